@@ -1,40 +1,28 @@
 import pandas as pd
 import numpy as np
-import pandas_datareader.data as web
 from pandas_datareader._utils import RemoteDataError
 from pandas.tseries.offsets import BDay
 from datetime import datetime
-import cPickle as pickle
-from collections import namedtuple
 import csv
-import gzip
+import re
 import os
 
+from transcript_store import TranscriptStore
+from price_store import default_store, FIRST_DATE
+from price_fetcher import prefetch
 
-# Must be included to read contents of pickle file
-Transcript = namedtuple('Transcript', ['company',
-                                       'ticker',
-                                       'date',
-                                       'return_3days',
-                                       'return_30days',
-                                       'return_60days',
-                                       'return_90days',
-                                       'prepared',
-                                       'QandA'])
 
-
-def load_data(folder='../data', file='transcripts.p.gz'):
+def load_data(folder='../data', file='transcripts'):
     filepath = os.path.join(folder, file)
     print 'Loading {}'.format(filepath)
-    with gzip.open(filepath, 'rb') as f:
-        return pickle.load(f)
+    return TranscriptStore(filepath)
 
 
-def get_tbill_historical():
+def get_tbill_historical(filepath='../data/tbill/historical_tbill.csv'):
 
     """ Reads in historical interest rate data for the 4-week Treasury Bill. """
 
-    tbill = pd.read_csv('../data/tbill/historical_tbill.csv')
+    tbill = pd.read_csv(filepath)
     tbill.fillna(method='pad', inplace=True)
     tbill['rate'] = tbill.rate.map(lambda x: x / 100.)
     tbill['date'] = pd.to_datetime(tbill.date)
@@ -47,7 +35,8 @@ def get_tbill_historical():
 def calculate_abnormal_returns(transcripts,
                                output,
                                time_periods=(3, 30, 60, 90),
-                               tbill=get_tbill_historical):
+                               tbill=get_tbill_historical,
+                               store=None):
 
     """
 
@@ -65,10 +54,14 @@ def calculate_abnormal_returns(transcripts,
         Beta of Stock = Cov(daily returns of stock, daily returns of market) / Var(daily returns of market)
         Return on Market = return of S&P 500 over time period
 
+    Prices come from the local price store (see price_store.py), so an interrupted run can be started
+    again from the beginning: the transcripts that were already done only read the cache.
+
     """
 
     # Load in S&P 500 and Treasury Bill data
     tbill = tbill()
+    store = store or default_store()
 
     # Column headers
     output.writerow(['key',
@@ -83,10 +76,6 @@ def calculate_abnormal_returns(transcripts,
 
     for key in transcripts.keys():
 
-        # Last stopping point
-        if key <= 56810:
-            continue
-
         company = transcripts[key]
         print 'Key: {}, Ticker: {}'.format(key, company.ticker)
 
@@ -119,7 +108,7 @@ def calculate_abnormal_returns(transcripts,
 
         # Adjust start and ends based on whether the market was open
         # Also, retrieve beginning and end values of S&P 500 to calculate market returns
-        index_prices, _ = get_stock_prices(symbol='^GSPC', start=start, ends=ends)
+        index_prices, _ = get_stock_prices(symbol='^GSPC', start=start, ends=ends, store=store)
 
         # Use returns over the prior 30 days to calculate beta
         beta_start = start - BDay(31)
@@ -131,11 +120,11 @@ def calculate_abnormal_returns(transcripts,
         symbol = company.ticker.split(':')[-1]
 
         # Pull price history for stock
-        stock_prices, _ = get_stock_prices(symbol=symbol, start=start, ends=ends)
-        beta_stock_prices, beta_stock_returns = get_stock_prices(symbol=symbol, start=beta_start, ends=beta_end)
+        stock_prices, _ = get_stock_prices(symbol=symbol, start=start, ends=ends, store=store)
+        beta_stock_prices, beta_stock_returns = get_stock_prices(symbol=symbol, start=beta_start, ends=beta_end, store=store)
 
         # Pull index returns for beta
-        _, beta_index_returns = get_stock_prices(symbol='^GSPC', start=beta_start, ends=beta_end)
+        _, beta_index_returns = get_stock_prices(symbol='^GSPC', start=beta_start, ends=beta_end, store=store)
 
         # Calculate beta
         beta = calculate_beta(beta_stock_returns, beta_index_returns)
@@ -174,14 +163,209 @@ def calculate_abnormal_returns(transcripts,
                          None] + abnormal_returns)
 
 
-def get_stock_prices(symbol, start, ends):
+# Prices of all symbols in a panel are flattened into one array, column after column, and every price
+# gets the key symbol * SPAN + day, so one searchsorted finds the trading days of any (symbol, date)
+SPAN = 1 << 20
+
+
+def event_table(transcripts):
+
+    """ DataFrame of (key, name, ticker, date) events from {key: Transcript}, e.g. TranscriptStore.headers() """
+
+    keys = sorted(transcripts.keys())
+    return pd.DataFrame({'key': keys,
+                         'name': [transcripts[key].company for key in keys],
+                         'ticker': [transcripts[key].ticker for key in keys],
+                         'date': [transcripts[key].date for key in keys]},
+                        columns=['key', 'name', 'ticker', 'date'])
+
+
+def price_panel(symbols, store=None):
+
+    """ Dates x symbols DataFrame of adjusted closing prices from the price store (symbols without data are left out) """
+
+    store = store or default_store()
+
+    # Fill the store for all symbols concurrently first, then read the prices from disk
+    prefetch(store, symbols)
+
+    columns = dict()
+    for symbol in set(symbols):
+        try:
+            columns[symbol] = store.prices(symbol, FIRST_DATE, datetime.today())
+        except RemoteDataError:
+            print 'Symbol: {}'.format(symbol), 'API_ERROR'
+
+    return pd.DataFrame(columns)
+
+
+def flatten_panel(prices):
+
+    """ Returns (symbols, keys, flat prices, flat daily returns) of the valid prices of every column of the panel """
+
+    symbols = list(prices.columns)
+    days = prices.index.values.astype('datetime64[D]').astype(np.int64)
+
+    values = prices.values.T
+    valid = ~np.isnan(values)
+    columns, rows = np.nonzero(valid)
+
+    keys = columns * SPAN + days[rows]
+    flat = values[valid]
+
+    # Return of every price over the previous price of the same symbol (the first one of a symbol is meaningless,
+    # but it is never used: the returns of a window start after its first price)
+    returns = np.empty_like(flat)
+    returns[1:] = flat[1:] / flat[:-1] - 1
+    returns[:1] = np.nan
+
+    return symbols, keys, flat, returns
+
+
+def window(keys, columns, start, end):
+
+    """ Flat indices of the first and last price of every (column, start, end), last < first if there is none """
 
-    """ Fetches stock prices for time periods using Yahoo! API """
+    first = np.searchsorted(keys, columns * SPAN + start, side='left')
+    last = np.searchsorted(keys, columns * SPAN + end, side='right') - 1
+    return first, last
+
+
+def to_days(dates):
+    return pd.DatetimeIndex(dates).values.astype('datetime64[D]').astype(np.int64)
+
+
+def batch_abnormal_returns(events, prices, tbill, time_periods=(3, 30, 60, 90), market='^GSPC', today=None):
+
+    """
+
+    Calculates the abnormal returns of all events at once, with the same definitions as
+    calculate_abnormal_returns (see there), using array operations instead of a loop over transcripts.
+
+    events: DataFrame with columns key, name, ticker and date (see event_table)
+    prices: dates x symbols DataFrame of adjusted closing prices, including the market index (see price_panel),
+            a ValueError is raised if it has no prices of the market index
+    tbill: DataFrame of the 4-week Treasury Bill rate indexed by date (see get_tbill_historical)
+
+    Returns a DataFrame with the columns of the CSV file: key, name, ticker, date, error_code and one
+    return_<days>days column per time period. Time periods that end in the future are NaN.
+
+    """
+
+    # Every beta and return is relative to the market, so there is nothing to compute without its prices
+    if market not in prices.columns or prices[market].isnull().all():
+        raise ValueError('No prices of the market index {} in the price panel'.format(market))
+
+    today = pd.Timestamp(today or datetime.today())
+    n = len(events)
+    dates = pd.DatetimeIndex(events.date)
+    tickers = events.ticker.astype(object)
+
+    symbols, keys, flat, returns = flatten_panel(prices)
+    column_of = {symbol: i for i, symbol in enumerate(symbols)}
+    columns = np.array([column_of.get(ticker.split(':')[-1], -1) for ticker in tickers], dtype=np.int64)
+    market_columns = np.repeat(column_of[market], n)
+
+    error_code = np.array([None] * n, dtype=object)
+
+    # Ensure date is not in the future or too far in the past, and that the ticker looks correct
+    date_error = np.asarray((dates >= today) | (dates < datetime(2001, 7, 31)))
+    ticker_error = ~date_error & np.array([ticker != ticker.upper() for ticker in tickers], dtype=bool)
+    error_code[date_error] = 'DATE_ERROR'
+    error_code[ticker_error] = 'TICKER_ERROR'
+
+    # Start date, beta window and end dates of every event (BDay on a whole DatetimeIndex is vectorized)
+    days = dates.normalize()
+    start = days - BDay(1)
+    beta_start = start - BDay(31)
+    beta_end = start - BDay(1)
+    ends = [days + BDay(period) for period in time_periods]
+
+    # Approximate 1-week risk free rate by diving 4-week rate by 4
+    risk_free = tbill.rate.reindex(start).values / 4
+
+    # Beta over the daily returns of the prior 30 days. Like np.cov in calculate_beta, the k-th return of the
+    # stock is paired with the k-th return of the market, and the counts must match
+    stock_first, stock_last = window(keys, columns, to_days(beta_start), to_days(beta_end))
+    market_first, market_last = window(keys, market_columns, to_days(beta_start), to_days(beta_end))
+    n_stock = np.maximum(stock_last - stock_first, 0)
+    n_market = np.maximum(market_last - market_first, 0)
+
+    beta_error = ~date_error & ~ticker_error & ((columns < 0) | (n_stock != n_market))
+    error_code[beta_error] = 'BETA_ERROR'
+
+    count = np.where(columns < 0, 0, n_stock)
+    offsets = np.arange(max(count.max() if n else 0, 1))
+    mask = offsets < count[:, None]
+    stock = np.where(mask, returns[np.minimum(stock_first[:, None] + 1 + offsets, len(returns) - 1)], 0.)
+    index = np.where(mask, returns[np.minimum(market_first[:, None] + 1 + offsets, len(returns) - 1)], 0.)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        stock_demeaned = np.where(mask, stock - stock.sum(axis=1)[:, None] / count[:, None], 0.)
+        index_demeaned = np.where(mask, index - index.sum(axis=1)[:, None] / count[:, None], 0.)
+        covariance = (stock_demeaned * index_demeaned).sum(axis=1) / (count - 1)
+        variance = (index_demeaned ** 2).sum(axis=1) / count
+        beta = np.where(count > 1, covariance / variance, np.nan)
+
+    ok = error_code == None
+
+    result = pd.DataFrame({'key': events.key.values,
+                           'name': events.name.values,
+                           'ticker': tickers.values,
+                           'date': events.date.values,
+                           'error_code': error_code},
+                          columns=['key', 'name', 'ticker', 'date', 'error_code'])
+
+    start_days = to_days(start)
+    for period, end in zip(time_periods, ends):
+
+        stock_first, stock_last = window(keys, columns, start_days, to_days(end))
+        market_first, market_last = window(keys, market_columns, start_days, to_days(end))
+
+        # Windows without prices point before the first or past the last price, they are masked below
+        def price(i):
+            return flat[np.clip(i, 0, len(flat) - 1)]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            market_return = price(market_last) / price(market_first) - 1
+            stock_return = price(stock_last) / price(stock_first) - 1
+            expected_return = risk_free + beta * (market_return - risk_free)
+            abnormal_return = stock_return - expected_return
+
+        # No prices for the time period (or it ends in the future)
+        missing = (stock_last < stock_first) | (market_last < market_first) | np.asarray(end >= today)
+        result['return_{}days'.format(period)] = np.where(ok & ~missing, abnormal_return, np.nan)
+
+    return result
+
+
+def write_abnormal_returns(returns, output):
+
+    """ Writes the rows of batch_abnormal_returns with a csv writer, in the format of calculate_abnormal_returns """
+
+    columns = [column for column in returns.columns if column.startswith('return_')]
+    output.writerow(['key', 'name', 'ticker', 'date', 'error_code'] + columns)
+
+    for row in returns.itertuples(index=False):
+        values = [None if pd.isnull(value) else value for value in row[5:]]
+        if row.error_code is not None:
+            values = []
+        # Trailing empty time periods are left out, like the time periods calculate_abnormal_returns drops
+        while values and values[-1] is None:
+            values.pop()
+        output.writerow([row.key, row.name.encode('utf-8'), row.ticker, pd.Timestamp(row.date), row.error_code] + values)
+
+
+def get_stock_prices(symbol, start, ends, store=None):
+
+    """ Fetches stock prices for time periods from the local price store, which calls the Yahoo! API on a miss """
+
+    store = store or default_store()
 
     data = []
     for end in ends:
         try:
-            stock_prices = web.DataReader(symbol, 'yahoo', start, end)['Adj Close']
+            stock_prices = store.prices(symbol, start, end)
             daily_stock_returns = stock_prices.pct_change()[start : end]
             data.append((stock_prices, daily_stock_returns))
         except RemoteDataError:
@@ -203,8 +387,22 @@ def calculate_beta(beta_stock_returns, beta_index_returns):
         return None
 
 
+def next_returns_file(folder='../data/abnormal_returns'):
+
+    """ Path of the next abnormal_returns<n>.csv in folder, the file that concat_returns reads last """
+
+    numbers = [int(match.group(1) or 1) for match in
+               [re.match(r'abnormal_returns(\d*)\.csv$', file) for file in os.listdir(folder)] if match]
+    number = max(numbers) + 1 if numbers else 1
+    return os.path.join(folder, 'abnormal_returns{}.csv'.format(number if number > 1 else ''))
+
+
 if __name__ == '__main__':
 
-    with open('../data/abnormal_returns7.csv', 'wb') as csvfile:
+    # Only the metadata is needed, not the text of the transcripts
+    events = event_table(load_data().headers())
+    prices = price_panel([ticker.split(':')[-1] for ticker in events.ticker] + ['^GSPC'])
+
+    with open(next_returns_file(), 'wb') as csvfile:
         w = csv.writer(csvfile)
-        calculate_abnormal_returns(load_data(), output=w)
\ No newline at end of file
+        write_abnormal_returns(batch_abnormal_returns(events, prices, get_tbill_historical()), output=w)
\ No newline at end of file
@@ -0,0 +1,256 @@
+import pandas as pd
+import numpy as np
+from collections import namedtuple
+from datetime import datetime
+import csv
+
+from abnormal_returns import load_data, get_tbill_historical, event_table, price_panel
+
+
+# A window of trading days relative to the event day (day 0 = first trading day on or after the call):
+# returns run from the close of day start to the close of day end
+Window = namedtuple('Window', ['name', 'start', 'end'])
+
+
+def horizon(days):
+
+    """ (t - 1) -> (t + days), the time periods of calculate_abnormal_returns """
+
+    return Window('return_{}days'.format(days), -1, days)
+
+
+def drift(days):
+
+    """ (t - days - 1) -> (t - 1), the drift before the call """
+
+    return Window('drift_{}days'.format(days), -days - 1, -1)
+
+
+def estimation(days):
+
+    """ Beta estimation window over the daily returns of the days prior to (t - 1), like BDay(31) in abnormal_returns """
+
+    return Window('beta_{}days'.format(days), -days - 2, -2)
+
+
+HORIZONS = [horizon(days) for days in (3, 30, 60, 90)]
+ESTIMATION = estimation(30)
+
+
+class SymbolHistory(object):
+
+    """
+
+    Prices of one symbol on the trading days of the market, with the cumulative sums needed to answer
+    the beta of any estimation window in O(1): number of paired daily returns, sum of stock returns,
+    market returns, their products and squared market returns. Entry k of a cumulative array is the
+    sum over the days before k, so the sum over the returns of days (a, b] is C[b + 1] - C[a + 1].
+
+    """
+
+    def __init__(self, prices, market_returns):
+
+        self.prices = prices
+
+        returns = np.empty_like(prices)
+        returns[0] = np.nan
+        returns[1:] = prices[1:] / prices[:-1] - 1
+
+        valid = ~np.isnan(returns) & ~np.isnan(market_returns)
+        x = np.where(valid, returns, 0.)
+        y = np.where(valid, market_returns, 0.)
+
+        def cumulative(values):
+            return np.concatenate([[0.], np.cumsum(values)])
+
+        self.n = cumulative(valid.astype(np.float64))
+        self.x = cumulative(x)
+        self.y = cumulative(y)
+        self.xy = cumulative(x * y)
+        self.yy = cumulative(y * y)
+
+    def beta(self, start, end, min_observations=10):
+
+        """ OLS beta of the stock on the market over the daily returns of days (start, end], for arrays of days """
+
+        a, b = start + 1, end + 1
+        n = self.n[b] - self.n[a]
+        x = self.x[b] - self.x[a]
+        y = self.y[b] - self.y[a]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            covariance = (self.xy[b] - self.xy[a]) - x * y / n
+            variance = (self.yy[b] - self.yy[a]) - y * y / n
+            return np.where(n >= min_observations, covariance / variance, np.nan)
+
+    def window_return(self, start, end):
+        with np.errstate(invalid='ignore'):
+            return self.prices[end] / self.prices[start] - 1
+
+
+class EventStudy(object):
+
+    """
+
+    Event study over a price panel (dates x symbols, see abnormal_returns.price_panel).
+
+    Everything that does not depend on the events is computed once: the trading days of the market, the
+    cumulative risk-free return and, per symbol, its prices on those days with the cumulative sums for
+    rolling betas (see SymbolHistory). Any set of return windows and estimation windows is then answered
+    with a few array lookups per event, so a new horizon does not mean refetching or recomputing anything.
+
+    The risk-free return over a window is the sum of the daily T-bill rate (annual rate / days_per_year)
+    over the days in the window, instead of the rate of the first day divided by 4.
+
+    """
+
+    def __init__(self, prices, tbill, market='^GSPC', days_per_year=252):
+
+        if market not in prices.columns or prices[market].isnull().all():
+            raise ValueError('No prices of the market index {} in the price panel'.format(market))
+
+        market_prices = prices[market].dropna()
+        self.index = market_prices.index
+        self.dates = market_prices.index.values.astype('datetime64[D]')
+        self.panel = prices.reindex(market_prices.index)
+        self.market_prices = market_prices.values.astype(np.float64)
+        self.market_returns = np.r_[np.nan, self.market_prices[1:] / self.market_prices[:-1] - 1]
+
+        rate = tbill.rate.reindex(market_prices.index, method='pad').fillna(0.).values / days_per_year
+        self.risk_free = np.concatenate([[0.], np.cumsum(rate[1:])])
+
+        self._histories = dict()
+
+    def __len__(self):
+        return len(self.dates)
+
+    def history(self, symbol):
+
+        """ SymbolHistory of symbol (computed on first use), None if the panel has no prices for it """
+
+        if symbol not in self._histories:
+            if symbol in self.panel.columns and self.panel[symbol].notnull().any():
+                prices = self.panel[symbol].values.astype(np.float64)
+                self._histories[symbol] = SymbolHistory(prices, self.market_returns)
+            else:
+                self._histories[symbol] = None
+        return self._histories[symbol]
+
+    def precompute(self, symbols):
+        for symbol in set(symbols):
+            self.history(symbol)
+
+    def event_days(self, dates):
+
+        """ Index of the first trading day on or after each date """
+
+        days = pd.DatetimeIndex(dates).normalize().values.astype('datetime64[D]')
+        return np.searchsorted(self.dates, days, side='left')
+
+    def run(self, events, windows=HORIZONS, estimations=(ESTIMATION,), min_observations=10, today=None):
+
+        """
+
+        Abnormal returns of events (DataFrame with key, name, ticker and date, see abnormal_returns.event_table)
+        over every window, with the beta of every estimation window. Returns a wide table: key, name, ticker,
+        date, error_code, one column per estimation window with the beta, and one column per window with the
+        abnormal return (named <window>_<estimation> when there is more than one estimation window).
+        Windows that reach outside of the price history are NaN.
+
+        """
+
+        today = pd.Timestamp(today or datetime.today())
+        n = len(events)
+        dates = pd.DatetimeIndex(events.date)
+        symbols = np.array([ticker.split(':')[-1] for ticker in events.ticker], dtype=object)
+        days = self.event_days(dates)
+
+        table = pd.DataFrame({'key': events.key.values,
+                              'name': events.name.values,
+                              'ticker': events.ticker.values,
+                              'date': events.date.values},
+                             columns=['key', 'name', 'ticker', 'date'])
+
+        error_code = np.array([None] * n, dtype=object)
+        date_error = np.asarray((dates >= today) | (dates < datetime(2001, 7, 31)))
+        ticker_error = ~date_error & np.array([ticker != ticker.upper() for ticker in events.ticker], dtype=bool)
+        error_code[date_error] = 'DATE_ERROR'
+        error_code[ticker_error] = 'TICKER_ERROR'
+
+        betas = {window.name: np.full(n, np.nan) for window in estimations}
+        columns = [(window, beta) for window in windows for beta in estimations]
+        name = (lambda window, beta: window.name) if len(estimations) == 1 else \
+            (lambda window, beta: '{}_{}'.format(window.name, beta.name))
+        returns = {name(window, beta): np.full(n, np.nan) for window, beta in columns}
+
+        def lookup(start, end):
+
+            """ Mask of the (start, end) day pairs inside of the price history, and the pairs clipped to it """
+
+            inside = (start >= 0) & (end < len(self)) & (start < end)
+            return inside, np.clip(start, 0, len(self) - 1), np.clip(end, 0, len(self) - 1)
+
+        # The events of one symbol are answered together
+        order = np.argsort(symbols, kind='mergesort')
+        bounds = np.flatnonzero(np.r_[True, symbols[order][1:] != symbols[order][:-1], True])
+
+        for first, last in zip(bounds[:-1], bounds[1:]):
+
+            rows = order[first:last]
+            rows = rows[error_code[rows] == None]
+            if not len(rows):
+                continue
+
+            history = self.history(symbols[rows[0]])
+            if history is None:
+                error_code[rows] = 'BETA_ERROR'
+                continue
+
+            event = days[rows]
+            for window in estimations:
+                inside, start, end = lookup(event + window.start, event + window.end)
+                betas[window.name][rows] = np.where(inside, history.beta(start, end, min_observations), np.nan)
+
+            for window in windows:
+                inside, start, end = lookup(event + window.start, event + window.end)
+                stock_return = history.window_return(start, end)
+                market_return = self.market_prices[end] / self.market_prices[start] - 1
+                risk_free = self.risk_free[end] - self.risk_free[start]
+
+                for beta in estimations:
+                    expected_return = risk_free + betas[beta.name][rows] * (market_return - risk_free)
+                    returns[name(window, beta)][rows] = np.where(inside, stock_return - expected_return, np.nan)
+
+        # Every beta must be known, otherwise the event is a BETA_ERROR like in abnormal_returns
+        missing = np.zeros(n, dtype=bool)
+        for beta in betas.itervalues():
+            missing |= np.isnan(beta)
+        error_code[(error_code == None) & missing] = 'BETA_ERROR'
+
+        table['error_code'] = error_code
+        for window in estimations:
+            table[window.name] = betas[window.name]
+        for window, beta in columns:
+            table[name(window, beta)] = np.where(error_code == None, returns[name(window, beta)], np.nan)
+
+        return table
+
+
+def main(windows=None, estimations=None, output='../data/event_study.csv'):
+
+    # Only the metadata is needed, not the text of the transcripts
+    events = event_table(load_data().headers())
+    prices = price_panel([ticker.split(':')[-1] for ticker in events.ticker] + ['^GSPC'])
+
+    study = EventStudy(prices, get_tbill_historical())
+    windows = windows or HORIZONS + [horizon(days) for days in (1, 5, 10, 120)] + [drift(10)]
+    table = study.run(events, windows, estimations or (ESTIMATION,))
+
+    table['name'] = table.name.map(lambda name: name.encode('utf-8'))
+    table.to_csv(output, index=False, quoting=csv.QUOTE_MINIMAL)
+    print 'Wrote {} events to {}'.format(len(table), output)
+    return table
+
+
+if __name__ == '__main__':
+    main()
@@ -1,69 +1,106 @@
-import cPickle as pickle
-from collections import namedtuple
 import pandas as pd
+import numpy as np
+import shutil
+import re
 import os
-from collections import deque
-import gzip
 
+from transcript_store import TranscriptStore, RETURNS, write_metadata
 
-Transcript = namedtuple('Transcript', ['company',
-                                       'ticker',
-                                       'date',
-                                       'return_3days',
-                                       'return_30days',
-                                       'return_60days',
-                                       'return_90days',
-                                       'prepared',
-                                       'QandA'])
 
+# Metadata table of all of the transcripts of a store, the one the returns are mapped from
+PARSED_TABLE = 'parsed.csv'
 
-def concat_returns(folder='../data'):
 
-    data_folder = os.path.join(folder)
-    files = deque([f for f in os.listdir(os.path.join(data_folder)) if f.find('abnormal_returns') != -1])
+def file_order(file):
 
-    returns = pd.read_csv(os.path.join(data_folder, files.popleft()))
-    for file in files:
-        frame = pd.read_csv(os.path.join(data_folder, file))
-        returns = returns.append(frame)
+    """ abnormal_returns.csv, abnormal_returns2.csv, ..., abnormal_returns10.csv (numbers compared as numbers) """
+
+    return [int(number) for number in re.findall(r'\d+', file)], file
+
+
+def concat_returns(folder='../data/abnormal_returns'):
+
+    """
+
+    Reads all abnormal_returns*.csv files of folder with a single concat. A key that is in more than one
+    file (e.g. a run that was resumed) keeps one row: one without an error if there is one, otherwise
+    the one from the last file in the order of file_order. Returns the rows without errors.
+
+    """
+
+    files = sorted([f for f in os.listdir(folder)
+                    if f.find('abnormal_returns') != -1 and f.endswith('.csv')], key=file_order)
+
+    frames = [pd.read_csv(os.path.join(folder, file)) for file in files]
+    returns = pd.concat([frame.assign(file=i) for i, frame in enumerate(frames)], ignore_index=True)
+
+    returns['ok'] = pd.isnull(returns['error_code'])
+    returns.sort_values(by=['key', 'ok', 'file'], kind='mergesort', inplace=True)
+    duplicates = returns.duplicated('key', keep='last')
+    if duplicates.any():
+        print 'Resolved {} duplicate rows of {} keys'.format(duplicates.sum(),
+                                                             returns.key[duplicates].nunique())
+    returns = returns[~duplicates]
 
     # Only return the ones without errors
-    return returns[pd.isnull(returns['error_code'])]
+    return returns[returns.ok].drop(['ok', 'file'], axis=1).reset_index(drop=True)
 
 
-def map_returns(returns, transcripts):
+def map_returns(returns, transcripts, renumber=True):
 
+    """
 
-    new_transcripts = {}
-    counter = 1
+    Joins the returns onto the metadata of the transcripts (a TranscriptStore) by key, and returns the
+    new metadata table (see transcript_store.write_metadata). The text is not read or copied: the rows
+    keep pointing at the paragraphs of the store. Only the transcripts with returns are kept, and
+    returns whose ticker or date do not match the transcript are dropped. With renumber, the keys
+    become 1, 2, ... in the order of the store, otherwise they are kept.
 
-    for row in returns.itertuples():
+    """
 
-        company, ticker, date, _, _, _, _, prepared, QandA = transcripts[row[1]]
+    returns = returns.drop_duplicates('key', keep='last')
+    returns = returns[['key', 'ticker', 'date'] + RETURNS].rename(columns={'ticker': 'returns_ticker',
+                                                                          'date': 'returns_date'})
 
-        new_transcripts[counter] = Transcript(company=company,
-                                              ticker=ticker,
-                                              date=date,
-                                              return_3days=row.return_3days,
-                                              return_30days=row.return_30days,
-                                              return_60days=row.return_60days,
-                                              return_90days=row.return_90days,
-                                              prepared=prepared,
-                                              QandA=QandA)
+    metadata = transcripts.metadata.drop(RETURNS, axis=1).reset_index(drop=True)
+    metadata = metadata.merge(returns, on='key', how='inner', sort=False)
 
-        counter += 1
-        print 'New Key {}'.format(counter)
+    matches = (metadata.ticker == metadata.returns_ticker) & \
+              (metadata.date == pd.to_datetime(metadata.returns_date))
+    if not matches.all():
+        print 'Dropped the returns of {} keys that belong to a different transcript'.format((~matches).sum())
+    metadata = metadata[matches].drop(['returns_ticker', 'returns_date'], axis=1)
 
+    metadata = metadata.sort_values(by=['chunk', 'paragraph'], kind='mergesort').reset_index(drop=True)
+    if renumber:
+        metadata['key'] = np.arange(1, len(metadata) + 1)
 
-    return new_transcripts
+    print 'Mapped the returns of {} of {} transcripts'.format(len(metadata), len(transcripts))
+    return metadata
 
 
-if __name__ == '__main__':
+def map_store(folder='../data/transcripts', returns_folder='../data/abnormal_returns'):
+
+    """
+
+    Maps the returns onto the store in folder like the map stage of the pipeline does: the transcripts
+    are read from the table parsed.csv, and the ones with returns are written to metadata.csv with their
+    keys. A store that has no parsed.csv yet (e.g. one converted from the pickle) gets a copy of its
+    metadata.csv first. The input table is never overwritten, so running it again gives the same table.
 
-    returns = concat_returns()
+    """
 
-    with gzip.open('../data/transcripts.p.gz', 'rb') as f:
-        transcripts = pickle.load(f)
+    parsed = os.path.join(folder, PARSED_TABLE)
+    if not os.path.isfile(parsed):
+        shutil.copyfile(os.path.join(folder, 'metadata.csv'), parsed + '.tmp')
+        os.rename(parsed + '.tmp', parsed)
 
-    new_transcripts = map_returns(returns, transcripts)
-    pickle.dump(new_transcripts, open('../data/transcripts.p', 'wb'))
\ No newline at end of file
+    returns = concat_returns(returns_folder)
+    transcripts = TranscriptStore(folder, PARSED_TABLE)
+
+    # Only the metadata table is written, the text of the store is shared
+    return write_metadata(map_returns(returns, transcripts, renumber=False), folder)
+
+
+if __name__ == '__main__':
+    map_store()
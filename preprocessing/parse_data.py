@@ -1,98 +1,190 @@
 import pandas as pd
+import numpy as np
 from bs4 import BeautifulSoup
-from collections import namedtuple
 import warnings
+import re
 import sys
 import os
 import gzip
+import time
+import shutil
+import tempfile
+from multiprocessing import Pool, cpu_count
+
+from transcript_store import Transcript, write_store
 
 
 # Filter warnings
 warnings.filterwarnings(action='ignore')
 
-# Note: this namedtuple must be defined in order for the pickled file to be opened
-Transcript = namedtuple('Transcript', ['company',
-                                       'ticker',
-                                       'date',
-                                       'return_3days',
-                                       'return_30days',
-                                       'return_60days',
-                                       'return_90days',
-                                       'prepared',
-                                       'QandA'])
 
+def clean_lines(lines):
 
-def clean_data(folder='../data', subfolder='../raw_data'):
+    """ Removes all quotes and filters out the blank lines of a list of raw lines, returns the cleaned text """
 
-    """ Cleans the scraped data by removing all quotes and empty lines. """
+    out = []
+    for line in lines:
+        # Remove all quotes
+        line = line.replace('"', '')
+        # Filter out lines that are blank
+        if len(line) > 18 or line == 'END OF TRANSCRIPT':
+            # Use quotes to ensure commas in text do not cause problems
+            out.append('"{}"\n'.format(line))
+    return ''.join(out)
 
-    data_folder = os.path.join(folder)
 
-    w = open(os.path.join(data_folder, 'clean_data.csv'), 'wb')
-    w.write('text\n') # Header for file
+def clean_file(args):
+
+    """
+
+    Cleans one gzipped raw data file into a part file. The file is decompressed in blocks of block_size
+    bytes and split on line breaks, carrying the incomplete last line over to the next block, so memory
+    use does not depend on the size of the file. Returns (part file, compressed bytes, decompressed bytes).
+
+    """
+
+    file, part, block_size = args
+
+    read = 0
+    carry = ''
+    first = True
+
+    with gzip.open(file, 'rb') as f, open(part, 'wb', 1 << 20) as w:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            read += len(block)
+
+            lines = (carry + block).split('\r\n')
+            carry = lines.pop()
+
+            # Skip the 1st line (column name)
+            if first and lines:
+                lines = lines[1:]
+                first = False
+
+            w.write(clean_lines(lines))
+
+        if not first:
+            w.write(clean_lines([carry]))
+
+    return part, os.path.getsize(file), read
+
+
+def clean_data(folder='../data', subfolder='../raw_data', workers=None, block_size=1 << 24):
+
+    """
+
+    Cleans the scraped data by removing all quotes and empty lines. The raw files are streamed in
+    parallel, one process per gzip file, into part files that are concatenated in the order of the files.
+
+    """
+
+    data_folder = os.path.join(folder)
 
     raw_data_folder = os.path.join(data_folder, subfolder)
     files = [os.path.join(raw_data_folder, f) for f in os.listdir(raw_data_folder) if f[-2:] == 'gz']
 
-    for file in files:
+    parts_folder = tempfile.mkdtemp(prefix='clean', dir=data_folder)
+    tasks = [(file, os.path.join(parts_folder, 'part{}.csv'.format(i)), block_size) for i, file in enumerate(files)]
+
+    start = time.time()
+    compressed = decompressed = 0
+    pool = Pool(workers or min(cpu_count(), len(files)) or 1)
 
-        print 'Cleaning {}...'.format(file)
+    try:
+        with open(os.path.join(data_folder, 'clean_data.csv'), 'wb', 1 << 20) as w:
+            w.write('text\n') # Header for file
 
-        with gzip.open(file, 'rb') as f:
-            csvfile = f.read().split('\r\n')
-            for i, line in enumerate(csvfile):
-                # Skip the 1st line (column name)
-                if i == 0:
-                    continue
-                # Remove all quotes
-                line = line.replace('"', '')
-                # Filter out lines that are blank
-                if len(line) > 18 or line == 'END OF TRANSCRIPT':
-                    # Use quotes to ensure commas in text do not cause problems
-                    w.write('"{}"'.format(line))
-                    w.write('\n')
-    w.close()
+            # imap returns the parts in the order of the files, while later files are still being cleaned
+            for file, (part, size, read) in zip(files, pool.imap(clean_file, tasks)):
+                compressed += size
+                decompressed += read
+                elapsed = max(time.time() - start, 1e-6)
+                print 'Cleaned {} ({:.1f} MB/s, {:.1f} MB/s decompressed)'.format(file,
+                                                                                  compressed / elapsed / 1e+6,
+                                                                                  decompressed / elapsed / 1e+6)
+                with open(part, 'rb') as f:
+                    shutil.copyfileobj(f, w, 1 << 20)
+                os.remove(part)
+    finally:
+        pool.terminate()
+        shutil.rmtree(parts_folder, ignore_errors=True)
 
 
-def split_transcripts(folder='../data', file='../clean_data.csv'):
+# Lines made of printable ASCII, with simple tags and entities only, are stripped with regular expressions.
+# Everything else (comments, scripts, stray '<', unknown entities, blank text between tags, non-ASCII text)
+# goes through BeautifulSoup, whose parser handles those differently depending on where they are
+SIMPLE_LINE = re.compile(r'^(?!\s|</)(?!.*>\s+(?:<|$))[\x20-\x7e]*$')
+TAG = re.compile(r'</?(?:p|br|b|i|u|em|strong|span|a|div|h[1-6]|sup|sub|small|font)(?:\s[^<>]*)?/?>', re.IGNORECASE)
+ENTITY = re.compile(r'&(amp|lt|gt|quot|nbsp|#(?:3[2-9]|[4-9][0-9]|1[01][0-9]|12[0-6]));')
+ENTITIES = {'amp': u'&', 'lt': u'<', 'gt': u'>', 'quot': u'"', 'nbsp': u'\xa0'}
+UNSAFE = re.compile(r'<|&(?!(?:amp|lt|gt|quot|nbsp|#(?:3[2-9]|[4-9][0-9]|1[01][0-9]|12[0-6]));)|^\s*$')
+
+
+def unescape(match):
+    name = match.group(1)
+    return ENTITIES[name] if name in ENTITIES else unichr(int(name[1:]))
+
+
+def html_to_text(text):
 
     """
 
-    Splits the data file into namedtuples, each with a different transcript. The tuples are stored in a dictionary.
+    Same as text.map(lambda x: BeautifulSoup(x).get_text()), but the simple lines (almost all of them)
+    are stripped in one vectorized pass and only the rest are parsed with BeautifulSoup.
+
+    """
+
+    text = text.astype(object)
+    stripped = text.str.replace(TAG, '')
+    simple = (text.str.match(SIMPLE_LINE) & ~stripped.str.contains(UNSAFE)).fillna(False).astype(bool)
+
+    plain = pd.Series(index=text.index, dtype=object)
+    plain[simple] = stripped[simple].str.decode('ascii').str.replace(ENTITY, unescape)
+    plain[~simple] = text[~simple].map(lambda x: BeautifulSoup(x).get_text())
+    return plain
 
-    Format of namedtuple:
-    Transcript(company=<string>,
-               ticker=<string>,
-               date=<timestamp>,
-               prepared=<dataframe>,
-               QandA=<dataframe>)
+
+def parse_transcripts(df):
 
     """
 
-    filepath = os.path.join(folder, file)
-    df = pd.read_csv(filepath, verbose=True)
+    Splits a DataFrame of whole transcripts (each one followed by its END OF TRANSCRIPT line) and
+    returns a list with a Transcript, or None if it was filtered out, for every END OF TRANSCRIPT line.
 
-    end_of_transcripts = df[df.text == 'END OF TRANSCRIPT'].index
-    print 'Total Number of Transcripts: {}'.format(len(end_of_transcripts))
+    """
 
-    transcripts = {}
-    last_end = -1
-    n_transcript = 1
+    text = df.text.reset_index(drop=True)
+    ends = np.flatnonzero((text == 'END OF TRANSCRIPT').values)
+    starts = np.r_[0, ends[:-1] + 1].astype(int)
+
+    # First Q&A line of every transcript in one pass over the whole column (-1 if the transcript has none)
+    q_and_a_lines = np.flatnonzero(text.str.contains('id=question-answer-session').fillna(False).values)
+    q_and_a_lines = np.r_[q_and_a_lines, len(text)]
+    begins = q_and_a_lines[np.searchsorted(q_and_a_lines, starts)]
+    begins[begins >= ends] = -1
 
-    for i, end in enumerate(end_of_transcripts):
+    # Only the lines of transcripts that are long enough are converted to text
+    keep = np.zeros(len(text), dtype=bool)
+    for start, end in zip(starts, ends):
+        if end - start > 4:
+            keep[start:end] = True
+    plain = np.empty(len(text), dtype=object)
+    plain[keep] = html_to_text(text[keep]).values
 
-        sys.stdout.write("Transcripts Completed: %d%%   \r" % (100 * float(i) / len(end_of_transcripts)))
-        sys.stdout.flush()
+    transcripts = []
+    for start, end, begin in zip(starts, ends, begins):
 
-        transcript = df[(last_end + 1) : end].reset_index(drop=True)
-        last_end = end
+        transcripts.append(None)
 
         # Remove transcripts without required text (e.g. ones that reference an audio call only)
-        if len(transcript) <= 4:
+        if end - start <= 4:
             continue
 
         # Extract company name from first line of transcript
-        company = BeautifulSoup(transcript.iloc[0].values[0]).get_text()
+        company = plain[start]
 
         # Remove transcripts where the first line does not end with a closing parenthesis (indicates end of ticker)
         if len(company) < 1:
@@ -107,38 +199,84 @@ def split_transcripts(folder='../data', file='../clean_data.csv'):
         ticker = company[open_paren + 1 : close_paren]
 
         # Extract the date of the call from the third line of the transcript
-        date =  BeautifulSoup(transcript.iloc[2].values[0]).get_text()
+        date = plain[start + 2]
 
         # Remove transcripts with dates that cannot easily be converted into timestamps (for whatever reason)
         try:
             date = pd.to_datetime(date)
         except ValueError:
-            # Uncomment the line below for examples of dates that are in an incorrect format
-            # print date
             continue
 
         # Remove transcripts with improperly tagged Q&A sections
-        try:
-            begin_q_and_a = transcript[transcript.text.str.contains('id=question-answer-session')].index[0]
-        except IndexError:
+        if begin < 0:
             continue
 
-        # Split the remaining text into prepared remarks and the Q&A session
-        q_and_a = transcript[begin_q_and_a : ].text.map(lambda x: BeautifulSoup(x).get_text())
-        prepared = transcript[3 : begin_q_and_a].text.map(lambda x: BeautifulSoup(x).get_text())
+        # Split the remaining text into prepared remarks and the Q&A session (indexed by line in the transcript)
+        begin -= start
+        q_and_a = pd.Series(plain[start + begin : end], index=range(begin, end - start), name='text')
+        prepared = pd.Series(plain[start + 3 : start + begin], index=range(3, max(begin, 3)), name='text', dtype=object)
+
+        transcripts[-1] = Transcript(company=company,
+                                     ticker=ticker,
+                                     date=date,
+                                     return_3days=None,
+                                     return_30days=None,
+                                     return_60days=None,
+                                     return_90days=None,
+                                     prepared=prepared,
+                                     QandA=q_and_a)
+
+    return transcripts
+
 
-        # Store namedtuple in a dictionary, keys range from 1 to the number of transcripts
-        transcripts[n_transcript] = Transcript(company=company,
-                                               ticker=ticker,
-                                               date=date,
-                                               return_3days=None,
-                                               return_30days=None,
-                                               return_60days=None,
-                                               return_90days=None,
-                                               prepared=prepared,
-                                               QandA=q_and_a)
-        n_transcript += 1
+def split_transcripts(folder='../data', file='../clean_data.csv', workers=None, chunk_size=5000):
 
+    """
+
+    Splits the data file into namedtuples, each with a different transcript. The tuples are stored in a dictionary.
+
+    Format of namedtuple:
+    Transcript(company=<string>,
+               ticker=<string>,
+               date=<timestamp>,
+               prepared=<dataframe>,
+               QandA=<dataframe>)
+
+    The file is cut into chunks of about chunk_size transcripts, which are parsed by a pool of worker processes.
+
+    """
+
+    filepath = os.path.join(folder, file)
+    df = pd.read_csv(filepath, verbose=True)
+
+    end_of_transcripts = np.flatnonzero((df.text == 'END OF TRANSCRIPT').values)
+    print 'Total Number of Transcripts: {}'.format(len(end_of_transcripts))
+
+    # Chunks end right after an END OF TRANSCRIPT line, so no transcript is split between two chunks
+    bounds = [0] + [end + 1 for end in end_of_transcripts[chunk_size - 1::chunk_size]]
+    if bounds[-1] < (end_of_transcripts[-1] + 1 if len(end_of_transcripts) else 0):
+        bounds.append(end_of_transcripts[-1] + 1)
+    chunks = [df[first:last] for first, last in zip(bounds[:-1], bounds[1:])]
+
+    transcripts = {}
+    n_transcript = 1
+    done = 0
+
+    pool = Pool(workers or min(cpu_count(), len(chunks)) or 1)
+    try:
+        for parsed in pool.imap(parse_transcripts, chunks):
+
+            for transcript in parsed:
+                # Store namedtuple in a dictionary, keys range from 1 to the number of transcripts
+                if transcript is not None:
+                    transcripts[n_transcript] = transcript
+                    n_transcript += 1
+
+            done += len(parsed)
+            sys.stdout.write("Transcripts Completed: %d%%   \r" % (100 * float(done) / len(end_of_transcripts)))
+            sys.stdout.flush()
+    finally:
+        pool.terminate()
 
     print 'Transcripts Remaining after Filtering: {}'.format(len(transcripts.keys()))
     return transcripts
@@ -152,14 +290,8 @@ def main():
     # Uncomment below for an example of output
     # print transcripts[1]
 
-    # Save transcripts dictionary to pickle file for easy re-opening
-    import cPickle as pickle
-
-    folder = '../data'
-    filename = 'transcripts.p'
-    path = os.path.join(folder, filename)
-
-    pickle.dump(transcripts, open(path, 'wb'))
+    # Save transcripts to the columnar store (see transcript_store.py) for easy re-opening
+    write_store(transcripts, os.path.join('../data', 'transcripts'))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,477 @@
+import pandas as pd
+from pandas.tseries.offsets import BDay
+from multiprocessing import Pool, cpu_count
+from collections import OrderedDict
+from datetime import datetime
+import cPickle as pickle
+import hashlib
+import json
+import time
+import csv
+import sys
+import os
+
+from transcript_store import TranscriptStore, write_store, write_metadata
+from parse_data import clean_file, parse_transcripts
+from abnormal_returns import get_tbill_historical, event_table, price_panel, batch_abnormal_returns, \
+    write_abnormal_returns
+from map_returns_to_transcript import concat_returns, map_returns, PARSED_TABLE
+from price_store import default_store
+
+# The index stage uses the search code
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'search'))
+
+
+def digest(*values):
+
+    """ SHA-1 of values serialized as JSON (so str and unicode, lists and tuples hash the same) """
+
+    return hashlib.sha1(json.dumps(values, sort_keys=True, default=str)).hexdigest()
+
+
+def file_digest(path, cache=None, block_size=1 << 20):
+
+    """
+
+    SHA-1 of the contents of a file. With a cache dict, the digest is only recomputed when the size or
+    the modification time of the file changed since it was last hashed.
+
+    """
+
+    stat = os.stat(path)
+    signature = [stat.st_size, stat.st_mtime]
+    if cache is not None and path in cache and cache[path][0] == signature:
+        return cache[path][1]
+
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), ''):
+            h.update(block)
+
+    if cache is not None:
+        cache[path] = [signature, h.hexdigest()]
+    return h.hexdigest()
+
+
+def save_json(data, path):
+
+    # Written to a temporary file first, so a crash never leaves a broken checkpoint behind
+    with open(path + '.tmp', 'wb') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.rename(path + '.tmp', path)
+
+
+def load_json(path, default=None):
+    if not os.path.isfile(path):
+        return default
+    with open(path, 'rb') as f:
+        return json.load(f)
+
+
+class Stage(object):
+
+    """
+
+    A stage of the pipeline. Its work is split into partitions (a raw file, a range of keys, ...) that
+    are independent of each other:
+
+        partitions(pipeline)   OrderedDict of partition -> digest of everything the partition is computed
+                               from (its input files, the outputs of the stages before, parameters)
+        build(partition)       computes the output of one partition, returns the digest of the output
+        remove(partition)      deletes the output of a partition that no longer exists
+        collect(partitions)    combines the outputs once all partitions are built (optional), returns the
+                               digest of the combined output
+
+    The pipeline only builds the partitions whose input digest changed, and saves a checkpoint after
+    every partition. Stages with parallel = True build their partitions in a pool of processes, so
+    they must be picklable and build must not depend on the pipeline object.
+
+    """
+
+    name = None
+    parallel = False
+
+    def __init__(self, folder):
+        self.folder = os.path.join(folder, self.name)
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+
+    def path(self, *parts):
+        return os.path.join(self.folder, *parts)
+
+    def partitions(self, pipeline):
+        raise NotImplementedError
+
+    def build(self, partition):
+        raise NotImplementedError
+
+    def remove(self, partition):
+        pass
+
+    def collect(self, partitions):
+        return None
+
+
+def build_partition(args):
+    stage, partition = args
+    return partition, stage.build(partition)
+
+
+class CleanStage(Stage):
+
+    """ One partition per raw gzip file, cleaned into <file>.csv (see parse_data.clean_file) """
+
+    name = 'clean'
+    parallel = True
+
+    def __init__(self, folder, raw_folder='../data/raw_data', block_size=1 << 24):
+        Stage.__init__(self, folder)
+        self.raw_folder = raw_folder
+        self.block_size = block_size
+
+    def partitions(self, pipeline):
+        files = sorted(f for f in os.listdir(self.raw_folder) if f.endswith('.csv.gz'))
+        return OrderedDict((f, file_digest(os.path.join(self.raw_folder, f), pipeline.files)) for f in files)
+
+    def output(self, partition):
+        return self.path(partition[:-len('.gz')])
+
+    def build(self, partition):
+        clean_file((os.path.join(self.raw_folder, partition), self.output(partition), self.block_size))
+        return file_digest(self.output(partition))
+
+    def remove(self, partition):
+        if os.path.isfile(self.output(partition)):
+            os.remove(self.output(partition))
+
+
+class ParseStage(Stage):
+
+    """
+
+    One partition per cleaned file, split into transcripts (see parse_data.parse_transcripts) and pickled.
+    collect numbers the transcripts of all files in the order of the file names, starting at 1, and
+    writes them as one TranscriptStore, with all of them in the metadata table parsed.csv (the map
+    stage writes metadata.csv). A raw file that sorts after the others therefore only adds keys, and
+    the keys of the transcripts that were there already stay the same.
+
+    The metadata.csv of the map stage is carried over into the new store (see write_store), so the
+    store can still be opened with the returns of the unchanged transcripts until the map stage has
+    run again, e.g. after a run that was interrupted in between.
+
+    """
+
+    name = 'parse'
+    parallel = True
+    metadata = PARSED_TABLE
+    keep = ['metadata.csv']
+
+    def __init__(self, folder, clean, store='../data/transcripts'):
+        Stage.__init__(self, folder)
+        self.clean = clean
+        self.store = store
+
+    def open(self):
+        return TranscriptStore(self.store, self.metadata)
+
+    def partitions(self, pipeline):
+        return pipeline.outputs(self.clean.name)
+
+    def output(self, partition):
+        return self.path(partition[:-len('.csv.gz')] + '.p')
+
+    def build(self, partition):
+        df = pd.read_csv(self.clean.output(partition), header=None, names=['text'])
+        transcripts = [transcript for transcript in parse_transcripts(df) if transcript is not None]
+        with open(self.output(partition) + '.tmp', 'wb') as f:
+            pickle.dump(transcripts, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(self.output(partition) + '.tmp', self.output(partition))
+        return file_digest(self.output(partition))
+
+    def remove(self, partition):
+        if os.path.isfile(self.output(partition)):
+            os.remove(self.output(partition))
+
+    def transcripts(self, partitions):
+        key = 1
+        for partition in partitions:
+            with open(self.output(partition), 'rb') as f:
+                for transcript in pickle.load(f):
+                    yield key, transcript
+                    key += 1
+
+    def collect(self, partitions):
+        write_store(self.transcripts(partitions), self.store, metadata=self.metadata, keep=self.keep)
+        return digest(partitions.items())
+
+
+class ReturnsStage(Stage):
+
+    """
+
+    One partition per range of chunk_size keys of the parsed store: the abnormal returns of its
+    transcripts (see abnormal_returns.batch_abnormal_returns), in the CSV format of abnormal_returns.py.
+    This replaces resuming by hand (key <= 56810, abnormal_returns7.csv): a crashed run keeps the key
+    ranges that are done, and a new raw file only adds key ranges at the end. The ranges with a time
+    period that has not ended yet are computed again on the next day, and all of them when the
+    T-bill rates change.
+
+    """
+
+    name = 'returns'
+
+    def __init__(self, folder, parse, chunk_size=1000, time_periods=(3, 30, 60, 90), store=None,
+                 tbill_file='../data/tbill/historical_tbill.csv'):
+        Stage.__init__(self, folder)
+        self.parse = parse
+        self.chunk_size = chunk_size
+        self.time_periods = time_periods
+        self.store = store
+        self.tbill_file = tbill_file
+        self.events = None
+        self.tbill = None
+
+    def partitions(self, pipeline):
+
+        self.events = event_table(self.parse.open().headers())
+        tbill = file_digest(self.tbill_file, pipeline.files)
+        today = pd.Timestamp(datetime.today()).normalize()
+        pending = (pd.DatetimeIndex(self.events.date) + BDay(max(self.time_periods))) >= today
+
+        # Fixed ranges of keys (1-1000, 1001-2000, ...), so new keys do not move the ranges before them
+        ranges = (self.events.key.values - 1) // self.chunk_size
+        partitions = OrderedDict()
+        for r in sorted(set(ranges)):
+            events = self.events[ranges == r]
+            name = '{}-{}'.format(r * self.chunk_size + 1, (r + 1) * self.chunk_size)
+            partitions[name] = digest(tbill, self.time_periods,
+                                      [(key, ticker, str(date)) for key, ticker, date in
+                                       zip(events.key, events.ticker, events.date)],
+                                      str(today) if pending[ranges == r].any() else None)
+        return partitions
+
+    def output(self, partition):
+        return self.path('abnormal_returns{}.csv'.format(partition))
+
+    def build(self, partition):
+
+        first, last = [int(key) for key in partition.split('-')]
+        events = self.events[(self.events.key >= first) & (self.events.key <= last)]
+
+        self.tbill = self.tbill if self.tbill is not None else get_tbill_historical(self.tbill_file)
+        self.store = self.store or default_store()
+        prices = price_panel([ticker.split(':')[-1] for ticker in events.ticker] + ['^GSPC'], self.store)
+        returns = batch_abnormal_returns(events, prices, self.tbill, self.time_periods)
+
+        with open(self.output(partition) + '.tmp', 'wb') as csvfile:
+            write_abnormal_returns(returns, output=csv.writer(csvfile))
+        os.rename(self.output(partition) + '.tmp', self.output(partition))
+        return file_digest(self.output(partition))
+
+    def remove(self, partition):
+        if os.path.isfile(self.output(partition)):
+            os.remove(self.output(partition))
+
+
+class MapStage(Stage):
+
+    """
+
+    Joins the returns onto the parsed transcripts (see map_returns_to_transcript), keeping their keys,
+    and writes the metadata table (metadata.csv) of the store that was written by the parse stage.
+
+    """
+
+    name = 'map'
+
+    def __init__(self, folder, parse, returns):
+        Stage.__init__(self, folder)
+        self.parse = parse
+        self.returns = returns
+        self.output = parse.store
+
+    def partitions(self, pipeline):
+        return OrderedDict([('transcripts', digest(pipeline.collected(self.parse.name),
+                                                   pipeline.outputs(self.returns.name).items()))])
+
+    def build(self, partition):
+        returns = concat_returns(self.returns.folder)
+        return file_digest(write_metadata(map_returns(returns, self.parse.open(), renumber=False), self.output))
+
+
+class IndexStage(Stage):
+
+    """
+
+    Keeps the search index up to date with the transcript store. Every transcript has a digest in the
+    store (see transcript_store.transcript_digest), and the digests of the indexed transcripts are kept
+    in keys.json: new and changed transcripts are added as segments of batch_size transcripts (see
+    search/segments.py), with a checkpoint after every segment, and removed ones get tombstones.
+    The index is built from scratch (see build_index.buildIndex) when there is none.
+
+    """
+
+    name = 'index'
+
+    def __init__(self, folder, map, index='../search/index', batch_size=1000):
+        Stage.__init__(self, folder)
+        self.map = map
+        self.index = index
+        self.batch_size = batch_size
+
+    def partitions(self, pipeline):
+        return OrderedDict([('index', digest(pipeline.outputs(self.map.name).items()))])
+
+    def build(self, partition):
+
+        from build_index import buildIndex
+        from index_format import findShards
+        from segments import addTranscripts, removeTranscripts
+
+        transcripts = TranscriptStore(self.map.output)
+        digests = transcripts.digests()
+        checkpoint = self.path('keys.json')
+
+        if not os.path.isdir(self.index):
+            os.makedirs(self.index)
+
+        if not findShards(self.index):
+            buildIndex(transcripts, self.index)
+            save_json({str(key): value for key, value in digests.iteritems()}, checkpoint)
+            return digest(sorted(digests.items()))
+
+        # An index without a checkpoint was built by hand: every transcript is indexed again
+        indexed = {int(key): value for key, value in load_json(checkpoint, {}).iteritems()}
+
+        removed = [key for key in indexed if key not in digests]
+        if removed:
+            removeTranscripts(removed, self.index)
+            for key in removed:
+                del indexed[key]
+            save_json({str(key): value for key, value in indexed.iteritems()}, checkpoint)
+
+        changed = sorted(key for key, value in digests.iteritems() if indexed.get(key) != value)
+        for first in xrange(0, len(changed), self.batch_size):
+            keys = changed[first:first + self.batch_size]
+            addTranscripts(dict(transcripts.iteritems(keys)), self.index)
+            indexed.update((key, digests[key]) for key in keys)
+            save_json({str(key): value for key, value in indexed.iteritems()}, checkpoint)
+
+        print 'Index: {} transcripts added or changed, {} removed'.format(len(changed), len(removed))
+        return digest(sorted(digests.items()))
+
+
+class Pipeline(object):
+
+    """
+
+    Runs the stages in order: clean -> parse -> returns -> map -> index. The state of every stage
+    (input and output digest of every partition that is done, and the digest of the collected output)
+    is saved in <folder>/state/<stage>.json after each partition, so an interrupted run continues
+    where it stopped, and a run after a change (e.g. one more raw file) only rebuilds the partitions
+    whose inputs changed. A stage is collected again only when one of its partitions changed.
+
+    The folders of the transcript store and the index, the price store and the T-bill file can be
+    given, e.g. to run on test data.
+
+    """
+
+    def __init__(self, folder='../data/pipeline', raw_folder='../data/raw_data', workers=None, store=None,
+                 transcripts='../data/transcripts', index='../search/index',
+                 tbill_file='../data/tbill/historical_tbill.csv'):
+
+        self.folder = folder
+        self.workers = workers
+        self.state_folder = os.path.join(folder, 'state')
+        if not os.path.isdir(self.state_folder):
+            os.makedirs(self.state_folder)
+
+        # Digests of the files that were hashed, by size and modification time
+        self.files = load_json(os.path.join(self.state_folder, 'files.json'), {})
+
+        clean = CleanStage(folder, raw_folder)
+        parse = ParseStage(folder, clean, transcripts)
+        returns = ReturnsStage(folder, parse, store=store, tbill_file=tbill_file)
+        map = MapStage(folder, parse, returns)
+        index = IndexStage(folder, map, index)
+        self.stages = OrderedDict((stage.name, stage) for stage in [clean, parse, returns, map, index])
+
+    def state_path(self, name):
+        return os.path.join(self.state_folder, '{}.json'.format(name))
+
+    def state(self, name):
+        return load_json(self.state_path(name), {'inputs': {}, 'outputs': {}, 'collected': None})
+
+    def outputs(self, name):
+
+        """ OrderedDict of partition -> output digest of a stage, in the order of the partitions """
+
+        state = self.state(name)
+        return OrderedDict((partition, state['outputs'][partition]) for partition in state.get('order', [])
+                           if partition in state['outputs'])
+
+    def collected(self, name):
+        return self.state(name)['collected']
+
+    def run(self, names=None):
+
+        """ Runs the stages (all of them, or the ones in names, which must have run before) """
+
+        for name, stage in self.stages.iteritems():
+            if names is None or name in names:
+                self.run_stage(stage)
+
+    def run_stage(self, stage):
+
+        start = time.time()
+        state = self.state(stage.name)
+        partitions = stage.partitions(self)
+
+        stale = [partition for partition in state['inputs'] if partition not in partitions]
+        todo = [partition for partition, value in partitions.iteritems() if state['inputs'].get(partition) != value]
+
+        for partition in stale:
+            stage.remove(partition)
+            del state['inputs'][partition]
+            state['outputs'].pop(partition, None)
+
+        state['order'] = list(partitions)
+        changed = bool(stale) or bool(todo) or (state['collected'] is None and bool(partitions))
+
+        def done(partition, output):
+            state['inputs'][partition] = partitions[partition]
+            state['outputs'][partition] = output
+            save_json(state, self.state_path(stage.name))
+            save_json(self.files, os.path.join(self.state_folder, 'files.json'))
+            print '{}: {} done'.format(stage.name, partition)
+
+        # The collected output is invalid until all partitions are built again
+        state['collected'] = None if changed else state['collected']
+        save_json(state, self.state_path(stage.name))
+
+        if stage.parallel and len(todo) > 1:
+            pool = Pool(self.workers or min(cpu_count(), len(todo)))
+            try:
+                for partition, output in pool.imap_unordered(build_partition, [(stage, p) for p in todo]):
+                    done(partition, output)
+            finally:
+                pool.terminate()
+        else:
+            for partition in todo:
+                done(partition, stage.build(partition))
+
+        if changed:
+            state['collected'] = stage.collect(partitions) or digest(self.outputs(stage.name).items())
+            save_json(state, self.state_path(stage.name))
+
+        print 'Stage {}: {} of {} partitions built, {} removed ({:.1f}s)'.format(stage.name, len(todo),
+                                                                               len(partitions), len(stale),
+                                                                               time.time() - start)
+
+
+def main(names=None):
+    Pipeline().run(names)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:] or None)
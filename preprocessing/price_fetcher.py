@@ -0,0 +1,326 @@
+import pandas as pd
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+from pandas_datareader._utils import RemoteDataError
+from multiprocessing.pool import ThreadPool
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from collections import defaultdict
+from StringIO import StringIO
+import urlparse
+import threading
+import random
+import time
+import os
+
+from price_store import FixtureProvider, TransientError
+
+
+HOST = '127.0.0.1'
+PORT = 8766
+DATE_FORMAT = '%Y-%m-%d'
+
+
+class TokenBucket(object):
+
+    """ Thread-safe token bucket: at most rate requests per second on average, in bursts of at most capacity """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(rate, 1))
+        self.tokens = self.capacity
+        self.last = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+
+        """ Takes a token, sleeping until one is available. Returns the time spent waiting """
+
+        waited = 0.
+        while True:
+            with self._lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+
+class HttpProvider(object):
+
+    """
+
+    Fetches adjusted closing prices as CSV (Date, Adj Close) from GET <url>/prices/<symbol>?start=&end=,
+    e.g. from a StubPriceServer. 404 means there is no data for the symbol (RemoteDataError), other
+    errors are TransientError and get retried by the PriceFetcher.
+
+    """
+
+    def __init__(self, url='http://{}:{}'.format(HOST, PORT), timeout=30):
+        self.url = url.rstrip('/')
+        self.host = urlparse.urlparse(self.url).netloc
+        self.timeout = timeout
+
+    def __call__(self, symbol, start, end, session=None):
+
+        session = session or requests
+        try:
+            response = session.get('{}/prices/{}'.format(self.url, symbol),
+                                   params={'start': pd.Timestamp(start).strftime(DATE_FORMAT),
+                                           'end': pd.Timestamp(end).strftime(DATE_FORMAT)},
+                                   timeout=self.timeout)
+        except requests.RequestException as e:
+            raise TransientError(str(e))
+
+        if response.status_code == 404:
+            raise RemoteDataError('No data fetched for symbol {}'.format(symbol))
+        if response.status_code != 200:
+            raise TransientError('HTTP {} for {}'.format(response.status_code, symbol))
+
+        prices = pd.read_csv(StringIO(response.content), index_col='Date', parse_dates=True,
+                             float_precision='round_trip')['Adj Close']
+        return prices.sort_index()
+
+
+class Call(object):
+
+    """ A fetch in flight, shared by every thread that asks for the same prices in the meantime """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def get(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class PriceFetcher(object):
+
+    """
+
+    Concurrent front end for a price provider (HttpProvider, YahooProvider, ...), used as the provider
+    of a PriceStore. Requests for the same (symbol, start, end) that are in flight at the same time share
+    one fetch. Every host gets a token bucket (rate requests per second), one requests.Session (and its
+    connection pool) is shared by all threads, and transient failures are retried with exponential
+    backoff and jitter. The latency of every provider call is recorded (see percentiles).
+
+    """
+
+    def __init__(self, provider, workers=8, rate=5, burst=None, retries=4, backoff=0.5):
+
+        self.provider = provider
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.buckets = defaultdict(lambda: TokenBucket(rate, burst))
+        self.latencies = []
+        self.calls = 0
+        self.shared = 0
+        self.failures = 0
+
+        self._inflight = dict()
+        self._lock = threading.Lock()
+
+    def __call__(self, symbol, start, end):
+
+        key = (symbol, pd.Timestamp(start), pd.Timestamp(end))
+        with self._lock:
+            call = self._inflight.get(key)
+            owner = call is None
+            if owner:
+                call = self._inflight[key] = Call()
+            else:
+                self.shared += 1
+
+        if not owner:
+            return call.get()
+
+        try:
+            call.result = self._fetch(symbol, start, end)
+        except Exception as e:
+            call.error = e
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            call.done.set()
+
+        return call.get()
+
+    def _fetch(self, symbol, start, end):
+
+        bucket = self.buckets[getattr(self.provider, 'host', 'default')]
+
+        for attempt in xrange(self.retries + 1):
+
+            bucket.acquire()
+            begin = time.time()
+            try:
+                prices = self.provider(symbol, start, end, session=self.session)
+            except TransientError:
+                with self._lock:
+                    self.failures += 1
+                if attempt == self.retries:
+                    raise
+                time.sleep(self.backoff * 2 ** attempt * (1 + random.random()))
+                continue
+
+            with self._lock:
+                self.calls += 1
+                self.latencies.append(time.time() - begin)
+            return prices
+
+    def map(self, requests):
+
+        """ Fetches [(symbol, start, end)] concurrently; returns the prices, or the exception, of every request """
+
+        def fetch(request):
+            try:
+                return self(*request)
+            except (RemoteDataError, TransientError) as e:
+                return e
+
+        pool = ThreadPool(self.workers)
+        try:
+            return pool.map(fetch, requests, chunksize=1)
+        finally:
+            pool.terminate()
+
+    def percentiles(self, q=(50, 90, 99)):
+
+        """ Latency percentiles of the provider calls in seconds, {50: ..., 90: ..., 99: ...} """
+
+        if not self.latencies:
+            return dict()
+        return dict(zip(q, np.percentile(self.latencies, q)))
+
+    def report(self):
+        latency = ', '.join('p{}={:.0f}ms'.format(q, value * 1e+3) for q, value in sorted(self.percentiles().items()))
+        print 'Fetched {} price ranges ({} shared, {} retried): {}'.format(self.calls, self.shared,
+                                                                           self.failures, latency)
+
+
+def prefetch(store, symbols, workers=None):
+
+    """ Fills the price store for symbols concurrently (the store's provider should be a PriceFetcher) """
+
+    def fill(symbol):
+        try:
+            store.fill(symbol)
+        except TransientError as e:
+            # Not cached, so the next run tries again
+            print 'Symbol: {}'.format(symbol), 'FETCH_ERROR', e
+
+    workers = workers or getattr(store.provider, 'workers', 8)
+    pool = ThreadPool(workers)
+    try:
+        pool.map(fill, sorted(set(symbols)), chunksize=1)
+    finally:
+        pool.terminate()
+
+    if hasattr(store.provider, 'report'):
+        store.provider.report()
+
+
+class StubPriceServer(ThreadingMixIn, HTTPServer):
+
+    """
+
+    Local stand-in for the price API, for testing the fetch layer without network access. Serves the
+    fixture CSVs of FixtureProvider, optionally with added latency (seconds) and a rate of failures
+    (HTTP 503). Counts the requests per symbol. Endpoint:
+
+        GET /prices/<symbol>?start=YYYY-MM-DD&end=YYYY-MM-DD   ->  CSV with Date, Adj Close
+
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, folder='../data/fixtures/prices', host=HOST, port=PORT, latency=0., failure_rate=0.):
+
+        self.fixtures = FixtureProvider(folder)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.requests = defaultdict(int)
+        HTTPServer.__init__(self, (host, port), StubPriceHandler)
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address)
+
+    def start(self):
+
+        """ Serves from a background thread (for tests), returns the thread """
+
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+class StubPriceHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+
+        url = urlparse.urlparse(self.path)
+        params = urlparse.parse_qs(url.query)
+
+        if not url.path.startswith('/prices/'):
+            self.respond(404, 'unknown endpoint {}'.format(url.path))
+            return
+
+        symbol = urlparse.unquote(url.path[len('/prices/'):])
+        self.server.requests[symbol] += 1
+        time.sleep(self.server.latency)
+
+        if random.random() < self.server.failure_rate:
+            self.respond(503, 'try again')
+            return
+
+        try:
+            prices = self.server.fixtures(symbol, params['start'][0], params['end'][0])
+        except RemoteDataError:
+            self.respond(404, 'no data for {}'.format(symbol))
+            return
+
+        body = StringIO()
+        prices.to_frame('Adj Close').to_csv(body, index_label='Date', date_format=DATE_FORMAT, float_format='%r')
+        self.respond(200, body.getvalue(), 'text/csv')
+
+    def respond(self, code, body, content_type='text/plain'):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(folder='../data/fixtures/prices', host=HOST, port=PORT):
+    server = StubPriceServer(folder, host, port)
+    print 'Serving price fixtures from {} on {}:{}'.format(os.path.abspath(folder), host, port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    serve()
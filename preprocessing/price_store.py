@@ -0,0 +1,283 @@
+import pandas as pd
+import numpy as np
+import requests
+from pandas_datareader.yahoo.daily import YahooDailyReader
+from pandas_datareader._utils import RemoteDataError
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import threading
+import urllib
+import urlparse
+import os
+
+
+# Every symbol is fetched over this whole range the first time it is used, so later windows are cache hits
+FIRST_DATE = datetime(2001, 1, 1)
+
+
+def to_day(date):
+
+    """ Date, datetime or Timestamp -> numpy datetime64[D] """
+
+    return np.datetime64(pd.Timestamp(date).normalize().date(), 'D')
+
+
+class TransientError(Exception):
+
+    """ A fetch that failed for a reason worth retrying (server error, rate limit, timeout, dropped connection) """
+
+
+class YahooReader(YahooDailyReader):
+
+    """
+
+    YahooDailyReader that makes one request per read and tells failures apart instead of retrying them
+    itself: 404 means there is no data for the symbol (RemoteDataError), any other error is a TransientError,
+    so the PriceFetcher retries it with backoff and the PriceStore never caches it.
+
+    """
+
+    def __init__(self, symbol, start, end, session=None, url=None):
+        YahooDailyReader.__init__(self, symbol, start, end, retry_count=0, pause=0, session=session)
+        self._url = url
+
+    @property
+    def url(self):
+        return self._url or YahooDailyReader.url.fget(self)
+
+    def _get_response(self, url, params=None, headers=None):
+
+        try:
+            response = self.session.get(url, params=params, headers=headers or self.headers)
+        except requests.RequestException as e:
+            raise TransientError(str(e))
+
+        if response.status_code == 404:
+            raise RemoteDataError('No data fetched for symbol {}'.format(self.symbols))
+        if response.status_code != 200:
+            raise TransientError('HTTP {} for {}'.format(response.status_code, self.symbols))
+        return response
+
+
+class YahooProvider(object):
+
+    """ Fetches adjusted closing prices from the Yahoo! API (url is for testing, e.g. 'http://127.0.0.1:8767/{}') """
+
+    def __init__(self, url=None):
+        self.url = url
+        self.host = urlparse.urlparse(url).netloc if url else 'finance.yahoo.com'
+
+    def __call__(self, symbol, start, end, session=None):
+
+        try:
+            return YahooReader(symbol, start, end, session, self.url).read()['Adj Close']
+        except requests.RequestException as e:
+            raise TransientError(str(e))
+        except (AttributeError, ValueError) as e:
+            # A page without the prices (e.g. a consent or rate limit page served with 200)
+            raise TransientError('Unexpected response for {}: {}'.format(symbol, e))
+
+
+class FixtureProvider(object):
+
+    """
+
+    Stand-in for the Yahoo! API that reads prices from local CSV files, one per symbol, in the format of
+    the Yahoo! download (Date, ..., Adj Close). Unknown symbols raise RemoteDataError like the API does.
+
+    """
+
+    def __init__(self, folder='../data/fixtures/prices'):
+        self.folder = folder
+
+    def __call__(self, symbol, start, end, session=None):
+
+        path = os.path.join(self.folder, '{}.csv'.format(symbol))
+        if not os.path.isfile(path):
+            raise RemoteDataError('No data fetched for symbol {}'.format(symbol))
+
+        prices = pd.read_csv(path, index_col='Date', parse_dates=True, float_precision='round_trip')['Adj Close']
+        prices = prices.sort_index()
+        return prices[pd.Timestamp(start):pd.Timestamp(end)]
+
+
+class PriceHistory(object):
+
+    """
+
+    Price history of one symbol: sorted dates (datetime64[D]) and adjusted closing prices, plus the
+    range of dates that has been fetched (first, last), so that days without trading are not refetched.
+    A symbol the provider had no data for when its whole history was fetched is kept as an empty history
+    with missing=True, covering that range only: requests for later dates ask the provider again.
+
+    """
+
+    def __init__(self, dates=None, prices=None, first=None, last=None, missing=False):
+        self.dates = dates if dates is not None else np.array([], dtype='datetime64[D]')
+        self.prices = prices if prices is not None else np.array([], dtype=np.float64)
+        self.first = first
+        self.last = last
+        self.missing = missing
+
+    def covers(self, start, end):
+        return self.first is not None and self.first <= start and end <= self.last
+
+    def update(self, prices, first, last):
+
+        """ Merges newly fetched prices (a Series indexed by date) covering [first, last] """
+
+        dates = np.array([to_day(date) for date in prices.index], dtype='datetime64[D]')
+        keep = (self.dates < first) | (self.dates > last)
+        dates = np.concatenate([self.dates[keep], dates])
+        values = np.concatenate([self.prices[keep], np.asarray(prices.values, dtype=np.float64)])
+
+        order = np.argsort(dates, kind='mergesort')
+        self.dates, self.prices = dates[order], values[order]
+        self.first = first if self.first is None else min(first, self.first)
+        self.last = last if self.last is None else max(last, self.last)
+        self.missing = not len(self.dates)
+
+    def slice(self, start, end):
+
+        """ Adjusted closing prices from start to end (inclusive), found by binary search """
+
+        i = np.searchsorted(self.dates, start, side='left')
+        j = np.searchsorted(self.dates, end, side='right')
+        return pd.Series(self.prices[i:j], index=pd.DatetimeIndex(self.dates[i:j].astype('datetime64[ns]')),
+                         name='Adj Close')
+
+    def save(self, path):
+
+        # Written to a temporary file first, so an interrupted run never leaves a broken file behind
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f,
+                     dates=self.dates.astype(np.int64),
+                     prices=self.prices,
+                     range=np.array([self.first, self.last], dtype='datetime64[D]').astype(np.int64),
+                     missing=np.array(self.missing))
+        os.rename(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            first, last = [None if np.isnat(date) else date for date in data['range'].astype('datetime64[D]')]
+            return cls(data['dates'].astype('datetime64[D]'), data['prices'], first, last, bool(data['missing']))
+
+
+class PriceStore(object):
+
+    """
+
+    Local cache of daily adjusted closing prices, one columnar .npz file per symbol in folder.
+
+    The first request for a symbol fetches its whole history (FIRST_DATE until today) from the provider
+    in one call; later requests are served from the file by array indexing, and only dates outside of
+    the fetched range go back to the provider. The store survives restarts, so an interrupted run can
+    simply be started again. Pass FixtureProvider() to run without network access.
+
+    The store can be filled from several threads (see price_fetcher.prefetch): every symbol has a lock.
+
+    """
+
+    def __init__(self, folder='../data/prices', provider=None, maxsize=512):
+
+        self.folder = folder
+        self.provider = provider or YahooProvider()
+        self.maxsize = maxsize
+        self.fetches = 0
+        self._histories = OrderedDict()
+        self._lock = threading.Lock()
+        self._locks = dict()
+
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+    def path(self, symbol):
+        return os.path.join(self.folder, '{}.npz'.format(urllib.quote(symbol, safe='')))
+
+    def history(self, symbol):
+
+        """ The PriceHistory of symbol, from memory (most recently used symbols) or from its file """
+
+        with self._lock:
+            try:
+                history = self._histories.pop(symbol)
+            except KeyError:
+                path = self.path(symbol)
+                history = PriceHistory.load(path) if os.path.isfile(path) else PriceHistory()
+                if len(self._histories) >= self.maxsize:
+                    self._histories.popitem(last=False)
+
+            self._histories[symbol] = history
+            return history
+
+    def lock(self, symbol):
+        with self._lock:
+            return self._locks.setdefault(symbol, threading.Lock())
+
+    def fill(self, symbol, start=FIRST_DATE, end=None):
+
+        """
+
+        Fetches the parts of [start, end] that are not in the store yet, in at most two provider calls.
+        Only the first fetch (the whole history) can mark the symbol as missing: a gap the provider has
+        no data for is left out of the fetched range, so it is asked for again. Other errors (e.g. the
+        TransientError of a PriceFetcher) are raised before anything is saved.
+
+        """
+
+        start = to_day(start)
+        # The prices of today are not final yet, so the fetched range stops at yesterday
+        yesterday = to_day(datetime.today() - timedelta(days=1))
+        end = min(to_day(end), yesterday) if end is not None else yesterday
+
+        with self.lock(symbol):
+            history = self.history(symbol)
+            if history.covers(start, end) or start > end:
+                return history
+
+            if history.first is None:
+                gaps = [(min(start, to_day(FIRST_DATE)), yesterday)]
+            else:
+                one = np.timedelta64(1, 'D')
+                gaps = [(start, history.first - one), (history.last + one, end)]
+
+            for first, last in gaps:
+                if first > last:
+                    continue
+                with self._lock:
+                    self.fetches += 1
+                try:
+                    prices = self.provider(symbol, pd.Timestamp(first), pd.Timestamp(last))
+                except RemoteDataError:
+                    if history.first is not None:
+                        continue
+                    prices = pd.Series([], name='Adj Close')
+                history.update(prices.dropna(), first, last)
+
+            history.save(self.path(symbol))
+            return history
+
+    def prices(self, symbol, start, end):
+
+        """ Adjusted closing prices of symbol from start to end (inclusive), like the Adj Close column of the Yahoo! download """
+
+        history = self.fill(symbol, start, end)
+        if history.missing:
+            raise RemoteDataError('No data fetched for symbol {}'.format(symbol))
+        return history.slice(to_day(start), to_day(end))
+
+
+_store = None
+
+
+def default_store():
+
+    """ The price store shared by everything in this process, fetching from Yahoo! through a PriceFetcher """
+
+    from price_fetcher import PriceFetcher
+
+    global _store
+    if _store is None:
+        _store = PriceStore(provider=PriceFetcher(YahooProvider()))
+    return _store
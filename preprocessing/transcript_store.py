@@ -0,0 +1,311 @@
+import pandas as pd
+import numpy as np
+from collections import namedtuple
+import cPickle as pickle
+import hashlib
+import json
+import shutil
+import gzip
+import zlib
+import os
+
+
+# The one definition of the namedtuple used by all of the pipeline stages
+Transcript = namedtuple('Transcript', ['company',
+                                       'ticker',
+                                       'date',
+                                       'return_3days',
+                                       'return_30days',
+                                       'return_60days',
+                                       'return_90days',
+                                       'prepared',
+                                       'QandA'])
+
+RETURNS = ['return_3days', 'return_30days', 'return_60days', 'return_90days']
+
+
+class TranscriptStore(object):
+
+    """
+
+    Columnar, chunked store of the transcripts (replaces the gzip-pickled dict). Layout of the folder:
+
+        metadata.csv    one row per transcript: key, company, ticker, date, returns, where its
+                        paragraphs are (chunk, first paragraph, number of prepared / Q&A paragraphs),
+                        a digest of its paragraphs and a digest of everything (see transcript_digest)
+        offsets.npy     byte offset of every paragraph in the concatenated (utf-8) text, plus the end
+        chunks.npy      byte offset at which every chunk starts in the concatenated text
+        chunk<n>.z      zlib compressed text of the paragraphs of chunk n
+
+    Only metadata.csv is read when the store is opened, so filtering by ticker or date never touches
+    the text. Reading a transcript decompresses its chunk (the last chunk is kept), and iteritems()
+    streams the transcripts chunk by chunk. Behaves like the old {key: Transcript} dict.
+
+    The text is never rewritten to change the metadata: write_metadata writes a new table (e.g. with
+    the returns, see map_returns_to_transcript.py) whose rows point into the same chunks. A store can
+    have several tables, the one to open is given by metadata.
+
+    """
+
+    def __init__(self, folder='../data/transcripts', metadata='metadata.csv'):
+
+        self.folder = folder
+        self.metadata = pd.read_csv(os.path.join(folder, metadata), encoding='utf-8', float_precision='round_trip')
+        self.metadata['date'] = pd.to_datetime(self.metadata.date)
+        self.metadata.set_index('key', drop=False, inplace=True)
+
+        self.offsets = np.load(os.path.join(folder, 'offsets.npy'), mmap_mode='r')
+        self.chunks = np.load(os.path.join(folder, 'chunks.npy'))
+        self._chunk = (None, None)
+
+    def __len__(self):
+        return len(self.metadata)
+
+    def __contains__(self, key):
+        return key in self.metadata.index
+
+    def __getitem__(self, key):
+        return self._transcript(self.metadata.loc[key])
+
+    def keys(self):
+        return list(self.metadata.index)
+
+    def select(self, tickers=None, start=None, end=None):
+
+        """ Metadata of the transcripts of some tickers and/or within a date range (inclusive) """
+
+        selected = self.metadata
+        if tickers is not None:
+            selected = selected[selected.ticker.isin(tickers) |
+                                selected.ticker.map(lambda ticker: ticker.split(':')[-1]).isin(tickers)]
+        if start is not None:
+            selected = selected[selected.date >= pd.to_datetime(start)]
+        if end is not None:
+            selected = selected[selected.date <= pd.to_datetime(end)]
+        return selected
+
+    def iteritems(self, keys=None):
+
+        """ Streams (key, Transcript) in store order, decompressing every chunk only once """
+
+        rows = self.metadata if keys is None else self.metadata.loc[list(keys)].sort_values(by=['chunk', 'paragraph'])
+        for _, row in rows.iterrows():
+            yield int(row.key), self._transcript(row)
+
+    def itervalues(self, keys=None):
+        for _, transcript in self.iteritems(keys):
+            yield transcript
+
+    def headers(self):
+
+        """ {key: Transcript} without the text (prepared and QandA are None), straight from the metadata """
+
+        return {int(row.key): self._transcript(row, text=False) for _, row in self.metadata.iterrows()}
+
+    def paragraphs(self, chunk, first, last):
+
+        """ Text of the paragraphs [first, last) of a chunk """
+
+        if self._chunk[0] != chunk:
+            with open(os.path.join(self.folder, 'chunk{}.z'.format(chunk)), 'rb') as f:
+                self._chunk = (chunk, zlib.decompress(f.read()))
+
+        text = self._chunk[1]
+        base = self.chunks[chunk]
+        return [text[self.offsets[i] - base:self.offsets[i + 1] - base].decode('utf-8') for i in xrange(first, last)]
+
+    def paragraph(self, key, i):
+
+        """ Text of the i-th paragraph of a transcript (prepared remarks first, then the Q&A), reading only its chunk """
+
+        row = self.metadata.loc[key]
+        first = int(row.paragraph) + i
+        return self.paragraphs(int(row.chunk), first, first + 1)[0]
+
+    def digests(self):
+
+        """ {key: digest} of every transcript, to find the ones that changed without reading the text """
+
+        if 'digest' not in self.metadata.columns:
+            return {key: transcript_digest(transcript, text_digest(transcript.prepared, transcript.QandA))
+                    for key, transcript in self.iteritems()}
+        return dict(zip(self.metadata.key.astype(int), self.metadata.digest))
+
+    def _transcript(self, row, text=True):
+
+        returns = [None if pd.isnull(row[column]) else row[column] for column in RETURNS]
+        prepared = QandA = None
+
+        if text:
+            first = int(row.paragraph)
+            middle = first + int(row.n_prepared)
+            paragraphs = self.paragraphs(int(row.chunk), first, middle + int(row.n_qanda))
+            prepared = pd.Series(paragraphs[:middle - first], name='text', index=range(3, middle - first + 3))
+            QandA = pd.Series(paragraphs[middle - first:], name='text',
+                              index=range(middle - first + 3, len(paragraphs) + 3))
+
+        return Transcript(row.company, row.ticker, row.date, *(returns + [prepared, QandA]))
+
+
+METADATA = ['key', 'company', 'ticker', 'date'] + RETURNS + ['chunk', 'paragraph', 'n_prepared', 'n_qanda',
+                                                                'text_digest', 'digest']
+
+
+def text_digest(prepared, QandA):
+
+    """ SHA-1 of the prepared and Q&A paragraphs of a transcript """
+
+    h = hashlib.sha1()
+    h.update('{} {}\0'.format(len(prepared), len(QandA)))
+    for paragraph in list(prepared) + list(QandA):
+        h.update(unicode(paragraph).encode('utf-8'))
+        h.update('\0')
+    return h.hexdigest()
+
+
+def transcript_digest(row, text):
+
+    """ SHA-1 of the metadata and returns of a transcript (a Transcript or a metadata row) and its text_digest """
+
+    values = [row.company, row.ticker, str(pd.Timestamp(row.date))]
+    values += [None if pd.isnull(getattr(row, column)) else float(getattr(row, column)) for column in RETURNS]
+    return hashlib.sha1(json.dumps(values + [text])).hexdigest()
+
+
+def write_metadata(metadata, folder='../data/transcripts', name='metadata.csv'):
+
+    """
+
+    Writes a metadata table (rows of METADATA) into a store, e.g. with new returns or keys. The rows keep
+    pointing at the paragraphs in the chunks of the store, only the digests are computed again.
+
+    """
+
+    metadata = metadata.reset_index(drop=True)
+    metadata['digest'] = [transcript_digest(row, row.text_digest) for row in metadata.itertuples(index=False)]
+
+    # Written to a temporary file first, so readers never see a half written table
+    path = os.path.join(folder, name)
+    metadata[METADATA].to_csv(path + '.tmp', index=False, encoding='utf-8', float_format='%r')
+    os.rename(path + '.tmp', path)
+    return path
+
+
+def carry_metadata(table, metadata):
+
+    """
+
+    Points the rows of a metadata table of a store that is being rewritten at the paragraphs of the new
+    store (metadata: the rows of the new store). Rows are matched by key and text digest, so the rows of
+    transcripts whose text changed or that are gone are dropped.
+
+    """
+
+    pointers = metadata[['key', 'text_digest', 'chunk', 'paragraph', 'n_prepared', 'n_qanda']]
+    return table.drop(['chunk', 'paragraph', 'n_prepared', 'n_qanda'], axis=1).merge(pointers,
+                                                                                     on=['key', 'text_digest'])
+
+
+def write_store(transcripts, folder='../data/transcripts', chunk_size=256, metadata='metadata.csv', keep=()):
+
+    """
+
+    Writes {key: Transcript} (or any iterable of (key, Transcript)) as a TranscriptStore. The store is
+    written next to folder and swapped in at the end, so readers never see a half written store.
+    The metadata tables in keep (e.g. the one with the returns, written by another step) are carried
+    over from the store that is replaced, see carry_metadata.
+
+    """
+
+    items = transcripts.iteritems() if hasattr(transcripts, 'iteritems') else transcripts
+    tmp = folder.rstrip('/') + '.tmp'
+    if os.path.isdir(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+
+    rows = []
+    offsets = [0]
+    chunks = [0]
+    pieces = []
+
+    def flush():
+        with open(os.path.join(tmp, 'chunk{}.z'.format(len(chunks) - 1)), 'wb') as f:
+            f.write(zlib.compress(''.join(pieces), 6))
+        chunks.append(offsets[-1])
+        del pieces[:]
+
+    in_chunk = 0
+    for key, transcript in items:
+
+        row = {'key': key,
+               'company': transcript.company,
+               'ticker': transcript.ticker,
+               'date': transcript.date,
+               'chunk': len(chunks) - 1,
+               'paragraph': len(offsets) - 1,
+               'n_prepared': len(transcript.prepared),
+               'n_qanda': len(transcript.QandA),
+               'text_digest': text_digest(transcript.prepared, transcript.QandA)}
+        row.update((column, getattr(transcript, column)) for column in RETURNS)
+        rows.append(row)
+
+        for paragraph in list(transcript.prepared) + list(transcript.QandA):
+            data = unicode(paragraph).encode('utf-8')
+            pieces.append(data)
+            offsets.append(offsets[-1] + len(data))
+
+        in_chunk += 1
+        if in_chunk == chunk_size:
+            flush()
+            in_chunk = 0
+
+    if in_chunk or not rows:
+        flush()
+
+    np.save(os.path.join(tmp, 'offsets.npy'), np.array(offsets, dtype=np.int64))
+    # The last entry is the end of the text, not the start of a chunk
+    np.save(os.path.join(tmp, 'chunks.npy'), np.array(chunks[:-1], dtype=np.int64))
+
+    rows = pd.DataFrame(rows, columns=METADATA)
+    write_metadata(rows, tmp, metadata)
+
+    for name in keep:
+        path = os.path.join(folder, name)
+        if name != metadata and os.path.isfile(path):
+            table = pd.read_csv(path, encoding='utf-8', float_precision='round_trip')
+            write_metadata(carry_metadata(table, rows), tmp, name)
+
+    # The old store is moved out of the way before it is deleted, so folder is only missing between two renames
+    old = folder.rstrip('/') + '.old'
+    if os.path.isdir(old):
+        shutil.rmtree(old)
+    if os.path.isdir(folder):
+        os.rename(folder, old)
+    os.rename(tmp, folder)
+    if os.path.isdir(old):
+        shutil.rmtree(old)
+    return folder
+
+
+def load_pickle(filepath='../data/transcripts.p.gz'):
+
+    """ Loads a pickle written by the old pipeline, whichever module the namedtuple was defined in """
+
+    def find_global(module, name):
+        if name == 'Transcript':
+            return Transcript
+        return getattr(__import__(module, fromlist=[name]), name)
+
+    with (gzip.open if filepath.endswith('.gz') else open)(filepath, 'rb') as f:
+        unpickler = pickle.Unpickler(f)
+        unpickler.find_global = find_global
+        return unpickler.load()
+
+
+def convert(filepath='../data/transcripts.p.gz', folder='../data/transcripts'):
+    print 'Converting {} to {}'.format(filepath, folder)
+    return write_store(load_pickle(filepath), folder)
+
+
+if __name__ == '__main__':
+    convert()
@@ -0,0 +1,204 @@
+import csv
+import numpy as np
+import pandas as pd
+
+from doc_table import RETURNS, openDocTable
+from index_format import Manifest
+
+
+# Abnormal return tiers of visualize_transcripts.ipynb: High >= 0.10 > Mid >= -0.10 > Low
+TIERS = ['Low', 'Mid', 'High']
+TIER_THRESHOLD = 0.10
+
+# Date buckets: pandas period frequencies
+FREQUENCIES = {'day': 'D', 'week': 'W', 'month': 'M', 'quarter': 'Q'}
+
+# datetime.toordinal() of 1970-01-01, to turn the ordinals of the doc table into datetime64[D]
+EPOCH_ORDINAL = 719163
+
+
+def loadSectors(path='../data/sectors.csv'):
+
+    """ Reads {symbol: sector} from a CSV file with the columns ticker and sector (with or without exchange) """
+
+    sectors = dict()
+    with open(path, 'rb') as f:
+        for row in csv.DictReader(f):
+            sectors[row['ticker'].split(':')[-1]] = row['sector']
+    return sectors
+
+
+class Aggregator(object):
+
+    """
+
+    Buckets the per-document counts of a search (ShardExecutor.search(ngrams, by='doc')) into
+    arrays ready to plot, by any combination of these dimensions:
+
+        'day', 'week', 'month', 'quarter'   date of the call (empty periods in between are included)
+        'ticker', 'sector'                  company (sectors from a {symbol: sector} dict, see loadSectors)
+        'tier'                              High / Mid / Low abnormal return over horizon (documents
+                                            without a return are left out)
+
+    The bucket of every document and the number of documents and tokens in every bucket are computed
+    once per grouping from the columns of the DocTable, so a query only costs one bincount per ngram.
+    Removed documents (tombstones) are not counted.
+
+    """
+
+    def __init__(self, docs, deleted=frozenset(), sectors=None):
+
+        n = len(docs)
+        self.live = np.ones(n, dtype=bool)
+        self.live[[id for id in deleted if id < n]] = False
+
+        self.days = (np.array(docs.dates, dtype=np.int64) - EPOCH_ORDINAL).astype('datetime64[D]')
+        self.symbols = np.array([ticker.split(':')[-1] for ticker in docs.tickers], dtype=object)
+        self.returns = {column: np.array(docs.returns[column], dtype=np.float64) for column in RETURNS}
+        self.tokens = np.array(docs.tokens, dtype=np.float64)
+        self.sectors = sectors or dict()
+
+        self._groups = dict()
+
+    def __len__(self):
+        return len(self.live)
+
+    def dimension(self, name, horizon='return_3days', threshold=TIER_THRESHOLD):
+
+        """ (labels, codes) of one dimension: the bucket labels, and the bucket of every document (-1 for none) """
+
+        if name in FREQUENCIES:
+            periods = pd.PeriodIndex(pd.DatetimeIndex(self.days.astype('datetime64[ns]')), freq=FREQUENCIES[name])
+            if not len(periods):
+                return pd.PeriodIndex([], freq=FREQUENCIES[name]), np.zeros(0, dtype=np.int64)
+            labels = pd.period_range(periods.min(), periods.max(), freq=FREQUENCIES[name])
+            return labels, (periods.asi8 - labels[0].ordinal).astype(np.int64)
+
+        if name == 'tier':
+            returns = self.returns[horizon]
+            with np.errstate(invalid='ignore'):
+                codes = (returns >= -threshold).astype(np.int64) + (returns >= threshold)
+            codes[np.isnan(returns)] = -1
+            return pd.Index(TIERS, name='tier'), codes
+
+        if name == 'ticker':
+            values = self.symbols
+        elif name == 'sector':
+            values = np.array([self.sectors.get(symbol, 'Unknown') for symbol in self.symbols], dtype=object)
+        else:
+            raise ValueError('Invalid dimension: {}'.format(name))
+
+        codes, labels = pd.factorize(values, sort=True)
+        return pd.Index(labels, name=name), codes.astype(np.int64)
+
+    def groups(self, by='month', horizon='return_3days', threshold=TIER_THRESHOLD):
+
+        """
+
+        (labels, codes, totals) of a grouping (a dimension or a list of them): the labels of the buckets (a
+        MultiIndex for several dimensions), the bucket of every document (-1 if it is not in any) and a
+        DataFrame with the number of documents and tokens of every bucket. Cached per grouping.
+
+        """
+
+        by = (by,) if isinstance(by, basestring) else tuple(by)
+        cache_key = (by, horizon if 'tier' in by else None, threshold if 'tier' in by else None)
+
+        if cache_key not in self._groups:
+
+            labels, codes = self.dimension(by[0], horizon, threshold)
+            codes = np.where(self.live, codes, -1)
+
+            for name in by[1:]:
+                more_labels, more_codes = self.dimension(name, horizon, threshold)
+                codes = np.where((codes >= 0) & (more_codes >= 0), codes * len(more_labels) + more_codes, -1)
+                labels = pd.MultiIndex.from_product([labels, more_labels])
+
+            if len(by) == 1 and by[0] in FREQUENCIES:
+                labels = labels.rename('date')
+            elif len(by) > 1:
+                labels = labels.set_names([name if name not in FREQUENCIES else 'date' for name in by])
+
+            valid = codes >= 0
+            totals = pd.DataFrame({'docs': np.bincount(codes[valid], minlength=len(labels)),
+                                   'tokens': np.bincount(codes[valid], weights=self.tokens[valid],
+                                                         minlength=len(labels))},
+                                  index=labels, columns=['docs', 'tokens'])
+
+            self._groups[cache_key] = (labels, codes, totals)
+
+        return self._groups[cache_key]
+
+    def aggregate(self, counts, by='month', normalize=None, measure='count', horizon='return_3days',
+                  threshold=TIER_THRESHOLD):
+
+        """
+
+        Buckets {ngram: {doc id: count}} into a DataFrame with one row per bucket and one column per ngram.
+
+        measure: 'count' sums the occurrences, 'docs' counts the documents with at least one
+        normalize: None, 'docs' (divided by the number of documents in the bucket, e.g. the share of
+                   the calls that mention the ngram with measure='docs') or 'tokens' (occurrences per
+                   token of the bucket). Empty buckets are NaN when normalized.
+
+        """
+
+        labels, codes, totals = self.groups(by, horizon, threshold)
+
+        columns = dict()
+        for ngram, doc_counts in counts.iteritems():
+
+            ids = np.fromiter(doc_counts.iterkeys(), dtype=np.int64, count=len(doc_counts))
+            values = np.fromiter(doc_counts.itervalues(), dtype=np.float64, count=len(doc_counts))
+
+            buckets = codes[ids] if len(ids) else ids
+            keep = (buckets >= 0) & (values > 0)
+            weights = values[keep] if measure == 'count' else None
+            columns[ngram] = np.bincount(buckets[keep], weights=weights, minlength=len(labels)).astype(np.float64)
+
+        result = pd.DataFrame(columns, index=labels, columns=sorted(counts))
+
+        if normalize is not None:
+            if normalize not in totals.columns:
+                raise ValueError('Invalid normalization: {}'.format(normalize))
+            result = result.div(totals[normalize].replace(0, np.nan), axis=0)
+
+        return result
+
+
+def openAggregator(folder='index', sectors=None):
+
+    """ Aggregator over the doc table of the index in folder, leaving out its tombstones """
+
+    manifest = Manifest.load(folder)
+    deleted = frozenset(manifest.tombstones) if manifest is not None else frozenset()
+    return Aggregator(openDocTable(folder), deleted, sectors)
+
+
+def aggregateSearch(ngrams, folder='index', by='month', normalize='docs', measure='count', executor=None,
+                    aggregator=None, field=None, **options):
+
+    """
+
+    Searches the index and returns the aggregated counts (see Aggregator.aggregate), e.g. the share of
+    the calls per quarter that mention each ngram:
+
+        aggregateSearch('profit margin, unexpected loss', by='quarter', measure='docs')
+
+    Pass an open ShardExecutor and Aggregator to run several queries without reopening the index, and
+    field ('prepared' or 'qanda') to only count one section of the calls.
+
+    """
+
+    from search import ShardExecutor
+
+    own = executor is None
+    executor = executor or ShardExecutor(folder)
+    try:
+        counts = executor.search(ngrams, by='doc', field=field)
+    finally:
+        if own:
+            executor.close()
+
+    aggregator = aggregator or openAggregator(folder)
+    return aggregator.aggregate(counts or dict(), by, normalize, measure, **options)
@@ -0,0 +1,107 @@
+import re
+import os
+import cPickle as pickle
+from collections import OrderedDict
+from nltk.stem import PorterStemmer
+
+
+# Same pattern as nltk's wordpunct_tokenize: runs of word characters or of punctuation
+TOKEN_PATTERN = re.compile(r'\w+|[^\w\s]+', re.UNICODE | re.MULTILINE | re.DOTALL)
+
+# Positions left empty between two paragraphs, so phrases never match across a paragraph boundary
+PARAGRAPH_GAP = 1
+
+# Sections of a transcript that can be searched on their own: the prepared remarks come first,
+# the Q&A starts at the position stored in the DocTable (see DocTable.field)
+FIELDS = ['prepared', 'qanda']
+
+
+class StemCache(object):
+
+    """
+
+    Bounded LRU cache in front of PorterStemmer. The vocabulary is tiny compared to the token
+    stream, so almost every token is a hit. Can be saved to and loaded from disk to start warm.
+
+    """
+
+    def __init__(self, maxsize=500000, path=None):
+
+        self.maxsize = maxsize
+        self.stemmer = PorterStemmer()
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+
+        if path is not None and os.path.isfile(path):
+            self.load(path)
+
+    def __len__(self):
+        return len(self._cache)
+
+    def stem(self, token):
+
+        try:
+            stem = self._cache.pop(token)
+            self.hits += 1
+        except KeyError:
+            stem = self.stemmer.stem(token)
+            self.misses += 1
+            if len(self._cache) >= self.maxsize:
+                self._cache.popitem(last=False)
+
+        # (Re)insert as the most recently used entry
+        self._cache[token] = stem
+        return stem
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            pickle.dump(dict(self._cache), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def load(self, path):
+        with open(path, 'rb') as f:
+            for token, stem in pickle.load(f).iteritems():
+                if len(self._cache) < self.maxsize:
+                    self._cache[token] = stem
+
+
+class Analyzer(object):
+
+    """
+
+    Turns text into index terms: lowercase, tokenize (wordpunct_tokenize compatible), stem.
+    Used by both build_index and search, so index-time and query-time terms are identical.
+
+    """
+
+    def __init__(self, cache=None):
+        self.cache = cache or StemCache()
+
+    def tokens(self, text):
+        return TOKEN_PATTERN.findall(text.lower())
+
+    def terms(self, text):
+        stem = self.cache.stem
+        return [stem(token) for token in TOKEN_PATTERN.findall(text.lower())]
+
+    def analyzeSeries(self, series):
+
+        """ Analyzes a whole Series (or list) of paragraphs, returning a list of terms per paragraph """
+
+        stem = self.cache.stem
+        findall = TOKEN_PATTERN.findall
+        return [[stem(token) for token in findall(paragraph)] for paragraph in series.str.lower()] \
+            if hasattr(series, 'str') else [self.terms(paragraph) for paragraph in series]
+
+
+_analyzer = None
+
+
+def defaultAnalyzer():
+
+    """ The analyzer shared by everything in this process (one stem cache per process) """
+
+    global _analyzer
+    if _analyzer is None:
+        _analyzer = Analyzer()
+    return _analyzer
@@ -0,0 +1,138 @@
+import time
+from multiprocessing import cpu_count
+
+from nltk.stem import PorterStemmer
+from nltk.tokenize import wordpunct_tokenize
+
+from analysis import Analyzer
+from search import ShardExecutor
+from build_index import loadTranscripts
+from doc_table import openDocTable
+from index_format import Manifest, findShards, openIndex
+from ranking import collectionStats, queryWeights, topK, exhaustive, mergeTop
+
+
+QUERIES = ['profit margin, unexpected loss',
+           'supply chain, headwinds',
+           'guidance, share repurchase program']
+
+RANKED_QUERIES = ['supply chain disruption',
+                  'raised full year guidance',
+                  'share repurchase program dividend']
+
+
+def benchmarkWorkers(folder='index', queries=QUERIES, workers=None):
+
+    """
+
+    Times the shard-parallel search for an increasing number of workers. Each executor is
+    warmed up first (the workers open their shards), so the timings are for repeat queries.
+
+    """
+
+    paths = findShards(folder)
+    workers = workers or range(1, min(cpu_count(), len(paths)) + 1)
+    print '{} shards, {} cores'.format(len(paths), cpu_count())
+    print '{:>8} {:>10} {:>8}'.format('workers', 'seconds', 'speedup')
+
+    baseline = None
+    for n in workers:
+
+        # Without the query cache, which would answer the repeat queries
+        executor = ShardExecutor(folder, workers=n, preload=True, cache_size=0)
+        executor.search(queries[0])
+
+        start = time.time()
+        for ngrams in queries:
+            executor.search(ngrams)
+        elapsed = (time.time() - start) / len(queries)
+        executor.close()
+
+        baseline = baseline or elapsed
+        print '{:>8} {:>10.3f} {:>7.2f}x'.format(n, elapsed, baseline / elapsed)
+
+
+def benchmarkAnalysis(texts=None, limit=200):
+
+    """
+
+    Tokens/sec of the analysis of transcripts: the old per-token wordpunct_tokenize + PorterStemmer
+    path against the shared Analyzer (compiled regex tokenizer + LRU stem cache, cold and warm).
+
+    """
+
+    if texts is None:
+        transcripts = loadTranscripts()
+        texts = [transcript.prepared.append(transcript.QandA)
+                 for _, transcript in zip(xrange(limit), transcripts.itervalues())]
+
+    def old(text):
+        stemmer = PorterStemmer()
+        return [[stemmer.stem(token) for token in wordpunct_tokenize(row.lower())] for row in text]
+
+    analyzer = Analyzer()
+    runs = [('wordpunct_tokenize + PorterStemmer', old),
+            ('Analyzer (cold cache)', analyzer.analyzeSeries),
+            ('Analyzer (warm cache)', analyzer.analyzeSeries)]
+
+    print '{:<36} {:>10} {:>14}'.format('', 'seconds', 'tokens/sec')
+    for name, analyze in runs:
+        start = time.time()
+        tokens = sum(len(terms) for text in texts for terms in analyze(text))
+        elapsed = time.time() - start
+        print '{:<36} {:>10.2f} {:>14,.0f}'.format(name, elapsed, tokens / elapsed)
+
+    print 'Stem cache: {} entries, {} hits, {} misses'.format(len(analyzer.cache),
+                                                              analyzer.cache.hits,
+                                                              analyzer.cache.misses)
+
+
+def benchmarkRanking(folder='index', queries=RANKED_QUERIES, k=20, repeat=5):
+
+    """
+
+    Latency of top k BM25 queries with MaxScore pruning (ranking.topK) against scoring every document
+    that holds a query term (ranking.exhaustive), in one process over all of the shards, and the number
+    of documents each of them scores. Also checks that both return the same scores.
+
+    """
+
+    docs = openDocTable(folder)
+    manifest = Manifest.load(folder)
+    deleted = frozenset(manifest.tombstones) if manifest is not None else frozenset()
+    shards = [openIndex(path, docs) for path in findShards(folder)]
+    n, _ = collectionStats(docs, deleted)
+
+    print '{} shards, {} documents, top {}'.format(len(shards), n, k)
+    print '{:<36} {:>12} {:>12} {:>10} {:>10} {:>8}'.format('query', 'exhaustive', 'maxscore', 'scored', 'scored',
+                                                            'speedup')
+
+    for query in queries:
+
+        weights = queryWeights(query, shards, n)
+        timings = []
+        results = []
+        counts = []
+
+        for rank in [exhaustive, topK]:
+            counters = dict()
+            start = time.time()
+            for _ in xrange(repeat):
+                result = mergeTop([rank(weights, shard, docs, k, deleted, counters=counters)
+                                   for shard in shards], k)
+            timings.append((time.time() - start) / repeat)
+            results.append(result)
+            counts.append(counters.get('scored', 0) / repeat)
+
+        assert all(abs(a[0] - b[0]) < 1e-9 for a, b in zip(*results)) and len(results[0]) == len(results[1]), \
+            'MaxScore and exhaustive scoring disagree for {}'.format(query)
+
+        print '{:<36} {:>10.1f}ms {:>10.1f}ms {:>10} {:>10} {:>7.2f}x'.format(query, 1000 * timings[0],
+                                                                         1000 * timings[1], counts[0], counts[1],
+                                                                         timings[0] / timings[1])
+
+
+if __name__ == '__main__':
+    benchmarkWorkers()
+    benchmarkAnalysis()
+    benchmarkRanking()
@@ -0,0 +1,243 @@
+import struct
+import numpy as np
+from array import array
+
+
+# Containers with more documents than this are bitmaps (8 KB), smaller ones sorted uint16 arrays
+ARRAY_MAX = 4096
+WORDS = 1024
+
+COUNT = struct.Struct('<I')
+ENTRY = np.dtype([('key', '<u2'), ('kind', '<u2'), ('count', '<u4')])
+
+POPCOUNT = np.array([bin(i).count('1') for i in xrange(256)], dtype=np.uint16)
+ONE = np.uint64(1)
+
+
+def popcount(words):
+    return int(POPCOUNT[words.view(np.uint8)].sum())
+
+
+def setBits(words, lows):
+    np.bitwise_or.at(words, lows >> 6, np.left_shift(ONE, (lows & 63).astype(np.uint64)))
+    return words
+
+
+def testBits(words, lows):
+    return (np.right_shift(words[lows >> 6], (lows & 63).astype(np.uint64)) & ONE).astype(bool)
+
+
+def bitsToArray(words):
+    # Bytes of the little endian words, bits of every byte from the lowest up
+    bits = np.unpackbits(words.view(np.uint8)).reshape(-1, 8)[:, ::-1].ravel()
+    return np.flatnonzero(bits).astype(np.uint16)
+
+
+def container(values, count=None):
+
+    """ (container, cardinality) in the smallest form, None if empty """
+
+    if values.dtype == np.uint64:
+        count = popcount(values) if count is None else count
+        if count <= ARRAY_MAX:
+            values = bitsToArray(values)
+    else:
+        count = len(values)
+        if count > ARRAY_MAX:
+            values = setBits(np.zeros(WORDS, dtype=np.uint64), values)
+    return (values, count) if count else None
+
+
+def isBitmap(values):
+    return values.dtype == np.uint64
+
+
+def andContainers(a, b):
+    if isBitmap(a) and isBitmap(b):
+        return container(a & b)
+    if isBitmap(a):
+        a, b = b, a
+    if isBitmap(b):
+        return container(a[testBits(b, a)])
+    return container(np.intersect1d(a, b, assume_unique=True))
+
+
+def orContainers(a, b):
+    if isBitmap(a) and isBitmap(b):
+        return container(a | b)
+    if isBitmap(a):
+        a, b = b, a
+    if isBitmap(b):
+        return container(setBits(b.copy(), a))
+    return container(np.union1d(a, b).astype(np.uint16))
+
+
+def subContainers(a, b):
+    if isBitmap(a) and isBitmap(b):
+        return container(a & ~b)
+    if isBitmap(b):
+        return container(a[~testBits(b, a)])
+    if isBitmap(a):
+        words = a.copy()
+        np.bitwise_and.at(words, b >> 6, ~np.left_shift(ONE, (b & 63).astype(np.uint64)))
+        return container(words)
+    return container(np.setdiff1d(a, b, assume_unique=True).astype(np.uint16))
+
+
+class DocBitmap(object):
+
+    """
+
+    Compressed set of doc ids (roaring-style). The ids are split by their upper 16 bits into
+    containers of up to 65536 ids: a sorted uint16 array while a container holds at most ARRAY_MAX
+    ids, otherwise a bitmap of 1024 64-bit words. &, | and - (and not) work container by container,
+    on whole words for two bitmaps, and the cardinality of every container is kept, so len() is free.
+
+    Binary shards store the bitmap of every term with at least BITMAP_MIN_DF documents (see
+    index_format.py), so the documents of a query can be found from its terms without decoding
+    any postings.
+
+    """
+
+    __slots__ = ('keys', 'containers', 'counts')
+
+    def __init__(self, keys=(), containers=(), counts=()):
+        self.keys = list(keys)
+        self.containers = list(containers)
+        self.counts = list(counts)
+
+    @classmethod
+    def fromArray(cls, ids):
+
+        """ Bitmap of a sorted sequence of doc ids (e.g. the docs of Postings) """
+
+        if isinstance(ids, array):
+            ids = np.frombuffer(ids, dtype=np.uint32) if len(ids) else np.zeros(0, dtype=np.uint32)
+        ids = np.asarray(ids, dtype=np.uint32)
+
+        bitmap = cls()
+        highs = ids >> 16
+        keys, starts = np.unique(highs, return_index=True)
+        ends = list(starts[1:]) + [len(ids)]
+        for key, start, end in zip(keys, starts, ends):
+            bitmap._append(int(key), container((ids[start:end] & 0xFFFF).astype(np.uint16)))
+        return bitmap
+
+    def toArray(self):
+
+        """ Sorted doc ids as a numpy int64 array """
+
+        parts = [(np.int64(key) << 16) + (bitsToArray(values) if isBitmap(values) else values)
+                 for key, values in zip(self.keys, self.containers)]
+        return np.concatenate(parts).astype(np.int64) if parts else np.zeros(0, dtype=np.int64)
+
+    def __len__(self):
+        return sum(self.counts)
+
+    def __nonzero__(self):
+        return bool(self.keys)
+
+    def __contains__(self, doc):
+
+        try:
+            values = self.containers[self.keys.index(doc >> 16)]
+        except ValueError:
+            return False
+
+        low = np.uint16(doc & 0xFFFF)
+        if isBitmap(values):
+            return bool(testBits(values, np.array([low]))[0])
+        i = np.searchsorted(values, low)
+        return i < len(values) and values[i] == low
+
+    def __and__(self, other):
+        result = DocBitmap()
+        others = dict(zip(other.keys, other.containers))
+        for key, values in zip(self.keys, self.containers):
+            if key in others:
+                result._append(key, andContainers(values, others[key]))
+        return result
+
+    def __or__(self, other):
+        result = DocBitmap()
+        mine = dict(zip(self.keys, self.containers))
+        others = dict(zip(other.keys, other.containers))
+        for key in sorted(set(mine) | set(others)):
+            if key in mine and key in others:
+                result._append(key, orContainers(mine[key], others[key]))
+            else:
+                values = mine.get(key, others.get(key))
+                result._append(key, (values, self._count(key) if key in mine else other._count(key)))
+        return result
+
+    def __sub__(self, other):
+        result = DocBitmap()
+        others = dict(zip(other.keys, other.containers))
+        for key, values, count in zip(self.keys, self.containers, self.counts):
+            result._append(key, subContainers(values, others[key]) if key in others else (values, count))
+        return result
+
+    def serialize(self):
+
+        """ Number of containers, (key, kind, count) of every container, then the containers """
+
+        entries = np.zeros(len(self.keys), dtype=ENTRY)
+        entries['key'] = self.keys
+        entries['kind'] = [int(isBitmap(values)) for values in self.containers]
+        entries['count'] = self.counts
+        return COUNT.pack(len(self.keys)) + entries.tostring() + \
+            ''.join(values.astype(values.dtype.newbyteorder('<')).tostring() for values in self.containers)
+
+    @classmethod
+    def deserialize(cls, buf, offset=0):
+
+        """
+
+        Reads a serialized bitmap from buf. The containers are copied out of buf, so the bitmap can outlive
+        it (e.g. a cached result of a memory mapped shard that was closed since).
+
+        """
+
+        n, = COUNT.unpack_from(buf, offset)
+        offset += COUNT.size
+        entries = np.frombuffer(buf, dtype=ENTRY, count=n, offset=offset)
+        offset += n * ENTRY.itemsize
+
+        bitmap = cls()
+        for key, kind, count in entries.tolist():
+            if kind:
+                values = np.frombuffer(buf, dtype='<u8', count=WORDS, offset=offset).copy()
+            else:
+                values = np.frombuffer(buf, dtype='<u2', count=count, offset=offset).copy()
+            offset += values.nbytes
+            bitmap._append(key, (values, count))
+        return bitmap
+
+    def _count(self, key):
+        return self.counts[self.keys.index(key)]
+
+    def _append(self, key, found):
+        if found is not None:
+            self.keys.append(key)
+            self.containers.append(found[0])
+            self.counts.append(found[1])
+
+
+def deletedBitmap(docs, deleted):
+
+    """ DocBitmap of the tombstones, cached on the DocTable """
+
+    key = ('deleted bitmap', deleted)
+    if key not in docs.cache:
+        docs.cache[key] = DocBitmap.fromArray(sorted(deleted))
+    return docs.cache[key]
+
+
+def unsectionedBitmap(docs):
+
+    """ DocBitmap of the documents indexed without the start of their Q&A (see DocTable.qanda), cached on the DocTable """
+
+    key = 'unsectioned bitmap'
+    if key not in docs.cache:
+        docs.cache[key] = DocBitmap.fromArray(np.flatnonzero(np.array(docs.qanda, dtype=np.int64) < 0))
+    return docs.cache[key]
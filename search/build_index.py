@@ -2,22 +2,23 @@ __author__ = 'trevorlindsay'
 
 
 import os
-import gzip
-import cPickle as pickle
-from collections import namedtuple, defaultdict
-from nltk.stem import PorterStemmer
-from nltk.tokenize import wordpunct_tokenize
+import sys
+import glob
+import time
+import heapq
+import tempfile
+from multiprocessing import Pool, cpu_count
+from collections import defaultdict, deque
 
+from postings import fromLists
+from bitmaps import DocBitmap
+from analysis import defaultAnalyzer, PARAGRAPH_GAP
+from doc_table import DocTable, ParagraphMap, DOCS_FILE, PARAGRAPHS_FILE, openDocTable, resolveId
+from index_format import ShardWriter, Manifest, lockIndex, findShards, dateRange
 
-Transcript = namedtuple('Transcript', ['company',
-                                       'ticker',
-                                       'date',
-                                       'return_3days',
-                                       'return_30days',
-                                       'return_60days',
-                                       'return_90days',
-                                       'prepared',
-                                       'QandA'])
+# The Transcript namedtuple and the transcript store are shared with the preprocessing scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'preprocessing'))
+from transcript_store import Transcript, TranscriptStore
 
 
 class InvertedIndex(defaultdict):
@@ -29,7 +30,7 @@ class InvertedIndex(defaultdict):
     def merge(self, dict2):
         for token, posting in dict2.iteritems():
             self[token].append(posting)
-            self._ids |= set(posting[0])
+            self._ids.add(posting[0])
 
     def updateIds(self):
         for posting in self.values():
@@ -39,67 +40,312 @@ class InvertedIndex(defaultdict):
     def ids(self):
         return self._ids
 
+    def docFreq(self, token):
+        postings = self.postings(token)
+        return len(postings) if postings is not None else 0
+
+    def postings(self, token):
+
+        """ Postings of token with doc ids and positions as integer arrays (None if not indexed) """
+
+        if token not in self and isinstance(token, unicode):
+            # Shards read from text files are keyed by utf-8 bytes
+            token = token.encode('utf-8')
+        if token not in self:
+            return None
+        return fromLists(self[token])
+
+    def bitmap(self, token):
+
+        """ DocBitmap of the documents of token (None if not indexed) """
+
+        return self.termBitmap(token)[0]
+
+    def termBitmap(self, token):
+
+        """ (DocBitmap, Postings) of token, (None, None) if not indexed (see Shard.termBitmap) """
+
+        postings = self.postings(token)
+        return (DocBitmap.fromArray(postings.docs), postings) if postings is not None else (None, None)
+
 
 
 def loadTranscripts():
-    with gzip.open('../data/transcripts.p.gz', 'rb') as f:
-        return pickle.load(f)
 
+    """ Opens the transcript store; the transcripts are read chunk by chunk as they are iterated """
+
+    return TranscriptStore('../data/transcripts')
+
+
+def parseTranscript(transcript, id):
+
+    """
 
-def parseTranscript(transcript):
+    Returns {token: [id, positions]} for one transcript, id being its integer id in the DocTable,
+    the position at which its Q&A starts and the position at which every paragraph starts (see
+    ParagraphMap). The prepared remarks come first and the Q&A after them, and every paragraph
+    starts PARAGRAPH_GAP positions after the end of the previous one, so a phrase can never match
+    across two paragraphs or across the two sections (see FIELDS).
+
+    """
 
     assert isinstance(transcript, Transcript), \
         "transcript must be stored in custom namedtuple, not {}".format(type(transcript))
 
-    text = transcript.prepared.append(transcript.QandA)
-    id = "{ticker}-{year}-{month}-{day}".format(ticker=transcript.ticker.split(':')[-1],
-                                                year=transcript.date.year,
-                                                month=transcript.date.month,
-                                                day=transcript.date.day)
-
-    tokenizer = wordpunct_tokenize
-    stemmer = PorterStemmer()
+    analyzer = defaultAnalyzer()
     index = dict()
     pos = 0
+    sections = []
+    paragraphs = []
 
-    for row in text:
+    for section in [transcript.prepared, transcript.QandA]:
 
-        for i, token in enumerate(tokenizer(row.lower())):
-            token = stemmer.stem(token)
-            if token not in index and '|' not in token:
-                index[token] = [id, [str(pos + i)]]
-            elif '|' not in token:
-                index[token][-1].append(str(pos + i))
+        sections.append(pos)
 
-        try:
-            pos += (i + 1)
-        except:
-            pass
+        for terms in analyzer.analyzeSeries(section):
 
-    return index
+            paragraphs.append(pos)
 
+            for i, token in enumerate(terms):
+                if token not in index and '|' not in token:
+                    index[token] = [id, [str(pos + i)]]
+                elif '|' not in token:
+                    index[token][-1].append(str(pos + i))
 
-def buildIndex(transcripts):
+            pos += len(terms) + PARAGRAPH_GAP
 
-    # Initiate InvertedIndex object (extends defaultdict)
-    index = InvertedIndex()
-    path = 'index/index.txt'
-    indices = 1
+    return index, sections[1], paragraphs
 
-    for key, transcript in transcripts.iteritems():
 
-        print "{}, {}".format(key, transcript.company.encode('utf-8'))
-        index.merge(parseTranscript(transcript))
+def countTokens(parsed):
 
-        if key % 1000 == 0:
-            filesize = writeIndexToFile(index, path)
-            if filesize >= 1e+8:
-                indices += 1
-                path = 'index/index{}.txt'.format(indices)
-                index = InvertedIndex()
+    """ Number of tokens of a transcript from the output of parseTranscript """
+
+    return sum(len(posting[1]) for posting in parsed.itervalues())
+
+
+class Progress(object):
+
+    """ Reports documents/sec and tokens/sec on a single, periodically refreshed line """
+
+    def __init__(self, total, every=2.0):
+        self.total = total
+        self.every = every
+        self.docs = 0
+        self.tokens = 0
+        self.start = self.last = time.time()
+
+    def update(self, docs, tokens):
+
+        self.docs += docs
+        self.tokens += tokens
+        now = time.time()
+
+        if now - self.last >= self.every or self.docs == self.total:
+            self.last = now
+            elapsed = max(now - self.start, 1e-6)
+            sys.stdout.write("Indexed %d/%d transcripts (%d%%), %.1f docs/s, %.0f tokens/s   \r" %
+                             (self.docs, self.total, 100 * float(self.docs) / max(self.total, 1),
+                              self.docs / elapsed, self.tokens / elapsed))
+            sys.stdout.flush()
+
+    def finish(self):
+        print
+        print 'Indexed {} transcripts ({} tokens) in {:.1f}s'.format(self.docs, self.tokens,
+                                                                     time.time() - self.start)
 
-    writeIndexToFile(index, path)
-    return index
+
+def writeRun(index, path):
+
+    """ Writes an in-memory index as a run: the text shard format with the lines sorted by token """
+
+    lines = []
+    for token, postings in index.iteritems():
+        token = token.encode('utf-8') if isinstance(token, unicode) else token
+        lines.append((token, ';'.join(['{}:{}'.format(id, ','.join(posting)) for id, posting in postings])))
+
+    lines.sort()
+    with open(path, 'wb') as f:
+        for token, postings in lines:
+            f.write(token + '||' + postings + '\n')
+
+    return os.path.getsize(path)
+
+
+def readRun(path, run=0):
+
+    """ Streams the (token, run, postings) lines of a run """
+
+    with open(path, 'rb') as f:
+        for line in f:
+            token, postings = line.rstrip('\n').split('||')
+            yield token, run, postings
+
+
+def parseBatch(args):
+
+    """
+
+    Pool task: tokenizes and stems a batch of (id, transcript) pairs into a sorted run on disk.
+    Also returns the number of tokens, the start of the Q&A and the paragraph starts of every transcript.
+
+    """
+
+    path, batch = args
+    index = InvertedIndex()
+    tokens = []
+    qanda = []
+    paragraphs = []
+
+    for id, transcript in batch:
+        parsed, start, starts = parseTranscript(transcript, id)
+        tokens.append(countTokens(parsed))
+        qanda.append(start)
+        paragraphs.append(starts)
+        index.merge(parsed)
+
+    writeRun(index, path)
+    return path, [id for id, _ in batch], tokens, qanda, paragraphs, os.path.getsize(path)
+
+
+def mergeRuns(args):
+
+    """
+
+    Pool task: k-way merges sorted runs into one binary shard. Only the postings of the current
+    token are held in memory, so the memory needed does not grow with the size of the shard.
+
+    """
+
+    paths, ids, dates, lengths, dst = args
+    writer = ShardWriter(dst, ids, dates, lengths)
+    current, postings = None, []
+
+    for token, _, line in heapq.merge(*[readRun(path, run) for run, path in enumerate(paths)]):
+        if token != current:
+            if current is not None:
+                writer.add(current, postings)
+            current, postings = token, []
+        postings.extend((int(id), locs.split(',')) for id, locs in
+                        [posting.split(':') for posting in line.split(';')])
+
+    if current is not None:
+        writer.add(current, postings)
+
+    for path in paths:
+        os.remove(path)
+
+    return dst, writer.close()
+
+
+def buildIndex(transcripts, folder='index', workers=None, batch_size=250, shard_size=1e+8):
+
+    """
+
+    Builds the index with a pool of worker processes in two passes:
+
+    1. map: batches of batch_size transcripts are tokenized and stemmed by the workers, each batch
+       into a run on disk (sorted by token). At most 2 * workers batches are in flight at a time,
+       which (with batch_size) bounds the memory used.
+    2. reduce: consecutive runs are grouped until they hold about shard_size bytes, and each group
+       is k-way merged into a binary shard (index1.bin, index2.bin, ...), also in parallel.
+
+    Documents get dense integer ids in the order of transcripts. The shards are merged next to the
+    runs and moved into folder with the DocTable, the ParagraphMap and the manifest, so a search that
+    reloads meanwhile never sees doc ids that no shard holds yet.
+
+    """
+
+    workers = workers or cpu_count()
+    runs_folder = tempfile.mkdtemp(prefix='runs', dir=folder)
+    docs = DocTable()
+    paragraphs = ParagraphMap()
+    pool = Pool(workers)
+
+    def batches():
+        batch = []
+        for key, transcript in transcripts.iteritems():
+            batch.append((docs.addTranscript(key, transcript), transcript))
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    # Map: parse the batches into runs, keeping a bounded number of batches in flight
+    progress = Progress(len(transcripts))
+    runs = []
+    pending = deque()
+
+    for i, batch in enumerate(batches()):
+        pending.append(pool.apply_async(parseBatch, [(os.path.join(runs_folder, 'run{}.txt'.format(i)), batch)]))
+        while len(pending) >= 2 * workers or (pending and pending[0].ready()):
+            path, ids, tokens, qanda, starts, size = pending.popleft().get()
+            runs.append((path, ids, size))
+            progress.update(len(ids), sum(tokens))
+            for id, count, start, paragraph_starts in zip(ids, tokens, qanda, starts):
+                docs.tokens[id] = count
+                docs.qanda[id] = start
+                paragraphs.set(id, paragraph_starts)
+
+    while pending:
+        path, ids, tokens, qanda, starts, size = pending.popleft().get()
+        runs.append((path, ids, size))
+        progress.update(len(ids), sum(tokens))
+        for id, count, start, paragraph_starts in zip(ids, tokens, qanda, starts):
+            docs.tokens[id] = count
+            docs.qanda[id] = start
+            paragraphs.set(id, paragraph_starts)
+
+    progress.finish()
+
+    # Reduce: group consecutive runs into shards and merge every group
+    groups = [[]]
+    for path, ids, size in runs:
+        if groups[-1] and sum(run[2] for run in groups[-1]) + size > shard_size:
+            groups.append([])
+        groups[-1].append((path, ids, size))
+
+    tasks = []
+    for i, group in enumerate(groups):
+        name = 'index.bin' if i == 0 else 'index{}.bin'.format(i + 1)
+        ids = [id for _, run_ids, _ in group for id in run_ids]
+        tasks.append(([path for path, _, _ in group], ids, dateRange(docs, ids),
+                      {id: docs.tokens[id] for id in ids}, os.path.join(runs_folder, name)))
+
+    start = time.time()
+    shards = []
+    for dst, size in pool.imap(mergeRuns, tasks):
+        print 'Merged {} ({:.1f} MB)'.format(os.path.basename(dst), size / 1e+6)
+        shards.append(dst)
+
+    pool.close()
+    pool.join()
+    print 'Merged {} shards in {:.1f}s'.format(len(shards), time.time() - start)
+
+    with lockIndex(folder):
+
+        # The shards, then the tables, then the manifest: each rename leaves open shards untouched
+        for i, path in enumerate(shards):
+            shards[i] = os.path.join(folder, os.path.basename(path))
+            os.rename(path, shards[i])
+        os.rmdir(runs_folder)
+        docs.save(os.path.join(folder, DOCS_FILE))
+        paragraphs.save(os.path.join(folder, PARAGRAPHS_FILE))
+
+        previous = Manifest.load(folder)
+        manifest = Manifest(folder,
+                            generation=previous.generation if previous is not None else 0,
+                            segments=[os.path.basename(path) for path in shards])
+        manifest.save()
+
+        # Remove shards and segments of a previous build that were not overwritten
+        for pattern in ['index*.txt', 'index*.bin', 'segment*.bin']:
+            for path in glob.glob(os.path.join(folder, pattern)):
+                if path not in shards:
+                    os.remove(path)
+
+    return shards
 
 
 def writeIndexToFile(index, path='index/index.txt'):
@@ -113,48 +359,58 @@ def writeIndexToFile(index, path='index/index.txt'):
     return os.path.getsize(path)
 
 
-def readIndexFromFile(path):
+def readIndexFromFile(path, docs=None):
+
+    """
+
+    Reads a text shard. Old TICKER-YYYY-M-D document ids are mapped to integer ids through docs, which
+    is never changed: ids of documents that are not in the table would get different integer ids in
+    every process that reads the shard, so such shards have to be converted first (see convertIndex).
+
+    """
 
     index = InvertedIndex()
 
     with open(path, 'rb') as f:
         for line in f:
             token, postings = line.strip().split('||')
-            postings = [[id, locs.split(',')] for id, locs in
-                        [posting.split(':') for posting in postings.split(';')]]
+            try:
+                postings = [[resolveId(id, docs, add=False), locs.split(',')] for id, locs in
+                            [posting.split(':') for posting in postings.split(';')]]
+            except KeyError as e:
+                raise ValueError('Document {} of {} is not in the doc table, convert the text shards with '
+                                 'python index_format.py first'.format(e.args[0], path))
             index[token] = postings
 
     index.updateIds()
     return index
 
 
-def updateIndex():
+def updateIndex(folder='index'):
+
+    """
+
+    Adds the transcripts that are not in the index yet as a new segment (see segments.py),
+    instead of rewriting a shard. Builds the index from scratch if there is none.
 
-    from_scratch = False
+    """
 
-    if os.path.isfile('index/index.txt'):
-        index = readIndexFromFile()
-    else:
-        from_scratch = True
+    from segments import addTranscripts
 
-    if not from_scratch:
-        for transcript in loadTranscripts():
-            id = "{ticker}-{year}-{month}-{day}".format(ticker=transcript.ticker,
-                                                        year=transcript.date.year,
-                                                        month=transcript.date.month,
-                                                        day=transcript.date.day)
-            if id not in index.ids:
-                index.merge(parseTranscript(transcript))
-    else:
-        create = input("No index exists! Would you like to build it from scratch? (y/n")
+    transcripts = loadTranscripts()
+
+    if not findShards(folder):
+        create = raw_input("No index exists! Would you like to build it from scratch? (y/n) ")
         if create.lower() == 'y':
             print "Creating index from scratch!"
-            index = buildIndex(loadTranscripts())
-        else:
-            print "The index was not updated."
-            index = None
-
-    return index
+            return buildIndex(transcripts, folder)
+        print "The index was not updated."
+        return None
+
+    # Only the text of the new transcripts is read from the store
+    indexed = set(openDocTable(folder).keys)
+    return addTranscripts(dict(transcripts.iteritems([key for key in transcripts.keys() if key not in indexed])),
+                          folder)
 
 
 if __name__ == '__main__':
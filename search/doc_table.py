@@ -0,0 +1,271 @@
+import os
+import csv
+import math
+import struct
+import numpy as np
+from array import array
+from bisect import bisect_right
+from datetime import datetime
+
+
+DOCS_FILE = 'docs.csv'
+PARAGRAPHS_FILE = 'paragraphs.bin'
+RETURNS = ['return_3days', 'return_30days', 'return_60days', 'return_90days']
+COLUMNS = ['id', 'key', 'company', 'ticker', 'date'] + RETURNS + ['tokens', 'qanda']
+
+
+def legacyId(ticker, date):
+
+    """ Document id used by the first version of the index, e.g. LXFT-2016-2-12 """
+
+    return "{ticker}-{year}-{month}-{day}".format(ticker=ticker.split(':')[-1],
+                                                  year=date.year,
+                                                  month=date.month,
+                                                  day=date.day)
+
+
+def resolveId(id, docs, add=True):
+
+    """
+
+    Integer document id of an id read from a text shard. Old TICKER-YYYY-M-D ids are looked up in
+    docs (see DocTable.idFor), so text shards with such ids can not be read without the DocTable.
+
+    """
+
+    if id.isdigit():
+        return int(id)
+    if docs is None:
+        raise ValueError('Document {} has an old TICKER-YYYY-M-D id, pass the DocTable of the index'.format(id))
+    return docs.idFor(id, add)
+
+
+def toFloat(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float('nan')
+
+
+def formatFloat(value):
+    return '' if math.isnan(value) else repr(value)
+
+
+class DocTable(object):
+
+    """
+
+    Maps the dense integer document ids used in the postings to the transcripts they index.
+    Columns are held as parallel lists/arrays, so looking up the date or the returns of a hit
+    is array indexing. Dates are stored as ordinals and converted to one shared datetime per day.
+    tokens holds the number of indexed tokens of every document (0 if unknown, e.g. in old tables).
+    qanda holds the position at which the Q&A of every document starts (-1 if unknown, for documents
+    indexed before the sections were told apart), see field().
+    cache holds values derived from the columns (e.g. filter masks, see filters.py) until a document is added.
+
+    """
+
+    def __init__(self):
+
+        self.keys = []
+        self.companies = []
+        self.tickers = []
+        self.dates = array('I')
+        self.returns = {column: array('d') for column in RETURNS}
+        self.tokens = array('I')
+        self.qanda = array('i')
+
+        self.cache = dict()
+        self._datetimes = dict()
+        self._legacy = None
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key, company, ticker, date, returns=(), tokens=0, qanda=-1):
+
+        """ Appends a document and returns its id """
+
+        self.keys.append(key)
+        self.companies.append(company)
+        self.tickers.append(ticker)
+        self.dates.append(date.toordinal())
+        returns = dict(returns)
+        for column in RETURNS:
+            self.returns[column].append(toFloat(returns.get(column)))
+        self.tokens.append(tokens)
+        self.qanda.append(qanda)
+        self.cache.clear()
+
+        id = len(self.keys) - 1
+        if self._legacy is not None:
+            self._legacy.setdefault(legacyId(ticker, date), id)
+        return id
+
+    def addTranscript(self, key, transcript):
+        return self.add(key,
+                        transcript.company,
+                        transcript.ticker,
+                        transcript.date,
+                        [(column, getattr(transcript, column, None)) for column in RETURNS])
+
+    def date(self, id):
+
+        ordinal = self.dates[id]
+        if ordinal not in self._datetimes:
+            self._datetimes[ordinal] = datetime.fromordinal(ordinal)
+        return self._datetimes[ordinal]
+
+    def field(self, id, pos):
+
+        """ The section (see analysis.FIELDS) of the position pos of a document, None if unknown """
+
+        start = self.qanda[id]
+        if start < 0:
+            return None
+        return 'prepared' if pos < start else 'qanda'
+
+    def symbol(self, id):
+        return self.tickers[id].split(':')[-1]
+
+    def exchange(self, id):
+        ticker = self.tickers[id]
+        return ticker.split(':')[0] if ':' in ticker else ''
+
+    def idFor(self, legacy_id, add=True):
+
+        """
+
+        Looks up the document of an id in the old TICKER-YYYY-M-D format. Ids that are not in the
+        table are added from the ticker and date in the string (split from the right, so tickers
+        containing hyphens like BRK-B are kept intact), or raise a KeyError if add is False.
+
+        """
+
+        if self._legacy is None:
+            # The old index merged transcripts of the same ticker and day, keep the first one
+            self._legacy = dict()
+            for id in xrange(len(self) - 1, -1, -1):
+                self._legacy[legacyId(self.tickers[id], self.date(id))] = id
+
+        if legacy_id not in self._legacy:
+            if not add:
+                raise KeyError(legacy_id)
+            ticker, year, month, day = legacy_id.rsplit('-', 3)
+            self._legacy[legacy_id] = self.add(None, '', ticker, datetime(int(year), int(month), int(day)))
+
+        return self._legacy[legacy_id]
+
+    def save(self, path):
+
+        # Written to a temporary file first, so searchers never see a partial table
+        with open(path + '.tmp', 'wb') as f:
+            w = csv.writer(f)
+            w.writerow(COLUMNS)
+            for id in xrange(len(self)):
+                company = self.companies[id]
+                w.writerow([id,
+                            self.keys[id] if self.keys[id] is not None else '',
+                            company.encode('utf-8') if isinstance(company, unicode) else company,
+                            self.tickers[id],
+                            self.date(id).strftime('%Y-%m-%d')] +
+                           [formatFloat(self.returns[column][id]) for column in RETURNS] +
+                           [self.tokens[id], self.qanda[id] if self.qanda[id] >= 0 else ''])
+        os.rename(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+
+        docs = cls()
+        with open(path, 'rb') as f:
+            for row in csv.DictReader(f):
+                id = docs.add(int(row['key']) if row['key'] else None,
+                              row['company'].decode('utf-8'),
+                              row['ticker'],
+                              datetime.strptime(row['date'], '%Y-%m-%d'),
+                              [(column, row[column]) for column in RETURNS],
+                              int(row.get('tokens') or 0),
+                              int(row.get('qanda') or -1))
+                assert id == int(row['id']), 'document ids in {} must be dense and in order'.format(path)
+        return docs
+
+
+def openDocTable(folder='index'):
+    path = os.path.join(folder, DOCS_FILE)
+    return DocTable.load(path) if os.path.isfile(path) else DocTable()
+
+
+class ParagraphMap(object):
+
+    """
+
+    The position at which every paragraph of every document starts (prepared remarks first, then the
+    Q&A, in the order of the transcript store), as written by the index builder. Maps a position of
+    a hit to its paragraph, so the text around it can be read from that paragraph alone (see
+    snippets.py). Documents indexed before the map existed are unknown (None).
+
+    File layout: MAGIC, number of documents, the number of paragraphs of every document (int32, -1
+    if unknown), then all of the start positions (uint32).
+
+    """
+
+    MAGIC = 'ECPM'
+    HEADER = struct.Struct('<4sI')
+
+    def __init__(self):
+        self.starts = []
+
+    def __len__(self):
+        return len(self.starts)
+
+    def set(self, id, starts):
+        while len(self.starts) <= id:
+            self.starts.append(None)
+        self.starts[id] = array('I', starts)
+
+    def get(self, id):
+        return self.starts[id] if id < len(self.starts) else None
+
+    def locate(self, id, pos):
+
+        """ (paragraph, offset of pos in the paragraph in tokens) of a position of a document, None if unknown """
+
+        starts = self.get(id)
+        if not starts:
+            return None
+        paragraph = bisect_right(starts, pos) - 1
+        return paragraph, pos - starts[paragraph]
+
+    def save(self, path):
+
+        counts = array('i', [len(starts) if starts is not None else -1 for starts in self.starts])
+        with open(path + '.tmp', 'wb') as f:
+            f.write(self.HEADER.pack(self.MAGIC, len(self.starts)))
+            f.write(counts.tostring())
+            for starts in self.starts:
+                if starts is not None:
+                    f.write(starts.tostring())
+        os.rename(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+
+        paragraphs = cls()
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        magic, n = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC:
+            raise ValueError('{} is not a paragraph map'.format(path))
+
+        counts = np.frombuffer(data, dtype='<i4', count=n, offset=cls.HEADER.size)
+        flat = np.frombuffer(data, dtype='<u4', offset=cls.HEADER.size + 4 * n)
+        ends = np.cumsum(np.maximum(counts, 0)).tolist()
+        for count, end in zip(counts.tolist(), ends):
+            paragraphs.starts.append(array('I', flat[end - count:end].tostring()) if count >= 0 else None)
+        return paragraphs
+
+
+def openParagraphMap(folder='index'):
+    path = os.path.join(folder, PARAGRAPHS_FILE)
+    return ParagraphMap.load(path) if os.path.isfile(path) else ParagraphMap()
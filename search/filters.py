@@ -0,0 +1,215 @@
+import numpy as np
+from datetime import datetime
+from collections import OrderedDict
+
+from doc_table import RETURNS
+from bitmaps import DocBitmap
+
+
+DATE_FORMAT = '%Y-%m-%d'
+
+# Masks and bitmaps of distinct filters kept per DocTable, least recently used dropped first
+FILTER_CACHE_SIZE = 64
+
+
+def toOrdinal(date):
+    if date is None:
+        return None
+    if isinstance(date, basestring):
+        date = datetime.strptime(date, DATE_FORMAT)
+    return date.toordinal()
+
+
+def docColumns(docs):
+
+    """ The columns of a DocTable as numpy arrays (symbols, exchanges, date ordinals and returns), cached on the table """
+
+    if 'columns' not in docs.cache:
+        columns = {'symbols': np.array([ticker.split(':')[-1] for ticker in docs.tickers], dtype=object),
+                   'exchanges': np.array([ticker.split(':')[0] if ':' in ticker else '' for ticker in docs.tickers],
+                                         dtype=object),
+                   'dates': np.array(docs.dates, dtype=np.int64)}
+        columns.update((column, np.array(docs.returns[column], dtype=np.float64)) for column in RETURNS)
+        docs.cache['columns'] = columns
+    return docs.cache['columns']
+
+
+def filterCache(docs):
+
+    """ LRU of the masks and bitmaps of filters, {key: value} with the most recently used last, cached on the DocTable """
+
+    return docs.cache.setdefault('filters', OrderedDict())
+
+
+def cached(docs, key, compute):
+
+    """ The value of key in the filterCache of docs, computed (and cached) if it is not there """
+
+    cache = filterCache(docs)
+    try:
+        value = cache.pop(key)
+    except KeyError:
+        value = compute()
+        if len(cache) >= FILTER_CACHE_SIZE:
+            cache.popitem(last=False)
+
+    # (Re)insert as the most recently used entry
+    cache[key] = value
+    return value
+
+
+class DocFilter(object):
+
+    """
+
+    Restricts a search to the documents with some attributes in the DocTable:
+
+        tickers     symbols (AAPL) or tickers (NASDAQ:AAPL)
+        exchanges   e.g. ['NASDAQ']
+        start, end  call dates (datetime or YYYY-MM-DD), inclusive
+        returns     {column: (low, high)}, inclusive bounds, None for an open end, e.g.
+                    {'return_30days': (None, -0.05)}. Documents without the return are left out.
+
+    The filter is turned into a mask over the doc ids (a boolean array) and a DocBitmap, both cached
+    on the DocTable along with those of the last FILTER_CACHE_SIZE filters. The search intersects the
+    bitmap with the documents of the terms before any positions are decoded. Shards whose date range
+    or documents do not overlap the filter are skipped entirely (see skipShard).
+
+    'guidance cut' in NASDAQ calls of 2012-2014 with a 30 day return below -5%:
+
+        DocFilter(exchanges=['NASDAQ'], start='2012-01-01', end='2014-12-31',
+                  returns={'return_30days': (None, -0.05)})
+
+    """
+
+    def __init__(self, tickers=None, exchanges=None, start=None, end=None, returns=None):
+
+        self.tickers = sorted(tickers) if tickers is not None else None
+        self.exchanges = sorted(exchanges) if exchanges is not None else None
+        self.start = toOrdinal(start)
+        self.end = toOrdinal(end)
+        self.returns = dict(returns or ())
+
+        for column in self.returns:
+            if column not in RETURNS:
+                raise ValueError('Invalid return column: {}'.format(column))
+
+    def key(self):
+        return (tuple(self.tickers or ()) if self.tickers is not None else None,
+                tuple(self.exchanges or ()) if self.exchanges is not None else None,
+                self.start, self.end, tuple(sorted(self.returns.items())))
+
+    def __repr__(self):
+        return 'DocFilter{}'.format(self.key())
+
+    def empty(self):
+
+        """ True if the filter does not restrict anything """
+
+        return self.tickers is None and self.exchanges is None and self.start is None and self.end is None \
+            and not self.returns
+
+    def mask(self, docs):
+
+        """ Boolean array over the doc ids of docs, True for the documents that pass """
+
+        return cached(docs, ('mask', self.key()), lambda: self._mask(docs))
+
+    def _mask(self, docs):
+
+        columns = docColumns(docs)
+        mask = np.ones(len(docs), dtype=bool)
+
+        if self.tickers is not None:
+            symbols = set(ticker.split(':')[-1] for ticker in self.tickers)
+            mask &= np.array([symbol in symbols for symbol in columns['symbols']], dtype=bool)
+        if self.exchanges is not None:
+            exchanges = set(self.exchanges)
+            mask &= np.array([exchange in exchanges for exchange in columns['exchanges']], dtype=bool)
+        if self.start is not None:
+            mask &= columns['dates'] >= self.start
+        if self.end is not None:
+            mask &= columns['dates'] <= self.end
+
+        for column, (low, high) in self.returns.iteritems():
+            values = columns[column]
+            with np.errstate(invalid='ignore'):
+                if low is not None:
+                    mask &= values >= low
+                if high is not None:
+                    mask &= values <= high
+            mask &= ~np.isnan(values)
+
+        return mask
+
+    def bitmap(self, docs):
+
+        """ The documents that pass as a DocBitmap, cached on the DocTable like the mask """
+
+        return cached(docs, ('bitmap', self.key()), lambda: DocBitmap.fromArray(np.flatnonzero(self.mask(docs))))
+
+    def overlaps(self, first, last):
+
+        """ True if the date range [first, last] (ordinals) can hold documents that pass """
+
+        return (self.start is None or last >= self.start) and (self.end is None or first <= self.end)
+
+    def skipShard(self, shard, docs):
+
+        """ True if no document of the shard passes: its date range is outside of the filter, or none of its ids pass """
+
+        dates = getattr(shard, 'dates', None)
+        if dates is not None and not self.overlaps(*dates):
+            return True
+
+        ids = shard.docIds() if hasattr(shard, 'docIds') else np.array(sorted(shard.ids), dtype=np.int64)
+        mask = self.mask(docs)
+        ids = ids[ids < len(mask)]
+        return not mask[ids].any()
+
+    @classmethod
+    def fromParams(cls, params):
+
+        """
+
+        Filter from query string parameters (lists of values as parsed by urlparse.parse_qs), None if
+        there are none: ticker and exchange (comma separated), start, end, and <return column>_min /
+        <return column>_max, e.g. exchange=NASDAQ&start=2012-01-01&end=2014-12-31&return_30days_max=-0.05
+
+        """
+
+        def values(name):
+            return [value for param in params.get(name, []) for value in param.split(',') if value] or None
+
+        def number(name):
+            return float(params[name][0]) if name in params else None
+
+        returns = dict()
+        for column in RETURNS:
+            bounds = (number(column + '_min'), number(column + '_max'))
+            if bounds != (None, None):
+                returns[column] = bounds
+
+        where = cls(values('ticker'), values('exchange'), params.get('start', [None])[0],
+                    params.get('end', [None])[0], returns)
+        return None if where.empty() else where
+
+    def toParams(self):
+
+        """ The inverse of fromParams """
+
+        params = dict()
+        if self.tickers is not None:
+            params['ticker'] = ','.join(self.tickers)
+        if self.exchanges is not None:
+            params['exchange'] = ','.join(self.exchanges)
+        if self.start is not None:
+            params['start'] = datetime.fromordinal(self.start).strftime(DATE_FORMAT)
+        if self.end is not None:
+            params['end'] = datetime.fromordinal(self.end).strftime(DATE_FORMAT)
+        for column, (low, high) in self.returns.iteritems():
+            if low is not None:
+                params[column + '_min'] = repr(low)
+            if high is not None:
+                params[column + '_max'] = repr(high)
+        return params
@@ -0,0 +1,630 @@
+"""
+
+Binary shard format:
+
+    header      MAGIC, version, number of docs, number of terms, the offsets of the sections below and
+                the first and last call date of the docs (ordinals, 0 if unknown)
+    docs        sorted ids (see DocTable) of the documents in the shard, delta encoded varints
+    postings    one block per term (see below), written in whatever order the terms arrive, each followed
+                by the DocBitmap of the term if it is in at least BITMAP_MIN_DF documents (see bitmaps.py)
+    dictionary  one entry per term, sorted by term: varint length + term, varint df, varint postings offset,
+                varint max term frequency, varint min length (tokens) of the docs that hold the term,
+                varint bitmap offset + 1 (0 without a bitmap)
+    table       fixed width (uint64) offsets of the dictionary entries, used to binary search the dictionary
+
+Postings block of a term, every number is a varint:
+
+    ndocs, ndocs doc number deltas, ndocs term frequencies, ndocs position block lengths (in bytes),
+    followed by one position block per doc holding the delta encoded positions
+
+Doc ids are the dense integer ids of the DocTable stored next to the shards, so they can be delta
+encoded. The doc ids and frequencies come before the positions so a search can decide which
+documents it needs before decoding any positions. The date range lets a search with a date filter
+skip a whole shard (see filters.py), and the max frequency / min length of a term bound its BM25
+score in any document (see ranking.py). The bitmaps let a search intersect (or unite, or subtract)
+the documents of common terms with bitwise operations, before any postings are decoded.
+
+Only shards of the current VERSION are read. Text shards are upgraded with convertIndex (run
+python index_format.py), binary shards of any other version have to be rebuilt.
+
+"""
+
+import os
+import json
+import mmap
+import glob
+import fcntl
+import struct
+import hashlib
+import numpy as np
+from array import array
+from contextlib import contextmanager
+
+from postings import Postings
+from bitmaps import DocBitmap
+from doc_table import DOCS_FILE, openDocTable, resolveId
+
+
+MAGIC = 'ECIX'
+VERSION = 5
+HEADER = struct.Struct('<4sIIIQQQII')
+OFFSET = struct.Struct('<Q')
+# Terms in fewer documents get their bitmap from the (short) doc ids of their postings
+BITMAP_MIN_DF = 1024
+MANIFEST_FILE = 'segments.json'
+
+
+def encodeVarint(value, out):
+
+    """ Appends value to the bytearray out as a little endian base 128 varint """
+
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def decodeVarints(buf, pos, count):
+
+    """ Decodes count varints from the bytearray buf starting at pos. Returns the values and the new position. """
+
+    values = []
+    for _ in xrange(count):
+        shift = 0
+        value = 0
+        while True:
+            byte = buf[pos]
+            pos += 1
+            value |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                break
+            shift += 7
+        values.append(value)
+    return values, pos
+
+
+def decodeVarintArray(buf, count):
+
+    """
+
+    Vectorized decodeVarints for long runs: decodes the first count varints of the uint8 array buf
+    with numpy (every byte below 0x80 ends a varint). Returns the values as an int64 array and the
+    number of bytes they take.
+
+    """
+
+    if count == 0:
+        return np.zeros(0, dtype=np.int64), 0
+
+    ends = np.flatnonzero(buf < 0x80)[:count]
+    size = int(ends[-1]) + 1
+    starts = np.empty(count, dtype=np.int64)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+
+    # Shift of every byte: 7 times its index within its varint
+    shifts = (np.arange(size, dtype=np.int64) - np.repeat(starts, ends - starts + 1)) * 7
+    return np.add.reduceat((buf[:size].astype(np.int64) & 0x7f) << shifts, starts), size
+
+
+def decodeDeltas(buf, pos, count):
+
+    """ Same as decodeVarints, but undoes the delta encoding """
+
+    values, pos = decodeVarints(buf, pos, count)
+    total = 0
+    for i, value in enumerate(values):
+        total += value
+        values[i] = total
+    return values, pos
+
+
+def dateRange(docs, ids):
+
+    """ (first, last) call date ordinal of the documents ids of docs, or None """
+
+    dates = [docs.dates[id] for id in ids if id < len(docs)]
+    return (min(dates), max(dates)) if dates else None
+
+
+def encodePostings(postings):
+
+    """ Encodes a list of (doc id, sorted positions) pairs, sorted by doc id, as a postings block """
+
+    docs = bytearray()
+    freqs = bytearray()
+    lengths = bytearray()
+    blocks = bytearray()
+
+    last_doc = 0
+    for doc, positions in postings:
+
+        encodeVarint(doc - last_doc, docs)
+        encodeVarint(len(positions), freqs)
+        last_doc = doc
+
+        block = bytearray()
+        last_pos = 0
+        for pos in positions:
+            encodeVarint(pos - last_pos, block)
+            last_pos = pos
+
+        encodeVarint(len(block), lengths)
+        blocks.extend(block)
+
+    out = bytearray()
+    encodeVarint(len(postings), out)
+    return out + docs + freqs + lengths + blocks
+
+
+class ShardWriter(object):
+
+    """
+
+    Streams a binary shard to disk. The document ids must be known up front, but terms can be
+    added in any order -- only the dictionary (term -> offset) is held in memory until close().
+    dates is the (first, last) date ordinal of the documents (see dateRange), None if unknown, and
+    lengths the number of tokens of every document (e.g. DocTable.tokens), used for the score bounds.
+
+    """
+
+    def __init__(self, path, ids, dates=None, lengths=None):
+
+        self.path = path
+        self.ids = sorted(ids)
+        self.dates = dates or (0, 0)
+        self.lengths = lengths
+        self.entries = []
+
+        self._file = open(path, 'wb')
+        self._file.write(HEADER.pack(MAGIC, VERSION, 0, 0, 0, 0, 0, 0, 0))
+
+        docs = bytearray()
+        last_id = 0
+        for id in self.ids:
+            encodeVarint(id - last_id, docs)
+            last_id = id
+        self._file.write(docs)
+
+        self._postings_offset = self._file.tell()
+
+    def add(self, term, postings):
+
+        """ Adds a term with its postings given as (doc id, positions) pairs """
+
+        if isinstance(term, unicode):
+            term = term.encode('utf-8')
+
+        merged = dict()
+        for id, positions in postings:
+            merged.setdefault(int(id), set()).update(int(pos) for pos in positions)
+
+        block = encodePostings([(doc, sorted(merged[doc])) for doc in sorted(merged)])
+        max_tf = max(len(positions) for positions in merged.itervalues()) if merged else 0
+        min_length = min(self.lengths[doc] for doc in merged) if merged and self.lengths is not None else 0
+        offset = self._file.tell() - self._postings_offset
+        self._file.write(block)
+
+        bitmap = 0
+        if len(merged) >= BITMAP_MIN_DF:
+            bitmap = self._file.tell() - self._postings_offset + 1
+            self._file.write(DocBitmap.fromArray(sorted(merged)).serialize())
+
+        self.entries.append((term, len(merged), offset, max_tf, min_length, bitmap))
+
+    def close(self):
+
+        dict_offset = self._file.tell()
+        offsets = []
+        entries = bytearray()
+
+        for term, df, offset, max_tf, min_length, bitmap in sorted(self.entries):
+            offsets.append(dict_offset + len(entries))
+            encodeVarint(len(term), entries)
+            entries.extend(term)
+            encodeVarint(df, entries)
+            encodeVarint(offset, entries)
+            encodeVarint(max_tf, entries)
+            encodeVarint(min_length, entries)
+            encodeVarint(bitmap, entries)
+
+        self._file.write(entries)
+        table_offset = self._file.tell()
+        self._file.write(''.join(OFFSET.pack(offset) for offset in offsets))
+
+        self._file.seek(0)
+        self._file.write(HEADER.pack(MAGIC, VERSION, len(self.ids), len(self.entries),
+                                     self._postings_offset, dict_offset, table_offset, *self.dates))
+        self._file.close()
+
+        return os.path.getsize(self.path)
+
+
+class Shard(object):
+
+    """
+
+    Read only view of a binary shard. The file is memory mapped and only the postings of
+    the terms that are looked up get decoded. Supports the same lookups as InvertedIndex:
+    index[token] returns a list of [id, positions] postings.
+
+    """
+
+    def __init__(self, path):
+
+        self.path = path
+        self._file = open(path, 'rb')
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version = struct.unpack('<4sI', self._mm[:8])
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('{} is not a binary index shard of version {}, rebuild it'.format(path, VERSION))
+
+        (_, _, n_docs, n_terms, postings_offset, dict_offset, table_offset, first, last) = \
+            HEADER.unpack(self._mm[:HEADER.size])
+
+        # (first, last) call date ordinal of the documents, None if unknown
+        self.dates = (first, last) if first else None
+        self.n_terms = n_terms
+        self._postings_offset = postings_offset
+        self._dict_offset = dict_offset
+        self._table_offset = table_offset
+
+        self._ids = array('I', decodeDeltas(bytearray(self._mm[HEADER.size:postings_offset]), 0, n_docs)[0])
+
+    def __getstate__(self):
+        # Shards are passed to other processes by path and re-mapped there
+        return self.path
+
+    def __setstate__(self, path):
+        self.__init__(path)
+
+    def __len__(self):
+        return self.n_terms
+
+    def __contains__(self, term):
+        return self._find(term) is not None
+
+    def __getitem__(self, term):
+
+        entry = self._find(term)
+        if entry is None:
+            raise KeyError(term)
+
+        postings = self._decode(entry[1])
+        return [[doc, list(postings.positions(i))] for i, doc in enumerate(postings.docs)]
+
+    def get(self, term, default=None):
+        try:
+            return self[term]
+        except KeyError:
+            return default
+
+    @property
+    def ids(self):
+        return set(self._ids)
+
+    def docIds(self):
+
+        """ Sorted ids of the documents in the shard as a numpy array """
+
+        return np.frombuffer(self._ids, dtype=np.uint32).astype(np.int64)
+
+    def postings(self, term):
+
+        """ Postings of term with doc ids and positions as integer arrays, or None """
+
+        entry = self._find(term)
+        return self._decode(entry[1]) if entry is not None else None
+
+    def docFreq(self, term):
+        entry = self._find(term)
+        return entry[0] if entry is not None else 0
+
+    def scoreBounds(self, term):
+
+        """ (max term frequency, min document length) of term, or None if it is not indexed """
+
+        entry = self._find(term)
+        return entry[2:4] if entry is not None else None
+
+    def bitmap(self, term):
+
+        """ DocBitmap of the documents of term (read from the shard if it was stored there), or None """
+
+        return self.termBitmap(term)[0]
+
+    def termBitmap(self, term):
+
+        """
+
+        (DocBitmap, Postings) of term, (None, None) if it is not indexed. The postings are only decoded
+        (and returned) for the terms without a stored bitmap, whose bitmap is built from them, so the
+        caller does not decode them again; otherwise they are None.
+
+        """
+
+        entry = self._find(term)
+        if entry is None:
+            return None, None
+        if entry[4]:
+            return DocBitmap.deserialize(self._mm, self._postings_offset + entry[4] - 1), None
+        postings = self._decode(entry[1])
+        return DocBitmap.fromArray(postings.docs), postings
+
+    def terms(self):
+        for i in xrange(self.n_terms):
+            yield self._entry(i)[0]
+
+    def items(self):
+
+        """ Yields (term, postings) for every term, in sorted term order """
+
+        for i in xrange(self.n_terms):
+            term, df, offset = self._entry(i)[:3]
+            yield term, self._decode(offset)
+
+    def close(self):
+        self._mm.close()
+        self._file.close()
+
+    def _entry(self, i):
+
+        """ Returns (term, df, postings offset, max tf, min length, bitmap offset + 1) of the i-th dictionary entry """
+
+        offset, = OFFSET.unpack_from(self._mm, self._table_offset + i * OFFSET.size)
+        # A dictionary entry is at most a few varints and the term itself
+        buf = bytearray(self._mm[offset:offset + 64])
+        (length,), pos = decodeVarints(buf, 0, 1)
+        if pos + length + 50 > len(buf):
+            buf = bytearray(self._mm[offset:offset + pos + length + 50])
+        term = str(buf[pos:pos + length])
+        (df, postings, max_tf, min_length, bitmap), _ = decodeVarints(buf, pos + length, 5)
+        return term, df, postings, max_tf, min_length, bitmap
+
+    def _find(self, term):
+
+        """ Binary searches the dictionary. Returns (df, postings offset, max tf, min length, bitmap) or None. """
+
+        if isinstance(term, unicode):
+            term = term.encode('utf-8')
+
+        lo, hi = 0, self.n_terms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry = self._entry(mid)
+            if entry[0] < term:
+                lo = mid + 1
+            elif entry[0] > term:
+                hi = mid
+            else:
+                return entry[1:]
+        return None
+
+    def _decode(self, offset):
+
+        """ Decodes the doc ids and frequencies of a postings block; positions are decoded on demand """
+
+        start = self._postings_offset + offset
+        (ndocs,), pos = decodeVarints(bytearray(self._mm[start:start + 10]), 0, 1)
+        start += pos
+
+        # Doc ids, frequencies and block lengths (at most 10 bytes each) are decoded in one go
+        raw = np.frombuffer(self._mm, dtype=np.uint8, count=min(30 * ndocs, self._dict_offset - start), offset=start)
+        values, pos = decodeVarintArray(raw, 3 * ndocs)
+        docs = array('I', np.cumsum(values[:ndocs]).astype(np.uint32).tostring())
+        freqs = array('I', values[ndocs:2 * ndocs].astype(np.uint32).tostring())
+        blocks = [0] + np.cumsum(values[2 * ndocs:]).tolist()
+
+        start += pos
+        buf = bytearray(self._mm[start:start + blocks[-1]])
+
+        def positions(i):
+            return array('I', decodeDeltas(buf, blocks[i], freqs[i])[0])
+
+        return Postings(docs, freqs, positions)
+
+
+def isBinaryShard(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def openIndex(path, docs=None):
+
+    """
+
+    Opens a shard in either format: binary shards are memory mapped, text shards are parsed.
+    docs is only needed for text shards written with the old TICKER-YYYY-M-D document ids.
+
+    """
+
+    if isBinaryShard(path):
+        return Shard(path)
+
+    from build_index import readIndexFromFile
+    return readIndexFromFile(path, docs)
+
+
+class Manifest(object):
+
+    """
+
+    Lists the segments (shards) that make up the index in a folder, plus the ids of documents
+    that were removed or re-ingested (tombstones). Every change bumps the generation, which is
+    how searchers and caches notice that the index changed. Saved as JSON, atomically.
+
+    Segments that compaction merged away are kept on disk as retired ([name, generation] pairs)
+    for searches still running on an older generation, and removed by a later compaction.
+
+    """
+
+    def __init__(self, folder='index', generation=0, segments=(), tombstones=(), next_segment=1, retired=()):
+        self.folder = folder
+        self.generation = generation
+        self.segments = list(segments)
+        self.tombstones = set(tombstones)
+        self.next_segment = next_segment
+        self.retired = [list(segment) for segment in retired]
+
+    @property
+    def paths(self):
+        return [os.path.join(self.folder, segment) for segment in self.segments]
+
+    def newSegment(self):
+
+        """ Reserves the file name of a new segment (skipping names that compaction reserved on disk) """
+
+        while True:
+            name = 'segment{}.bin'.format(self.next_segment)
+            self.next_segment += 1
+            if not os.path.exists(os.path.join(self.folder, name)):
+                return name
+
+    def save(self):
+
+        self.generation += 1
+        path = os.path.join(self.folder, MANIFEST_FILE)
+        with open(path + '.tmp', 'wb') as f:
+            json.dump({'generation': self.generation,
+                       'segments': self.segments,
+                       'tombstones': sorted(self.tombstones),
+                       'next_segment': self.next_segment,
+                       'retired': self.retired}, f)
+        os.rename(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, folder='index'):
+
+        path = os.path.join(folder, MANIFEST_FILE)
+        if not os.path.isfile(path):
+            return None
+
+        with open(path, 'rb') as f:
+            manifest = json.load(f)
+        return cls(folder, manifest['generation'], manifest['segments'],
+                   manifest['tombstones'], manifest['next_segment'], manifest.get('retired', ()))
+
+
+@contextmanager
+def lockIndex(folder='index'):
+
+    """ Serializes changes to the index in folder (adding segments, compaction, rebuilds) """
+
+    with open(os.path.join(folder, '.lock'), 'wb') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def indexGeneration(folder='index'):
+    manifest = Manifest.load(folder)
+    return manifest.generation if manifest is not None else 0
+
+
+def indexStamp(folder='index'):
+
+    """
+
+    Identifies one build of the index in folder: its generation, plus the size and modification time of
+    the manifest (of the shards if there is none) and of the doc table. Unlike the generation, which
+    starts over when an index is built from scratch (and is always 0 without a manifest), it changes
+    with every rebuild.
+
+    """
+
+    manifest = os.path.join(folder, MANIFEST_FILE)
+    stamps = []
+    for path in ([manifest] if os.path.isfile(manifest) else findShards(folder)) + [os.path.join(folder, DOCS_FILE)]:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        stamps.append((os.path.basename(path), stat.st_size, stat.st_mtime))
+    return '{}-{}'.format(indexGeneration(folder), hashlib.sha1(repr(stamps)).hexdigest()[:16])
+
+
+def findShards(folder='index'):
+
+    """
+
+    Lists the shards of the index in folder: the segments of the manifest if there is one,
+    otherwise every index* file, preferring the binary version of a shard when both exist.
+
+    """
+
+    manifest = Manifest.load(folder)
+    if manifest is not None:
+        return manifest.paths
+
+    shards = {}
+    for path in sorted(glob.glob(os.path.join(folder, 'index*'))):
+        name, ext = os.path.splitext(path)
+        if ext == '.bin' or name not in shards:
+            shards[name] = path
+    return [shards[name] for name in sorted(shards)]
+
+
+def writeBinaryIndex(index, path, docs=None):
+
+    """
+
+    Writes an InvertedIndex (or any dict of token -> [[id, positions], ...]) as a binary shard.
+    Pass the DocTable to record the date range of the shard and the score bounds of its terms.
+
+    """
+
+    ids = set()
+    for postings in index.itervalues():
+        ids.update(posting[0] for posting in postings)
+
+    writer = ShardWriter(path, ids, dateRange(docs, ids) if docs is not None else None,
+                         docs.tokens if docs is not None else None)
+    for token, postings in index.iteritems():
+        writer.add(token, postings)
+    return writer.close()
+
+
+def convertIndex(src, dst=None, docs=None):
+
+    """
+
+    Converts a text shard (token||id:pos,pos;id:pos...) into a binary shard. The text file is
+    streamed twice (once for the document ids, once for the postings), so the whole shard never
+    has to be held in memory. Old TICKER-YYYY-M-D ids are mapped to integer ids through docs,
+    which gets new entries for ids it does not know yet: save it before the binary shard is
+    searched (python index_format.py does both).
+
+    """
+
+    if dst is None:
+        dst = os.path.splitext(src)[0] + '.bin'
+
+    def parse(line):
+        token, postings = line.strip().split('||')
+        return token, [(resolveId(id, docs), locs.split(',')) for id, locs in
+                       [posting.split(':') for posting in postings.split(';')]]
+
+    ids = set()
+    with open(src, 'rb') as f:
+        for line in f:
+            ids.update(id for id, _ in parse(line)[1])
+
+    writer = ShardWriter(dst, ids, dateRange(docs, ids) if docs is not None else None,
+                         docs.tokens if docs is not None else None)
+    with open(src, 'rb') as f:
+        for line in f:
+            writer.add(*parse(line))
+
+    size = writer.close()
+    print 'Converted {} -> {} ({:.1f} MB)'.format(src, dst, size / 1e+6)
+    return dst
+
+
+if __name__ == '__main__':
+    docs = openDocTable('index')
+    for path in glob.glob('index/index*.txt'):
+        convertIndex(path, docs=docs)
+    docs.save(os.path.join('index', DOCS_FILE))
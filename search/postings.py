@@ -0,0 +1,133 @@
+from array import array
+from bisect import bisect_left
+
+
+class Postings(object):
+
+    """
+
+    Postings of a single term: the sorted doc numbers it appears in and, for each of those
+    documents, the sorted positions. Positions can be given as a list of arrays or as a
+    function of the index into docs, so they are only decoded for the documents a search needs.
+
+    """
+
+    __slots__ = ('docs', 'freqs', '_positions')
+
+    def __init__(self, docs, freqs, positions):
+        self.docs = docs
+        self.freqs = freqs
+        self._positions = positions
+
+    def __len__(self):
+        return len(self.docs)
+
+    def positions(self, i):
+
+        """ Positions of the term in the i-th document of the postings """
+
+        if callable(self._positions):
+            return self._positions(i)
+        return self._positions[i]
+
+
+def fromLists(postings):
+
+    """ Builds Postings from a list of (doc number, positions) pairs in any order """
+
+    merged = dict()
+    for doc, positions in postings:
+        merged.setdefault(doc, set()).update(int(pos) for pos in positions)
+
+    docs = array('I', sorted(merged))
+    positions = [array('I', sorted(merged[doc])) for doc in docs]
+    return Postings(docs, array('I', [len(locs) for locs in positions]), positions)
+
+
+def gallop(values, target, lo=0):
+
+    """
+
+    Returns the first index i >= lo with values[i] >= target (or len(values)). Probes
+    lo, lo + 1, lo + 3, lo + 7, ... before binary searching the last gap, so a run of cursor
+    advances over a sorted array costs O(log distance) each instead of O(log n).
+
+    """
+
+    n = len(values)
+    step = 1
+    hi = lo
+    while hi < n and values[hi] < target:
+        lo = hi + 1
+        hi += step
+        step *= 2
+    return bisect_left(values, target, lo, min(hi, n))
+
+
+def intersect(lists):
+
+    """
+
+    Intersects sorted doc number arrays. The lists should be ordered rarest first: every doc
+    of the first list is galloped to in the others. Returns a list of (doc, indices) where
+    indices[k] is the position of doc in lists[k].
+
+    """
+
+    if not lists:
+        return []
+
+    first, others = lists[0], lists[1:]
+    cursors = [0] * len(others)
+    matches = []
+
+    for i, doc in enumerate(first):
+
+        indices = [i]
+        for k, values in enumerate(others):
+            j = cursors[k] = gallop(values, doc, cursors[k])
+            if j == len(values):
+                # One of the lists is exhausted, nothing else can match
+                return matches
+            if values[j] != doc:
+                break
+            indices.append(j)
+        else:
+            matches.append((doc, indices))
+
+    return matches
+
+
+def phraseMatches(locs):
+
+    """
+
+    Finds the start positions of a phrase in one document. locs is a list of (offset, positions)
+    with the offset of each word from the beginning of the phrase, e.g. 'very high profit margin'
+    at [[2, 10], [3], [4, 8, 12, 29], [5]] gives [(0, [2, 10]), (1, [3]), (2, [4, 8, 12, 29]), (3, [5])]
+    and the match [2]. Starts from the word with the fewest positions and merges the remaining
+    position arrays against the candidate starts.
+
+    """
+
+    locs = sorted(locs, key=lambda loc: len(loc[1]))
+    offset, positions = locs[0]
+    candidates = [pos - offset for pos in positions]
+
+    for offset, positions in locs[1:]:
+
+        keep = []
+        j = 0
+        n = len(positions)
+        for start in candidates:
+            j = gallop(positions, start + offset, j)
+            if j == n:
+                break
+            if positions[j] == start + offset:
+                keep.append(start)
+
+        candidates = keep
+        if not candidates:
+            break
+
+    return candidates
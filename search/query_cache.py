@@ -0,0 +1,169 @@
+import os
+import glob
+import hashlib
+import cPickle as pickle
+from collections import OrderedDict, defaultdict
+
+
+class QueryCache(object):
+
+    """
+
+    Bounded LRU cache of search results, one entry per ngram, keyed on the normalized ngram: its
+    analyzed terms (so 'Profit Margins' and 'profit margin' share an entry), the bucketing (by), the
+    document filter and the field. A query of several ngrams reuses the entries of any of them, e.g.
+    'profit margin, unexpected loss' only searches 'unexpected loss' after 'profit margin'.
+
+    Entries belong to one generation of the index: as soon as a search sees another generation
+    (segments added, removed or compacted) the whole cache is dropped.
+
+    With a folder, entries are also written there (one pickle per entry, at most maxsize files,
+    least recently used removed first), so a restarted server starts warm as long as the index
+    has not changed in the meantime. The files belong to the stamp of the index (see indexStamp),
+    which also changes when an index is rebuilt and its generation starts over. Files removed by
+    another process are treated as missing entries.
+
+    """
+
+    def __init__(self, maxsize=1024, folder=None):
+
+        self.maxsize = maxsize
+        self.folder = folder
+        self.generation = None
+        self.stamp = None
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._files = OrderedDict()
+
+        if folder is not None:
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            self.stamp = self._readStamp()
+            # Least recently used first, as saved by the access times of the files
+            for path in sorted(glob.glob(os.path.join(folder, '*.p')), key=os.path.getmtime):
+                self._files[os.path.basename(path)] = None
+
+    def __len__(self):
+        return len(self._cache)
+
+    @staticmethod
+    def key(terms, by='date', where=None, field=None):
+        return tuple(terms), by, where.key() if where is not None else None, field
+
+    def validate(self, generation, stamp=None):
+
+        """
+
+        Drops every entry if the index is not at the generation of the cache anymore, and the files too
+        if it is not at their stamp (the generation if no stamp is given)
+
+        """
+
+        stamp = str(generation) if stamp is None else stamp
+        if generation == self.generation and stamp == self.stamp:
+            return
+
+        self._cache.clear()
+        if self.folder is not None and stamp != self.stamp:
+            for name in self._files:
+                self._remove(name)
+            self._files.clear()
+            self._writeStamp(stamp)
+        self.generation = generation
+        self.stamp = stamp
+
+    def get(self, key):
+
+        """ The cached result of key ({bucket: count}), or None """
+
+        try:
+            result = self._cache.pop(key)
+        except KeyError:
+            result = self._load(key)
+            if result is None:
+                self.misses += 1
+                return None
+
+        self.hits += 1
+        self._insert(key, result)
+        return defaultdict(int, result)
+
+    def put(self, key, result):
+
+        result = dict(result)
+        self._insert(key, result)
+        if self.folder is not None:
+            self._save(key, result)
+
+    def stats(self):
+        return {'entries': len(self._cache), 'files': len(self._files), 'hits': self.hits, 'misses': self.misses,
+                'generation': self.generation}
+
+    def _insert(self, key, result):
+
+        # (Re)insert as the most recently used entry
+        self._cache.pop(key, None)
+        if len(self._cache) >= self.maxsize:
+            self._cache.popitem(last=False)
+        self._cache[key] = result
+
+    def _name(self, key):
+        return hashlib.sha1(repr(key)).hexdigest() + '.p'
+
+    def _load(self, key):
+
+        if self.folder is None:
+            return None
+        name = self._name(key)
+        if name not in self._files:
+            return None
+
+        path = os.path.join(self.folder, name)
+        try:
+            with open(path, 'rb') as f:
+                stored, result = pickle.load(f)
+            os.utime(path, None)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            del self._files[name]
+            return None
+        if stored != key:
+            return None
+
+        self._files[name] = self._files.pop(name)
+        return result
+
+    def _save(self, key, result):
+
+        name = self._name(key)
+        path = os.path.join(self.folder, name)
+
+        # Written to a temporary file first, so a crash never leaves a broken entry behind
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump((key, result), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(path + '.tmp', path)
+
+        self._files.pop(name, None)
+        self._files[name] = None
+        while len(self._files) > self.maxsize:
+            self._remove(self._files.popitem(last=False)[0])
+
+    def _remove(self, name):
+        # Another process sharing the folder may have removed it already
+        try:
+            os.remove(os.path.join(self.folder, name))
+        except OSError:
+            pass
+
+    def _readStamp(self):
+        path = os.path.join(self.folder, 'stamp')
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def _writeStamp(self, stamp):
+        path = os.path.join(self.folder, 'stamp')
+        with open(path + '.tmp', 'wb') as f:
+            f.write(stamp)
+        os.rename(path + '.tmp', path)
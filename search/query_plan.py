@@ -0,0 +1,568 @@
+"""
+
+Query language of ShardExecutor.query. A query is a comma separated list of expressions, each of
+which gets its own counts (like the ngrams of search):
+
+    profit margin                       phrase (a run of words, or "quoted" to use a keyword as a word)
+    guidance AND "share repurchase"     both (AND can be left out between two phrases in quotes)
+    headwinds OR tailwinds              either
+    guidance NOT raised                 the first, in the calls without the second (also AND NOT)
+    supply chain NEAR/5 disruption      within 5 words of each other
+    (a OR b) AND c                      grouping
+
+Operators are upper case, and bind from loose to tight: OR, AND / NOT, NEAR. Filters anywhere in an
+expression restrict all of it:
+
+    field:prepared, field:qanda         one section of the calls (see analysis.FIELDS)
+    date:2012-01-01..2014-12-31         call date range, either end can be left out
+    ticker:AAPL ticker:MSFT             companies (repeat the filter for several of them)
+    exchange:NASDAQ
+
+Every expression is compiled into a plan tree. The count of a call is the number of matches of
+its positive parts (a phrase counts its occurrences, a NEAR the pairs that are close enough). The
+plan is evaluated per shard in two steps: first the candidate documents of every node are found
+with bitwise operations on the DocBitmaps of the terms, before any postings are decoded (AND
+intersects its children from the most selective one up, as estimated from the document frequencies
+of the shard, and NOT subtracts single words), then the positions are checked for the candidates,
+again most selective child first, stopping at the first child that does not match.
+Identical subexpressions (also across the expressions of one query) are evaluated once.
+
+"""
+
+import re
+from bisect import bisect_left
+from collections import defaultdict
+
+from analysis import defaultAnalyzer, FIELDS
+from filters import DocFilter
+from postings import phraseMatches
+from bitmaps import DocBitmap, deletedBitmap
+
+
+TOKEN = re.compile(r'"(?P<quoted>[^"]*)"|(?P<paren>[()])|(?P<near>NEAR/(?P<distance>\d+))|'
+                   r'(?P<op>\b(?:AND|OR|NOT)\b)|(?P<filter>\b(?:field|date|ticker|exchange):[^\s()",]+)|'
+                   r'(?P<word>[^\s()"]+)')
+
+# Counters reported by explain for every node
+STATS = ['estimate', 'postings', 'candidates', 'evaluated', 'matched', 'positions']
+
+
+def splitQuery(text):
+
+    """ Splits a query on the commas that are not in quotes or parentheses """
+
+    parts, depth, quoted, start = [], 0, False, 0
+    for i, char in enumerate(text):
+        if char == '"':
+            quoted = not quoted
+        elif not quoted and char == '(':
+            depth += 1
+        elif not quoted and char == ')':
+            depth -= 1
+        elif not quoted and depth == 0 and char == ',':
+            parts.append(text[start:i])
+            start = i + 1
+    parts.append(text[start:])
+    return [part.strip() for part in parts if part.strip()]
+
+
+class Node(object):
+
+    """ Node of a plan tree. key identifies the subexpression, so equal subtrees can be shared. """
+
+    children = ()
+    # True if the candidates of the node (see ShardEvaluator.candidates) are exactly the documents it matches
+    exact = False
+
+    def label(self):
+        return self.key
+
+
+class Phrase(Node):
+
+    def __init__(self, text, terms):
+        self.text = text
+        self.terms = tuple(terms)
+        self.exact = len(self.terms) == 1
+        self.key = u'"{}"'.format(u' '.join(term.decode('utf-8') if isinstance(term, str) else term
+                                           for term in self.terms))
+
+    def label(self):
+        return u'PHRASE "{}"'.format(self.text)
+
+    def estimate(self, shard):
+        return min(shard.docFreq(term) for term in self.terms) if self.terms else 0
+
+    def candidates(self, shard):
+
+        bitmaps = [shard.bitmap(term) for term in set(self.terms)]
+        if not bitmaps or None in bitmaps:
+            return DocBitmap()
+
+        bitmaps.sort(key=len)
+        docs = bitmaps[0]
+        for bitmap in bitmaps[1:]:
+            docs &= bitmap
+        return docs
+
+    def match(self, shard, doc):
+
+        locs = []
+        for offset, term in enumerate(self.terms):
+            postings = shard.postings(term, self)
+            if postings is None:
+                return []
+            i = bisect_left(postings.docs, doc)
+            if i == len(postings.docs) or postings.docs[i] != doc:
+                return []
+            locs.append((offset, shard.positions(self, term, i)))
+
+        length = len(self.terms) - 1
+        return [(start, start + length) for start in phraseMatches(locs)]
+
+
+class And(Node):
+
+    def __init__(self, children):
+        self.children = children
+        self.exact = all(child.exact for child in children)
+        self.key = u'AND({})'.format(u', '.join(sorted(child.key for child in children)))
+
+    def label(self):
+        return u'AND'
+
+    def estimate(self, shard):
+        return min(shard.estimate(child) for child in self.children)
+
+    def candidates(self, shard):
+
+        # Most selective child first, so the intersection only shrinks
+        docs = None
+        for child in shard.ordered(self.children):
+            docs = shard.candidates(child) if docs is None else docs & shard.candidates(child)
+            if not docs:
+                break
+        return docs
+
+    def match(self, shard, doc):
+
+        matches = set()
+        for child in shard.ordered(self.children):
+            found = shard.match(child, doc)
+            if not found:
+                return []
+            matches.update(found)
+        return sorted(matches)
+
+
+class Or(Node):
+
+    def __init__(self, children):
+        self.children = children
+        self.exact = all(child.exact for child in children)
+        self.key = u'OR({})'.format(u', '.join(sorted(child.key for child in children)))
+
+    def label(self):
+        return u'OR'
+
+    def estimate(self, shard):
+        return sum(shard.estimate(child) for child in self.children)
+
+    def candidates(self, shard):
+        docs = DocBitmap()
+        for child in self.children:
+            docs |= shard.candidates(child)
+        return docs
+
+    def match(self, shard, doc):
+        matches = set()
+        for child in self.children:
+            if doc in shard.candidates(child):
+                matches.update(shard.match(child, doc))
+        return sorted(matches)
+
+
+class Not(Node):
+
+    def __init__(self, include, exclude):
+        self.children = [include, exclude]
+        self.exact = include.exact and exclude.exact
+        self.key = u'NOT({}, {})'.format(include.key, exclude.key)
+
+    def label(self):
+        return u'NOT'
+
+    def estimate(self, shard):
+        return shard.estimate(self.children[0])
+
+    def candidates(self, shard):
+        # The candidates of the excluded part can only be removed if they are sure to match it
+        include, exclude = self.children
+        if exclude.exact:
+            return shard.candidates(include) - shard.candidates(exclude)
+        return shard.candidates(include)
+
+    def match(self, shard, doc):
+        include, exclude = self.children
+        found = shard.match(include, doc)
+        if found and doc in shard.candidates(exclude) and shard.match(exclude, doc):
+            return []
+        return found
+
+
+class Near(Node):
+
+    def __init__(self, left, right, distance):
+        self.children = [left, right]
+        self.distance = distance
+        self.key = u'NEAR/{}({})'.format(distance, u', '.join(sorted([left.key, right.key])))
+
+    def label(self):
+        return u'NEAR/{}'.format(self.distance)
+
+    def estimate(self, shard):
+        return min(shard.estimate(child) for child in self.children)
+
+    def candidates(self, shard):
+        first, second = shard.ordered(self.children)
+        return shard.candidates(first) & shard.candidates(second)
+
+    def match(self, shard, doc):
+
+        first, second = shard.ordered(self.children)
+        a = shard.match(first, doc)
+        b = a and shard.match(second, doc)
+        if not b:
+            return []
+
+        # Every match of the left part with a match of the right part at most distance words away
+        matches = set()
+        for start, end in a:
+            for other_start, other_end in b:
+                if max(other_start - end, start - other_end, 0) <= self.distance:
+                    matches.add((min(start, other_start), max(end, other_end)))
+        return sorted(matches)
+
+
+class Expression(object):
+
+    """ One parsed expression of a query: its plan tree, and its filters (a DocFilter and a field) """
+
+    def __init__(self, text, root, where=None, field=None):
+        self.text = text
+        self.root = root
+        self.where = where
+        self.field = field
+
+
+class Parser(object):
+
+    """ Recursive descent parser of one expression; nodes are interned in nodes (key -> node) """
+
+    def __init__(self, text, nodes):
+        self.text = text
+        self.nodes = nodes
+        self.tokens = []
+        self.filters = []
+        self.i = 0
+
+        for match in TOKEN.finditer(text):
+            if match.group('filter'):
+                self.filters.append(match.group('filter'))
+            elif match.group('quoted') is not None:
+                self.tokens.append(('phrase', match.group('quoted')))
+            elif match.group('paren'):
+                self.tokens.append((match.group('paren'), None))
+            elif match.group('near'):
+                self.tokens.append(('NEAR', int(match.group('distance'))))
+            elif match.group('op'):
+                self.tokens.append((match.group('op'), None))
+            elif self.tokens and self.tokens[-1][0] == 'words':
+                # A run of bare words is one phrase
+                self.tokens[-1] = ('words', self.tokens[-1][1] + u' ' + match.group('word'))
+            else:
+                self.tokens.append(('words', match.group('word')))
+
+    def parse(self):
+
+        root = self.parseOr() if self.tokens else None
+        if self.i < len(self.tokens):
+            raise ValueError(u'Unexpected {} in query: {}'.format(self.tokens[self.i][0], self.text))
+        if root is None:
+            raise ValueError(u'Nothing to search for in query: {}'.format(self.text))
+        where, field = self.parseFilters()
+        return Expression(self.text, root, where, field)
+
+    def peek(self):
+        return self.tokens[self.i][0] if self.i < len(self.tokens) else None
+
+    def take(self):
+        self.i += 1
+        return self.tokens[self.i - 1]
+
+    def intern(self, node):
+        return self.nodes.setdefault(node.key, node)
+
+    def parseOr(self):
+        children = [self.parseAnd()]
+        while self.peek() == 'OR':
+            self.take()
+            children.append(self.parseAnd())
+        return children[0] if len(children) == 1 else self.intern(Or(self.flatten(Or, children)))
+
+    def parseAnd(self):
+
+        node = self.parseNear()
+        include = [node]
+        while self.peek() in ('AND', 'NOT', 'phrase', 'words', '('):
+            op = self.take()[0] if self.peek() in ('AND', 'NOT') else 'AND'
+            if op == 'AND' and self.peek() == 'NOT':
+                op = self.take()[0]
+            if op == 'NOT':
+                exclude = self.parseNear()
+                node = self.intern(And(self.flatten(And, include))) if len(include) > 1 else include[0]
+                include = [self.intern(Not(node, exclude))]
+            else:
+                include.append(self.parseNear())
+        return include[0] if len(include) == 1 else self.intern(And(self.flatten(And, include)))
+
+    def parseNear(self):
+        node = self.parsePrimary()
+        while self.peek() == 'NEAR':
+            distance = self.take()[1]
+            node = self.intern(Near(node, self.parsePrimary(), distance))
+        return node
+
+    def parsePrimary(self):
+
+        kind = self.peek()
+        if kind == '(':
+            self.take()
+            node = self.parseOr()
+            if self.peek() != ')':
+                raise ValueError(u'Missing ) in query: {}'.format(self.text))
+            self.take()
+            return node
+
+        if kind in ('phrase', 'words'):
+            text = self.take()[1].strip()
+            terms = defaultAnalyzer().terms(text)
+            if not terms:
+                raise ValueError(u'Empty phrase in query: {}'.format(self.text))
+            return self.intern(Phrase(text, terms))
+
+        raise ValueError(u'Expected a phrase or ( instead of {} in query: {}'.format(kind or 'the end', self.text))
+
+    def flatten(self, cls, children):
+
+        """ AND(a, AND(b, c)) -> AND(a, b, c), without duplicates """
+
+        flat = []
+        for child in children:
+            for node in (child.children if isinstance(child, cls) else [child]):
+                if node not in flat:
+                    flat.append(node)
+        return flat
+
+    def parseFilters(self):
+
+        tickers, exchanges, start, end, field = None, None, None, None, None
+        for text in self.filters:
+            name, value = text.split(':', 1)
+            if name == 'field':
+                if value not in FIELDS:
+                    raise ValueError(u'Invalid field: {}'.format(value))
+                field = value
+            elif name == 'date':
+                start, _, end = value.partition('..')
+                start, end = start or None, end or None
+            elif name == 'ticker':
+                tickers = (tickers or []) + [value.upper()]
+            elif name == 'exchange':
+                exchanges = (exchanges or []) + [value.upper()]
+
+        where = DocFilter(tickers, exchanges, start, end)
+        return (None if where.empty() else where), field
+
+
+class QueryPlan(object):
+
+    """ The expressions of a query (see the module docstring), with their subexpressions shared """
+
+    def __init__(self, text):
+
+        if isinstance(text, str):
+            text = text.decode('utf-8')
+
+        self.text = text
+        self.nodes = dict()
+        self.expressions = [Parser(part, self.nodes).parse() for part in splitQuery(text)]
+
+    def evaluate(self, index, docs, deleted=frozenset(), by='date', where=None, field=None):
+
+        """
+
+        Counts the matches of every expression in one shard: {expression: {date: count}}, or
+        {expression: {doc id: count}} with by='doc'. where and field apply to every expression, on
+        top of its own filters. Also returns the counters of every node (see explain).
+
+        """
+
+        shard = ShardEvaluator(index)
+        counts = dict()
+
+        for expression in self.expressions:
+
+            ngram_count = counts[expression.text.encode('utf-8')] = defaultdict(int)
+
+            fields = set(filter for filter in (field, expression.field) if filter is not None)
+            if len(fields) > 1:
+                continue
+            section = fields.pop() if fields else None
+
+            found = shard.candidates(expression.root)
+            for filter in (where, expression.where):
+                if filter is not None:
+                    found &= filter.bitmap(docs)
+            if deleted:
+                found -= deletedBitmap(docs, deleted)
+
+            for doc in found.toArray().tolist():
+
+                if section is not None and docs.qanda[doc] < 0:
+                    continue
+
+                matches = shard.match(expression.root, doc)
+                if section is not None:
+                    split = bisect_left(matches, (docs.qanda[doc], 0))
+                    matches = matches[:split] if section == 'prepared' else matches[split:]
+
+                if matches:
+                    ngram_count[doc if by == 'doc' else docs.date(doc)] += len(matches)
+
+        # Plain dicts, to be sent back from the worker processes
+        return counts, {key: dict(counters) for key, counters in shard.stats.iteritems()}
+
+    def explain(self, stats):
+
+        """
+
+        Text rendering of the plan trees with the counters of every node, summed over the shards:
+        estimate (documents, from the document frequencies), postings (document entries decoded),
+        candidates (documents left after the bitmap operations), evaluated / matched (documents
+        whose positions were checked / that matched) and positions (position lists decoded).
+        Children of AND and NEAR are listed in the order they run; shared subexpressions are only
+        expanded the first time.
+
+        """
+
+        lines = []
+        seen = set()
+
+        def render(node, depth):
+
+            counters = stats.get(node.key, dict())
+            line = u'{}{}'.format(u'  ' * depth, node.label())
+            line += u' ' * max(1, 40 - len(line))
+            line += u'  '.join(u'{} {}'.format(name, counters.get(name, 0)) for name in STATS
+                               if name in counters or name == 'estimate')
+
+            if node.key in seen:
+                lines.append(line + u'  (shared)')
+                return
+            seen.add(node.key)
+            lines.append(line)
+
+            children = node.children
+            if isinstance(node, (And, Near)):
+                children = sorted(children, key=lambda child: stats.get(child.key, dict()).get('estimate', 0))
+            for child in children:
+                render(child, depth + 1)
+
+        for expression in self.expressions:
+            filters = []
+            if expression.where is not None:
+                filters.append(repr(expression.where))
+            if expression.field is not None:
+                filters.append(u'field {}'.format(expression.field))
+            lines.append(u'{}{}'.format(expression.text, u'  [{}]'.format(u', '.join(filters)) if filters else u''))
+            render(expression.root, 1)
+
+        return u'\n'.join(lines)
+
+
+class ShardEvaluator(object):
+
+    """ Evaluates plan nodes in one shard, caching postings, candidates and matches per node (see QueryPlan) """
+
+    def __init__(self, index):
+
+        self.index = index
+        self.stats = defaultdict(lambda: defaultdict(int))
+        self._postings = dict()
+        self._estimates = dict()
+        self._candidates = dict()
+        self._matches = defaultdict(dict)
+
+    def postings(self, term, node=None):
+
+        """ Postings of term, decoded the first time node needs their positions """
+
+        if term not in self._postings:
+            self._postings[term] = self.index.postings(term)
+            if node is not None and self._postings[term] is not None:
+                self.stats[node.key]['postings'] += len(self._postings[term])
+        return self._postings[term]
+
+    def bitmap(self, term):
+        return self.index.bitmap(term)
+
+    def docFreq(self, term):
+        # From the dictionary of the shard, without decoding the postings
+        return self.index.docFreq(term)
+
+    def positions(self, node, term, i):
+        self.stats[node.key]['positions'] += 1
+        return self.postings(term).positions(i)
+
+    def estimate(self, node):
+        if node.key not in self._estimates:
+            self._estimates[node.key] = node.estimate(self)
+            self.stats[node.key]['estimate'] = self._estimates[node.key]
+        return self._estimates[node.key]
+
+    def ordered(self, nodes):
+
+        """ Most selective (lowest estimate) first """
+
+        return sorted(nodes, key=self.estimate)
+
+    def candidates(self, node):
+
+        if node.key not in self._candidates:
+            self.estimate(node)
+            self._candidates[node.key] = node.candidates(self)
+            self.stats[node.key]['candidates'] = len(self._candidates[node.key])
+        return self._candidates[node.key]
+
+    def match(self, node, doc):
+
+        memo = self._matches[node.key]
+        if doc not in memo:
+            memo[doc] = node.match(self, doc)
+            self.stats[node.key]['evaluated'] += 1
+            if memo[doc]:
+                self.stats[node.key]['matched'] += 1
+        return memo[doc]
+
+
+def mergeStats(stats):
+
+    """ Sums the per-node counters of several shards """
+
+    merged = defaultdict(lambda: defaultdict(int))
+    for shard_stats in stats:
+        for key, counters in shard_stats.iteritems():
+            for name, value in counters.iteritems():
+                merged[key][name] += value
+    return merged
@@ -0,0 +1,243 @@
+import math
+import heapq
+import numpy as np
+from collections import Counter, defaultdict
+
+from analysis import defaultAnalyzer
+from postings import gallop
+
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+# Doc id past the end of every postings list
+END = float('inf')
+
+
+def collectionStats(docs, deleted=frozenset()):
+
+    """ (number of documents, average length in tokens) of the live documents of docs, cached on the DocTable """
+
+    key = ('bm25', deleted)
+    if key not in docs.cache:
+        lengths = np.array(docs.tokens, dtype=np.float64)
+        live = np.ones(len(lengths), dtype=bool)
+        live[[id for id in deleted if id < len(live)]] = False
+        known = live & (lengths > 0)
+        docs.cache[key] = (int(live.sum()), float(lengths[known].mean()) if known.any() else 1.0)
+    return docs.cache[key]
+
+
+def idf(df, n):
+    # The document frequencies still count removed documents until compaction, n does not
+    df = min(df, n)
+    return math.log(1 + (n - df + 0.5) / (df + 0.5))
+
+
+def termScore(weight, tf, length, avgdl, k1=K1, b=B):
+    return weight * tf * (k1 + 1) / (tf + k1 * (1 - b + b * length / avgdl))
+
+
+def lengthNorms(docs, avgdl, k1=K1, b=B):
+
+    """
+
+    k1 * (1 - b + b * length / avgdl) of every document as a list (the part of the BM25 denominator
+    that only depends on the document), documents of unknown length counted as average. Cached on
+    the DocTable, so a query only does one division per scored posting.
+
+    """
+
+    key = ('bm25 norms', avgdl, k1, b)
+    if key not in docs.cache:
+        lengths = np.array(docs.tokens, dtype=np.float64)
+        lengths[lengths == 0] = avgdl
+        docs.cache[key] = (k1 * (1 - b + b * lengths / avgdl)).tolist()
+    return docs.cache[key]
+
+
+def queryWeights(query, indexes, n):
+
+    """
+
+    {term: weight} of a free text query over the shards in indexes: the idf of the term in the whole
+    index (its document frequencies summed over the shards) times the number of times it is in the query
+
+    """
+
+    weights = dict()
+    for term, count in Counter(defaultAnalyzer().terms(query)).iteritems():
+        df = sum(index.docFreq(term) for index in indexes)
+        if df:
+            weights[term] = count * idf(df, n)
+    return weights
+
+
+class TermCursor(object):
+
+    """ Position in the postings of one query term, with the upper bound of the score of the term in any document """
+
+    __slots__ = ('docs', 'freqs', 'weight', 'bound', 'i', 'doc')
+
+    def __init__(self, postings, weight, bound):
+        self.docs = postings.docs
+        self.freqs = postings.freqs
+        self.weight = weight
+        self.bound = bound
+        self.i = 0
+        self.doc = self.docs[0] if len(self.docs) else END
+
+    def advance(self, target=None):
+
+        """ Moves to the first doc >= target (the next doc without target) """
+
+        self.i = self.i + 1 if target is None else gallop(self.docs, target, self.i)
+        self.doc = self.docs[self.i] if self.i < len(self.docs) else END
+
+
+def cursors(weights, index, norms, avgdl, k1=K1, b=B):
+
+    """
+
+    A TermCursor for every term of weights that is in index. The bound of a term comes from the max
+    frequency and min document length stored in the shard (see ShardWriter); for shards without them
+    it is computed from the postings.
+
+    """
+
+    result = []
+    for term, weight in weights.iteritems():
+
+        postings = index.postings(term)
+        if postings is None or not len(postings):
+            continue
+
+        bounds = index.scoreBounds(term) if hasattr(index, 'scoreBounds') else None
+        if bounds is not None:
+            max_tf, min_length = bounds
+            bound = termScore(weight, max_tf, min_length, avgdl, k1, b)
+        else:
+            freqs = np.array(postings.freqs, dtype=np.float64)
+            doc_norms = np.array(norms, dtype=np.float64)[np.array(postings.docs, dtype=np.int64)]
+            bound = (weight * freqs * (k1 + 1) / (freqs + doc_norms)).max()
+
+        result.append(TermCursor(postings, weight, bound))
+    return result
+
+
+def topK(weights, index, docs, k=20, deleted=frozenset(), where=None, k1=K1, b=B, counters=None):
+
+    """
+
+    The k documents of index with the highest BM25 score for the terms and weights of queryWeights,
+    as [(score, doc id)] from the highest score down (ties by doc id).
+
+    Uses MaxScore: the terms are sorted by the upper bound of their score, and once the top k is full
+    the terms with the lowest bounds whose bounds add up to less than the k-th best score so far become
+    non-essential -- a document that only holds those cannot make it into the top k. Candidates are
+    only taken from the postings of the essential terms, and the cursors of the non-essential terms
+    gallop straight to a candidate, and only while its score can still beat the threshold. As the
+    threshold rises, the common terms stop producing candidates and most of their postings are skipped.
+    counters (a dict) gets the number of documents that were scored.
+
+    """
+
+    _, avgdl = collectionStats(docs, deleted)
+    norms = lengthNorms(docs, avgdl, k1, b)
+    allowed = where.mask(docs) if where is not None else None
+
+    terms = sorted(cursors(weights, index, norms, avgdl, k1, b), key=lambda cursor: cursor.bound)
+    # below[i]: the sum of the bounds of terms[0..i]
+    below = []
+    for cursor in terms:
+        below.append((below[-1] if below else 0.0) + cursor.bound)
+
+    top = []
+    threshold = 0.0
+    first = 0
+    essential = terms
+    scored = 0
+
+    while essential:
+
+        doc = min([cursor.doc for cursor in essential])
+        if doc == END:
+            break
+
+        norm = norms[int(doc)]
+        skip = doc in deleted or (allowed is not None and not allowed[doc])
+
+        score = 0.0
+        for cursor in essential:
+            if cursor.doc == doc:
+                if not skip:
+                    tf = cursor.freqs[cursor.i]
+                    score += cursor.weight * tf * (k1 + 1) / (tf + norm)
+                cursor.advance()
+
+        if skip:
+            continue
+
+        # Non-essential terms, from the highest bound down, while the document can still make it
+        for i in xrange(first - 1, -1, -1):
+            if score + below[i] < threshold:
+                break
+            cursor = terms[i]
+            if cursor.doc < doc:
+                cursor.advance(doc)
+            if cursor.doc == doc:
+                tf = cursor.freqs[cursor.i]
+                score += cursor.weight * tf * (k1 + 1) / (tf + norm)
+        scored += 1
+
+        doc = int(doc)
+        if len(top) < k:
+            heapq.heappush(top, (score, -doc))
+        elif (score, -doc) > top[0]:
+            heapq.heapreplace(top, (score, -doc))
+        else:
+            continue
+
+        if len(top) == k:
+            threshold = top[0][0]
+            while first < len(terms) and below[first] < threshold:
+                first += 1
+            essential = terms[first:]
+
+    if counters is not None:
+        counters['scored'] = counters.get('scored', 0) + scored
+
+    return [(score, -doc) for score, doc in sorted(top, reverse=True)]
+
+
+def exhaustive(weights, index, docs, k=20, deleted=frozenset(), where=None, k1=K1, b=B, counters=None):
+
+    """ Same as topK, but scores every document that holds any of the terms (see benchmark.py) """
+
+    _, avgdl = collectionStats(docs, deleted)
+    norms = lengthNorms(docs, avgdl, k1, b)
+    allowed = where.mask(docs) if where is not None else None
+
+    scores = defaultdict(float)
+    for term, weight in weights.iteritems():
+        postings = index.postings(term)
+        if postings is None:
+            continue
+        for doc, tf in zip(postings.docs, postings.freqs):
+            scores[doc] += weight * tf * (k1 + 1) / (tf + norms[doc])
+
+    if counters is not None:
+        counters['scored'] = counters.get('scored', 0) + len(scores)
+
+    candidates = ((score, -doc) for doc, score in scores.iteritems()
+                  if doc not in deleted and (allowed is None or allowed[doc]))
+    return [(score, -doc) for score, doc in heapq.nlargest(k, candidates)]
+
+
+def mergeTop(results, k=20):
+
+    """ Merges the [(score, doc id)] top k lists of several shards into one """
+
+    return [(score, -doc) for score, doc in
+            heapq.nlargest(k, ((score, -doc) for result in results if result for score, doc in result))]
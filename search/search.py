@@ -1,94 +1,529 @@
-import glob
-from multiprocessing import Process
+import os
+import time
+import threading
+import numpy as np
+from bisect import bisect_left
+from multiprocessing import Pool, TimeoutError, cpu_count
 
-from datetime import datetime
 from collections import defaultdict
-from nltk.stem.porter import PorterStemmer
 
-from build_index import readIndexFromFile
+from analysis import defaultAnalyzer, FIELDS
+from postings import phraseMatches
+from bitmaps import DocBitmap, deletedBitmap, unsectionedBitmap
+from doc_table import openDocTable, openParagraphMap
+from index_format import Manifest, openIndex, findShards, indexGeneration, indexStamp
+from query_cache import QueryCache
+from query_plan import QueryPlan, mergeStats
+from ranking import collectionStats, queryWeights, topK, mergeTop
+from snippets import SnippetReader
 
 
-def search(ngrams, index, path, counts, id):
+# Seconds between the checks of a query waiting for the workers (see ShardExecutor._map)
+POLL_INTERVAL = 0.05
 
-    print 'Searching {}'.format(path.split('/')[-1])
+
+def splitNgrams(ngrams):
+
+    """ 'Profit margin, unexpected loss' -> ['profit margin', 'unexpected loss'] (utf-8) """
+
+    if len(ngrams) > 1:
+        return ngrams.replace(', ', ',').encode('utf-8').lower().split(',')
+    return ngrams.encode('utf-8').lower()
+
+
+def ngramMatches(words, index, allowed=None, removed=None):
+
+    """
+
+    Yields (doc id, sorted start positions) for every document of index that holds the phrase of
+    the analyzed words, in doc id order. allowed (a DocBitmap, None for all of them) restricts the
+    documents, and the documents of removed (a DocBitmap) are skipped.
+
+    """
+
+    # The postings of the words whose bitmap is built from them are decoded once, here
+    bitmaps = dict()
+    decoded = dict()
+    for word in set(words):
+        bitmaps[word], decoded[word] = index.termBitmap(word)
+
+    # If any of the words is not in the index, the ngram cannot appear
+    if not words or None in bitmaps.values():
+        return
+
+    # The documents that hold every word (and pass the filter) are found with bitwise operations
+    # on the bitmaps of the words, rarest first, before any postings are decoded
+    terms = sorted(bitmaps, key=lambda word: len(bitmaps[word]))
+    found = bitmaps[terms[0]]
+    for word in terms[1:]:
+        if not found:
+            break
+        found &= bitmaps[word]
+    if allowed is not None:
+        found &= allowed
+    if removed is not None:
+        found -= removed
+    if not found:
+        return
+
+    ids = found.toArray()
+    postings = {word: decoded[word] if decoded[word] is not None else index.postings(word) for word in terms}
+    indices = {word: np.searchsorted(np.frombuffer(postings[word].docs, dtype=np.uint32), ids).tolist()
+               for word in terms}
+
+    for k, doc in enumerate(ids.tolist()):
+        # Positions of each word in this transcript, with the word's offset in the ngram.
+        # The ngram appears wherever every word k is found at (start + k)
+        locs = [(i, postings[word].positions(indices[word][k])) for i, word in enumerate(words)]
+        yield doc, phraseMatches(locs)
+
+
+def fieldMatches(matches, qanda, field):
+
+    """ The matches (sorted positions) in one field, qanda being the start of the Q&A of the document """
+
+    # The prepared remarks come before the Q&A
+    split = bisect_left(matches, qanda)
+    return matches[:split] if field == 'prepared' else matches[split:]
+
+
+def excluded(docs, deleted, field=None):
+
+    """
+
+    DocBitmap of the documents a search skips, None if there are none: removed or re-ingested
+    transcripts (tombstones) until compaction drops them, and with a field the documents indexed
+    without their section boundary
+
+    """
+
+    removed = deletedBitmap(docs, deleted) if deleted else None
+    if field is not None:
+        unknown = unsectionedBitmap(docs)
+        removed = unknown if removed is None else removed | unknown
+    return removed
+
+
+def search(ngrams, index, docs, deleted=frozenset(), by='date', where=None, field=None):
+
+    """
+
+    Returns {ngram: {date: count}}, or {ngram: {doc id: count}} with by='doc' (see aggregate.py).
+    where is a DocFilter (see filters.py): only the documents that pass are counted.
+    field ('prepared' or 'qanda') only counts the matches in that section of the transcripts,
+    leaving out the documents indexed without their section boundary.
+
+    """
 
     # If 'Graph!' button was hit with nothing in box
     if ngrams == '':
         return None
 
-    if len(ngrams) > 1:
-        ngrams = ngrams.replace(', ', ',').encode('utf-8').lower().split(',')
-    else:
-        ngrams = ngrams.encode('utf-8').lower()
+    if field is not None and field not in FIELDS:
+        raise ValueError('Invalid field: {}'.format(field))
 
+    ngrams = splitNgrams(ngrams)
     ngram_count = {ngram: defaultdict(int) for ngram in ngrams}
-    stemmer = PorterStemmer()
+    analyzer = defaultAnalyzer()
+    allowed = where.bitmap(docs) if where is not None else None
+    removed = excluded(docs, deleted, field)
 
     for ngram in ngrams:
 
-        transcripts = list()
+        # Analyzed exactly like the transcripts were at index time (e.g. 'supply-chain' -> suppli, -, chain).
+        # Each word is stemmed once; the same stem is used for the doc lookup and the positions
+        words = analyzer.terms(ngram.decode('utf-8'))
 
-        for word in ngram.split():
+        for doc, matches in ngramMatches(words, index, allowed, removed):
+            if field is not None:
+                matches = fieldMatches(matches, docs.qanda[doc], field)
+            ngram_count[ngram][doc if by == 'doc' else docs.date(doc)] += len(matches)
 
-            # Get stem of word
-            word = stemmer.stem(word)
+    return ngram_count
 
-            try:
-                # Get set of books the word appears in
-                transcripts.append(set([posting[0] for posting in index[word]]))
-            except:
-                # If the word is not in the index
-                pass
 
-        # Get the set of transcripts in which all words in the ngram appear
-        transcripts = set.intersection(*transcripts) if len(transcripts) > 0 else set()
+def hitPositions(ngram, index, docs, ids, deleted=frozenset(), field=None):
 
-        for transcript in transcripts:
+    """ {doc id: sorted start positions} of the hits of one ngram in the documents ids (see ShardExecutor.snippets) """
 
-            year = int(transcript.split('-')[1])
-            month = int(transcript.split('-')[2])
-            day = int(transcript.split('-')[3])
-            date = datetime(year, month, day)
-            locs = []
+    words = defaultAnalyzer().terms(ngram)
+    hits = dict()
+    for doc, matches in ngramMatches(words, index, DocBitmap.fromArray(sorted(ids)), excluded(docs, deleted, field)):
+        hits[doc] = fieldMatches(matches, docs.qanda[doc], field) if field is not None else matches
+    return hits
 
-            # For each transcript, get all of the locations of where the words in the ngram appear
-            for word in ngram.split():
-                word = stemmer.stem(word)
-                locs.extend([posting[1] for posting in index[word] if posting[0] == transcript])
 
-            # Check if the words are next to each other
-            # e.g. ngram = 'very high profit margin' and the positions of the words are [[2,10] [3], [4,8,12,29], [5]]
-            # This line of code will shift the position of each word over by its distance from the
-            # beginning of the ngram to produce new positions [[2,10], [2], [2,6,10,29], [2]]
-            # Then I take the intersection of these positions -- if it's not empty,
-            # then the ngram appears in the transcript
-            locs = [set([int(pos) - i for pos in loc]) for i, loc in enumerate(locs)]
-            ngram_count[ngram][date] += len(set.intersection(*locs))
+def mergeCounts(counts):
 
-    counts[id] = ngram_count
-    print 'Finished searching {}'.format(path.split('/')[-1])
+    """ Sums the per-shard {ngram: {date (or doc id): count}} results into a single one """
 
+    merged = dict()
+    for ngram_count in counts:
+        if ngram_count is None:
+            continue
+        for ngram, dates in ngram_count.iteritems():
+            total = merged.setdefault(ngram, defaultdict(int))
+            for date, count in dates.iteritems():
+                total[date] += count
 
-def main(ngrams):
+    return merged
 
-    indices = glob.glob('index/index*')
-    processes = []
-    counts = dict()
 
-    for i, path in enumerate(indices):
+# Shards opened by this (worker) process, keyed by path, and the doc table and tombstones
+# of each index folder, keyed by folder and reloaded whenever the index generation changes
+_shards = dict()
+_state = dict()
 
-        print 'Loading {}'.format(path.split('/')[-1])
-        index = readIndexFromFile(path)
-        process = Process(target=search, args=(ngrams, index, path, counts, i))
-        processes.append(process)
-        process.start()
 
-    alive = True
-    while alive:
-        alive = sum([process.is_alive() for process in processes])
+def openState(folder, generation):
 
-    print counts
+    if folder not in _state or _state[folder][0] != generation:
+        manifest = Manifest.load(folder)
+        tombstones = frozenset(manifest.tombstones) if manifest is not None else frozenset()
+        _state[folder] = (generation, openDocTable(folder), tombstones)
+
+        # Drop the shards that compaction has removed from the index
+        if manifest is not None:
+            for path in set(_shards) - set(manifest.paths):
+                del _shards[path]
+
+    return _state[folder][1:]
+
+
+def openShard(path, docs=None):
+    if path not in _shards:
+        _shards[path] = openIndex(path, docs)
+    return _shards[path]
+
+
+def openShards(folder, generation, paths):
+    docs, _ = openState(folder, generation)
+    for path in paths:
+        openShard(path, docs)
+
+
+def searchShard(args):
+
+    """ Pool task: opens the shard by path (once per worker process) and returns its partial ngram_count """
+
+    ngrams, path, generation, by, where, field = args
+    docs, deleted = openState(os.path.dirname(path), generation)
+    shard = openShard(path, docs)
+
+    # Shards without any document that passes the filter are not searched at all
+    if where is not None and where.skipShard(shard, docs):
+        return None
+    return search(ngrams, shard, docs, deleted, by, where, field)
+
+
+def queryShard(args):
+
+    """ Pool task: the partial ngram_count of a query in the query language (see query_plan.py), and the counters of its plan """
+
+    text, path, generation, by, where, field = args
+    docs, deleted = openState(os.path.dirname(path), generation)
+    shard = openShard(path, docs)
+
+    if where is not None and where.skipShard(shard, docs):
+        return None, dict()
+    return QueryPlan(text).evaluate(shard, docs, deleted, by, where, field)
+
+
+def hitShard(args):
+
+    """ Pool task: the hit positions of an ngram in some of the documents (see hitPositions), {} if the shard has none of them """
+
+    ngram, path, generation, ids, field = args
+    docs, deleted = openState(os.path.dirname(path), generation)
+    return hitPositions(ngram, openShard(path, docs), docs, ids, deleted, field)
+
+
+def rankShard(args):
+
+    """
+
+    Pool task: the top k documents of one shard for a ranked query (see ranking.topK). The weights
+    of the terms depend on their document frequencies in the whole index, which every worker gets
+    from the dictionaries of all of the shards (memory mapped, so only a few pages are read).
+
+    """
+
+    query, path, paths, generation, k, where = args
+    docs, deleted = openState(os.path.dirname(path), generation)
+    shard = openShard(path, docs)
+
+    if where is not None and where.skipShard(shard, docs):
+        return []
+
+    n, _ = collectionStats(docs, deleted)
+    weights = queryWeights(query, [openShard(other, docs) for other in paths], n)
+    return topK(weights, shard, docs, k, deleted, where)
+
+
+class ShardExecutor(object):
+
+    """
 
+    Searches the shards of the index in folder in parallel with a fixed-size pool of worker
+    processes. Only the shard paths are sent to the workers, which keep the shards they have
+    opened, so repeated queries do not reload them. The partial results of the shards are
+    merged into one ngram_count. With preload=True every worker opens all of the shards when
+    it starts (cheap for binary shards, which are memory mapped and shared through the page cache).
+
+    Before every query the executor checks the generation of the index, so segments added
+    (or compacted) since the last query are searched right away. A DocFilter passed as where
+    (see filters.py) is sent along and applied by the workers, and so is the field to search.
+
+    The results of every ngram are kept in a QueryCache of cache_size entries (0 to turn it off),
+    which is dropped whenever the generation changes; cache_folder keeps them on disk as well.
+    store is the TranscriptStore (or its folder) the snippets are read from, data/transcripts by default.
+
+    The executor can be shared by threads (e.g. the handlers of the SearchServer): every query works
+    on one generation of the index, and the cache, the pool and the snippet reader are only touched
+    under a lock, which is not held while the workers search. A query that times out is abandoned:
+    its caller gets a TimeoutError, the workers finish its tasks (their results are dropped), and the
+    other queries are not affected.
+
+    """
+
+    def __init__(self, folder='index', workers=None, timeout=None, preload=False, cache_size=1024,
+                 cache_folder=None, store=None):
+
+        self.folder = folder
+        self._lock = threading.Lock()
+        self.refresh()
+        self.workers = workers or min(cpu_count(), len(self.paths)) or 1
+        self.timeout = timeout
+        self.preload = preload
+        self.cache = QueryCache(cache_size, cache_folder) if cache_size else None
+        self.store = store
+        self.pool = self._start()
+        self._snippets = (None, None)
+
+    def refresh(self):
+        self.generation = indexGeneration(self.folder)
+        self.paths = findShards(self.folder)
+
+    def _start(self):
+        if self.preload:
+            return Pool(self.workers, initializer=openShards,
+                        initargs=(self.folder, self.generation, self.paths))
+        return Pool(self.workers)
+
+    def current(self):
+
+        """ (generation, shard paths) of the index, after a refresh if it changed since the last query """
+
+        with self._lock:
+            if indexGeneration(self.folder) != self.generation:
+                self.refresh()
+            if self.cache is not None:
+                # The entries on disk outlive the executor, so they are checked against the build of the index
+                self.cache.validate(self.generation, indexStamp(self.folder) if self.cache.folder is not None else None)
+            return self.generation, self.paths
+
+    def search(self, ngrams, timeout=None, by='date', where=None, field=None):
+        return self._cachedSearch(ngrams, self.current(), timeout, by, where, field)
+
+    def _cachedSearch(self, ngrams, current, timeout=None, by='date', where=None, field=None):
+
+        if self.cache is None or ngrams == '':
+            return self._search(ngrams, current, timeout, by, where, field)
+
+        analyzer = defaultAnalyzer()
+
+        # Only the ngrams that are not cached yet are searched, in a single pass over the shards.
+        # The cache may have moved on to a newer generation in the meantime, its entries are not for this query
+        counts = dict()
+        missing = []
+        with self._lock:
+            valid = self.cache.generation == current[0]
+            for ngram in splitNgrams(ngrams):
+                key = self.cache.key(analyzer.terms(ngram.decode('utf-8')), by, where, field)
+                cached = self.cache.get(key) if valid else None
+                if cached is None:
+                    missing.append((ngram, key))
+                else:
+                    counts[ngram] = cached
+
+        if missing:
+            found = self._search(u','.join(ngram.decode('utf-8') for ngram, _ in missing), current, timeout, by,
+                                 where, field)
+            with self._lock:
+                valid = self.cache.generation == current[0]
+                for ngram, key in missing:
+                    counts[ngram] = found.get(ngram, defaultdict(int))
+                    if valid:
+                        self.cache.put(key, counts[ngram])
+
+        return counts
+
+    def searchFields(self, ngrams, timeout=None, by='date', where=None):
+
+        """ {field: ngram_count} with the counts in the prepared remarks and in the Q&A (see search) """
+
+        return {field: self.search(ngrams, timeout, by, where, field) for field in FIELDS}
+
+    def query(self, text, timeout=None, by='date', where=None, field=None, explain=False):
+
+        """
+
+        Counts for a query in the query language of query_plan.py, e.g. 'guidance NOT raised,
+        "supply chain" NEAR/5 disruption field:qanda', as an ngram_count keyed by the expressions.
+        With explain=True also returns the plans with their estimated and actual work per node.
+        These results are not cached.
+
+        """
+
+        # Parsed here first, so a bad query fails before reaching the workers
+        plan = QueryPlan(text)
+
+        generation, paths = self.current()
+        tasks = [(text, path, generation, by, where, field) for path in paths]
+        results = self._map(queryShard, tasks, timeout)
+        counts = mergeCounts([ngram_count for ngram_count, _ in results])
+        for expression in plan.expressions:
+            counts.setdefault(expression.text.encode('utf-8'), defaultdict(int))
+
+        if explain:
+            return counts, plan.explain(mergeStats([stats for _, stats in results]))
+        return counts
+
+    def snippets(self, ngram, offset=0, limit=20, width=10, timeout=None, where=None, field=None):
+
+        """
+
+        One page of keyword in context snippets of the hits of an ngram, ordered by call date and
+        position: {'total': number of hits, 'offset': offset, 'snippets': [snippet]}, a snippet being a
+        dict with the doc id, key, company, ticker, date, field, paragraph, position and the left / hit /
+        right text, with up to width tokens on either side (see SnippetReader).
+
+        The hits per document come from a search by doc (and its cache), so only the documents on the
+        page are searched for positions and only the paragraphs of their hits are read.
+
+        """
+
+        if isinstance(ngram, str):
+            ngram = ngram.decode('utf-8')
+        if ',' in ngram:
+            raise ValueError('Snippets are for one ngram at a time: {}'.format(ngram))
+
+        generation, paths = current = self.current()
+        counts = self._cachedSearch(ngram, current, timeout, 'doc', where, field) or dict()
+        counts = counts.values()[0] if counts else dict()
+        docs = self._docs(generation)
+
+        # (doc, hits to skip, hits to take) of the documents on the page
+        page = []
+        seen = 0
+        for doc in sorted((doc for doc in counts if counts[doc]), key=lambda doc: (docs.dates[doc], doc)):
+            start, end = max(seen, offset), min(seen + counts[doc], offset + limit)
+            if start < end:
+                page.append((doc, start - seen, end - start))
+            seen += counts[doc]
+
+        snippets = []
+        if page:
+            hits = dict()
+            tasks = [(ngram, path, generation, [doc for doc, _, _ in page], field) for path in paths]
+            for found in self._map(hitShard, tasks, timeout):
+                hits.update(found)
+
+            # The reader keeps the last chunk of the store it read, so threads take turns
+            length = len(defaultAnalyzer().terms(ngram))
+            with self._lock:
+                reader = self._snippetReader(docs, generation)
+                snippets = [reader.snippet(doc, pos, length, width)
+                            for doc, skip, take in page for pos in hits.get(doc, [])[skip:skip + take]]
+
+        return {'total': seen, 'offset': offset, 'snippets': snippets}
+
+    def iterSnippets(self, ngram, page_size=100, width=10, where=None, field=None):
+
+        """ Yields the snippets of every hit of an ngram, fetching them page_size at a time (see snippets) """
+
+        offset = 0
+        while True:
+            page = self.snippets(ngram, offset, page_size, width, where=where, field=field)
+            for snippet in page['snippets']:
+                yield snippet
+            offset += page_size
+            if offset >= page['total'] or not page['snippets']:
+                return
+
+    def rank(self, query, k=20, timeout=None, where=None):
+
+        """
+
+        The k transcripts with the highest BM25 score for a free text query (e.g. 'supply chain
+        disruption'), best first, as dicts with the doc id, key, company, ticker, date and score.
+
+        """
+
+        generation, paths = self.current()
+        tasks = [(query, path, paths, generation, k, where) for path in paths]
+        top = mergeTop(self._map(rankShard, tasks, timeout), k)
+
+        docs = self._docs(generation)
+        return [{'id': doc, 'key': docs.keys[doc], 'company': docs.companies[doc], 'ticker': docs.tickers[doc],
+                 'date': docs.date(doc), 'score': float(score)} for score, doc in top]
+
+    def _docs(self, generation):
+        with self._lock:
+            return openState(self.folder, generation)[0]
+
+    def _snippetReader(self, docs, generation):
+
+        # The paragraph map is reloaded with the doc table whenever the generation changes, the store is kept
+        current, reader = self._snippets
+        if current != generation:
+            self.store = reader.store if reader is not None else self.store
+            self._snippets = (generation, SnippetReader(docs, openParagraphMap(self.folder), self.store))
+        return self._snippets[1]
+
+    def _search(self, ngrams, current, timeout=None, by='date', where=None, field=None):
+        generation, paths = current
+        tasks = [(ngrams, path, generation, by, where, field) for path in paths]
+        return mergeCounts(self._map(searchShard, tasks, timeout))
+
+    def _map(self, task, tasks, timeout=None):
+
+        timeout = timeout or self.timeout
+        with self._lock:
+            result = self.pool.map_async(task, tasks, chunksize=1)
+
+        # Waits in short steps, since a wait without a timeout cannot be interrupted. The pool is shared
+        # by the other queries, so on a timeout the result is only abandoned, the workers are not stopped
+        deadline = time.time() + timeout if timeout else None
+        while not result.ready():
+            result.wait(POLL_INTERVAL if deadline is None else max(0, min(POLL_INTERVAL, deadline - time.time())))
+            if not result.ready() and deadline is not None and time.time() >= deadline:
+                raise TimeoutError('The query timed out after {}s'.format(timeout))
+
+        return result.get()
+
+    def close(self):
+        with self._lock:
+            self.pool.terminate()
+            self.pool.join()
+
+
+def main(ngrams, folder='index', workers=None, timeout=None):
+
+    start = time.time()
+    executor = ShardExecutor(folder, workers=workers, timeout=timeout)
+
+    try:
+        counts = executor.search(ngrams)
+    finally:
+        executor.close()
+
+    print 'Searched {} shards with {} workers in {:.2f}s'.format(len(executor.paths),
+                                                                 executor.workers,
+                                                                 time.time() - start)
+    print counts
+    return counts
 
-main('profit margin, unexpected loss')
 
+if __name__ == '__main__':
+    main('profit margin, unexpected loss')
\ No newline at end of file
@@ -0,0 +1,242 @@
+import os
+import re
+import math
+import time
+import heapq
+import threading
+
+from build_index import InvertedIndex, parseTranscript, countTokens
+from doc_table import DOCS_FILE, PARAGRAPHS_FILE, openDocTable, openParagraphMap
+from index_format import Manifest, Shard, ShardWriter, writeBinaryIndex, findShards, lockIndex
+
+
+def openManifest(folder='index'):
+
+    """ Loads the manifest, creating one for an index built before segments existed """
+
+    manifest = Manifest.load(folder)
+    if manifest is None:
+        manifest = Manifest(folder, segments=[os.path.basename(path) for path in findShards(folder)])
+    return manifest
+
+
+def liveIds(docs, manifest):
+
+    """ Maps transcript key -> doc id for the documents that have not been removed """
+
+    ids = dict()
+    for id, key in enumerate(docs.keys):
+        if key is not None and id not in manifest.tombstones:
+            ids[key] = id
+    return ids
+
+
+def addTranscripts(transcripts, folder='index'):
+
+    """
+
+    Indexes {key: Transcript} into a new immutable segment, which is searchable as soon as the
+    manifest is saved. Transcripts whose key is already indexed are re-ingested: the old document
+    gets a tombstone and the transcript is indexed under a new id.
+
+    """
+
+    if not transcripts:
+        return None
+
+    with lockIndex(folder):
+
+        manifest = openManifest(folder)
+        docs = openDocTable(folder)
+        paragraphs = openParagraphMap(folder)
+        indexed = liveIds(docs, manifest)
+        index = InvertedIndex()
+
+        for key, transcript in transcripts.iteritems():
+            if key in indexed:
+                manifest.tombstones.add(indexed[key])
+            id = docs.addTranscript(key, transcript)
+            parsed, docs.qanda[id], starts = parseTranscript(transcript, id)
+            paragraphs.set(id, starts)
+            docs.tokens[id] = countTokens(parsed)
+            index.merge(parsed)
+
+        segment = manifest.newSegment()
+        size = writeBinaryIndex(index, os.path.join(folder, segment), docs)
+
+        # The doc table must know the new ids before the segment becomes visible
+        docs.save(os.path.join(folder, DOCS_FILE))
+        paragraphs.save(os.path.join(folder, PARAGRAPHS_FILE))
+        manifest.segments.append(segment)
+        manifest.save()
+
+    print 'Added {} transcripts in {} ({:.1f} MB)'.format(len(transcripts), segment, size / 1e+6)
+    return segment
+
+
+def removeTranscripts(keys, folder='index'):
+
+    """ Removes transcripts from search results by adding tombstones; compaction drops their postings """
+
+    with lockIndex(folder):
+        manifest = openManifest(folder)
+        indexed = liveIds(openDocTable(folder), manifest)
+        manifest.tombstones.update(indexed[key] for key in keys if key in indexed)
+        manifest.save()
+
+
+def mergeSegments(paths, dst, tombstones=(), docs=None):
+
+    """
+
+    Merges segments into one, dropping the documents in tombstones. The terms of all segments
+    are walked in sorted order, so only the postings of one term are in memory at a time.
+    Pass the DocTable to record the score bounds of the terms (see ShardWriter).
+
+    """
+
+    shards = [Shard(path) for path in paths]
+    ids = set()
+    for shard in shards:
+        ids |= shard.ids
+
+    # The date range of the merged segment covers those of the segments (unknown if any of them is)
+    ranges = [shard.dates for shard in shards]
+    dates = (min(first for first, _ in ranges), max(last for _, last in ranges)) if None not in ranges else None
+    writer = ShardWriter(dst, ids - set(tombstones), dates, docs.tokens if docs is not None else None)
+
+    def walk(shard, i):
+        for term, postings in shard.items():
+            yield term, i, postings
+
+    current, merged = None, []
+    for term, _, postings in heapq.merge(*[walk(shard, i) for i, shard in enumerate(shards)]):
+        if term != current:
+            if merged:
+                writer.add(current, merged)
+            current, merged = term, []
+        merged.extend((doc, postings.positions(i)) for i, doc in enumerate(postings.docs)
+                      if doc not in tombstones)
+
+    if merged:
+        writer.add(current, merged)
+
+    for shard in shards:
+        shard.close()
+    return writer.close()
+
+
+def isSegment(name):
+
+    """ Whether a file of the manifest is a segment written by addTranscripts or compact (segment<n>.bin) """
+
+    return re.match(r'segment\d+\.bin$', name) is not None
+
+
+def sizeTier(size, base=1e+6, factor=4):
+    return int(math.log(max(size, base) / base, factor))
+
+
+def compact(folder='index', fanout=4, max_size=1e+8, base=1e+6):
+
+    """
+
+    Size-tiered compaction: segments are grouped in tiers of size (base, base * 4, base * 16, ...)
+    and whenever a tier holds fanout segments they are merged into one segment of the next tier.
+    Only the segments added by addTranscripts (and the ones compaction made of them) are merged:
+    the shards of a full build (index<n>.bin, or text shards) are left alone, so the search still
+    fans out over them, and so are segments of max_size or more. The merged segments are removed
+    from disk by the next compaction that merges anything (see Manifest). Returns the number of
+    segments that were merged.
+
+    """
+
+    manifest = openManifest(folder)
+    started = manifest.generation
+    tiers = dict()
+    for segment in manifest.segments:
+        if not isSegment(segment):
+            continue
+        size = os.path.getsize(os.path.join(folder, segment))
+        if size < max_size:
+            tiers.setdefault(sizeTier(size, base), []).append(segment)
+
+    merged = 0
+    for tier, segments in sorted(tiers.iteritems()):
+
+        if len(segments) < fanout:
+            continue
+
+        # The name is reserved by creating the file, not by saving the manifest, which would bump
+        # the generation (and drop the caches) before anything changed
+        with lockIndex(folder):
+            manifest = openManifest(folder)
+            name = manifest.newSegment()
+            open(os.path.join(folder, name), 'wb').close()
+
+        # Segments are immutable, so the merge itself does not need the lock
+        mergeSegments([os.path.join(folder, segment) for segment in segments],
+                      os.path.join(folder, name), manifest.tombstones, openDocTable(folder))
+
+        with lockIndex(folder):
+
+            manifest = openManifest(folder)
+            if not set(segments) <= set(manifest.segments):
+                # Someone else changed these segments in the meantime (e.g. a rebuild)
+                if os.path.exists(os.path.join(folder, name)):
+                    os.remove(os.path.join(folder, name))
+                continue
+
+            first = manifest.segments.index(segments[0])
+            manifest.segments = [segment for segment in manifest.segments if segment not in segments]
+            manifest.segments.insert(first, name)
+
+            # Tombstones of documents that no segment holds anymore are no longer needed
+            # (the ids of text shards are not known without parsing them, so their tombstones are kept)
+            if all(path.endswith('.bin') for path in manifest.paths):
+                remaining = set()
+                for path in manifest.paths:
+                    shard = Shard(path)
+                    remaining |= shard.ids & manifest.tombstones
+                    shard.close()
+                manifest.tombstones = remaining
+
+            # Searches still running on the previous generation may open the merged segments, so they
+            # are only retired here, and removed by a later compaction (this one removes earlier ones)
+            expired = [segment for segment, generation in manifest.retired if generation <= started]
+            manifest.retired = [[segment, generation] for segment, generation in manifest.retired
+                                if generation > started]
+            manifest.retired.extend([segment, manifest.generation + 1] for segment in segments)
+            manifest.save()
+
+        for segment in expired:
+            try:
+                os.remove(os.path.join(folder, segment))
+            except OSError:
+                pass
+        merged += len(segments)
+
+    return merged
+
+
+class Compactor(threading.Thread):
+
+    """ Background thread that compacts the segments of the index in folder every interval seconds """
+
+    def __init__(self, folder='index', interval=60, **kwargs):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.folder = folder
+        self.interval = interval
+        self.kwargs = kwargs
+        self._halt = threading.Event()
+
+    def run(self):
+        while not self._halt.wait(self.interval):
+            start = time.time()
+            merged = compact(self.folder, **self.kwargs)
+            if merged:
+                print 'Compacted {} segments in {:.1f}s'.format(merged, time.time() - start)
+
+    def stop(self):
+        self._halt.set()
@@ -0,0 +1,319 @@
+import os
+import json
+import time
+import urllib
+import urllib2
+import urlparse
+import threading
+from datetime import datetime
+from multiprocessing import TimeoutError
+from collections import defaultdict
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+from search import ShardExecutor
+from segments import Compactor
+from filters import DocFilter
+from analysis import FIELDS
+
+
+HOST = '127.0.0.1'
+PORT = 8765
+DATE_FORMAT = '%Y-%m-%d'
+
+
+class SearchServer(ThreadingMixIn, HTTPServer):
+
+    """
+
+    Long running search server. The shards are opened once by the worker processes of a
+    ShardExecutor and stay resident, so a query only pays for the search itself. Endpoints:
+
+        GET /search?ngrams=profit margin, unexpected loss   ->  {ngram: {date: count}}
+        GET /rank?q=supply chain disruption&k=20              ->  [{id, key, company, ticker, date, score}]
+        GET /query?q=guidance NOT raised&explain=1            ->  {counts: {expression: {date: count}},
+                                                                   explain: plan text or null}
+        GET /snippets?ngram=unexpected loss&offset=0&limit=20 ->  {total, offset, snippets: [{id, key, company,
+                                                                   ticker, date, field, paragraph, position,
+                                                                   left, hit, right, missing}]}
+        GET /status                                           ->  shards, number of queries served and
+                                                                  query cache hits / misses
+
+    /search takes optional document filters (see DocFilter.fromParams), e.g.
+    &exchange=NASDAQ&start=2012-01-01&end=2014-12-31&return_30days_max=-0.05, and &field=prepared
+    or &field=qanda to only count the prepared remarks or the Q&A. /query takes a query in the
+    query language of query_plan.py, and the same filters. So does /snippets, which also takes &width
+    (tokens of context on either side of a hit), and answers 404 if the transcript store can not be read.
+
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, folder='index', host=HOST, port=PORT, workers=None, timeout=None, compact_interval=300,
+                 cache_size=1024, cache_folder=None):
+
+        self.executor = ShardExecutor(folder, workers=workers, timeout=timeout, preload=True,
+                                      cache_size=cache_size, cache_folder=cache_folder)
+        self.queries = 0
+        self._lock = threading.Lock()
+
+        # Merge the small segments added by updateIndex in the background
+        self.compactor = Compactor(folder, compact_interval) if compact_interval else None
+        if self.compactor is not None:
+            self.compactor.start()
+
+        HTTPServer.__init__(self, (host, port), SearchHandler)
+        print 'Serving {} shards with {} workers on {}:{}'.format(len(self.executor.paths),
+                                                                  self.executor.workers,
+                                                                  host, port)
+
+    def countQuery(self):
+        # Every request is handled by its own thread
+        with self._lock:
+            self.queries += 1
+
+    def search(self, ngrams, where=None, field=None):
+        self.countQuery()
+        return self.executor.search(ngrams, where=where, field=field)
+
+    def query(self, text, where=None, field=None, explain=False):
+        self.countQuery()
+        return self.executor.query(text, where=where, field=field, explain=explain)
+
+    def snippets(self, ngram, offset=0, limit=20, width=10, where=None, field=None):
+        self.countQuery()
+        return self.executor.snippets(ngram, offset, limit, width, where=where, field=field)
+
+    def rank(self, query, k=20, where=None):
+        self.countQuery()
+        return self.executor.rank(query, k, where=where)
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        self.executor.close()
+        if self.compactor is not None:
+            self.compactor.stop()
+
+
+class SearchHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+
+        url = urlparse.urlparse(self.path)
+        params = urlparse.parse_qs(url.query)
+
+        if url.path == '/search':
+            ngrams = params.get('ngrams', [''])[0].decode('utf-8')
+            field = params.get('field', [None])[0]
+            if field is not None and field not in FIELDS:
+                self.respond(400, {'error': 'Invalid field: {}'.format(field)})
+                return
+            try:
+                where = DocFilter.fromParams(params)
+            except ValueError as e:
+                self.respond(400, {'error': str(e)})
+                return
+            start = time.time()
+            try:
+                counts = self.server.search(ngrams, where, field)
+            except TimeoutError:
+                self.respond(504, {'error': 'query timed out'})
+                return
+            self.log_message('"%s" answered in %.3fs', ngrams, time.time() - start)
+            self.respond(200, {ngram: {date.strftime(DATE_FORMAT): count for date, count in dates.iteritems()}
+                               for ngram, dates in counts.iteritems()})
+        elif url.path == '/rank':
+            query = params.get('q', [''])[0].decode('utf-8')
+            try:
+                k = int(params.get('k', ['20'])[0])
+                where = DocFilter.fromParams(params)
+            except ValueError as e:
+                self.respond(400, {'error': str(e)})
+                return
+            start = time.time()
+            try:
+                results = self.server.rank(query, k, where)
+            except TimeoutError:
+                self.respond(504, {'error': 'query timed out'})
+                return
+            self.log_message('"%s" ranked in %.3fs', query, time.time() - start)
+            for result in results:
+                result['date'] = result['date'].strftime(DATE_FORMAT)
+            self.respond(200, results)
+        elif url.path == '/query':
+            text = params.get('q', [''])[0].decode('utf-8')
+            field = params.get('field', [None])[0]
+            explain = params.get('explain', ['0'])[0] not in ('', '0', 'false')
+            if field is not None and field not in FIELDS:
+                self.respond(400, {'error': 'Invalid field: {}'.format(field)})
+                return
+            start = time.time()
+            try:
+                where = DocFilter.fromParams(params)
+                result = self.server.query(text, where, field, explain)
+            except ValueError as e:
+                self.respond(400, {'error': unicode(e)})
+                return
+            except TimeoutError:
+                self.respond(504, {'error': 'query timed out'})
+                return
+            counts, plan = result if explain else (result, None)
+            self.log_message('"%s" answered in %.3fs', text, time.time() - start)
+            self.respond(200, {'counts': {ngram: {date.strftime(DATE_FORMAT): count for date, count in dates.iteritems()}
+                                          for ngram, dates in counts.iteritems()},
+                               'explain': plan})
+        elif url.path == '/snippets':
+            ngram = params.get('ngram', [''])[0].decode('utf-8')
+            field = params.get('field', [None])[0]
+            if field is not None and field not in FIELDS:
+                self.respond(400, {'error': 'Invalid field: {}'.format(field)})
+                return
+            start = time.time()
+            try:
+                offset, limit, width = [int(params.get(name, [default])[0])
+                                        for name, default in [('offset', '0'), ('limit', '20'), ('width', '10')]]
+                where = DocFilter.fromParams(params)
+                page = self.server.snippets(ngram, offset, limit, width, where, field)
+            except ValueError as e:
+                self.respond(400, {'error': unicode(e)})
+                return
+            except (KeyError, IOError) as e:
+                self.respond(404, {'error': u'Not in the transcript store: {}'.format(e)})
+                return
+            except TimeoutError:
+                self.respond(504, {'error': 'query timed out'})
+                return
+            self.log_message('"%s" snippets in %.3fs', ngram, time.time() - start)
+            for snippet in page['snippets']:
+                snippet['date'] = snippet['date'].strftime(DATE_FORMAT)
+            self.respond(200, page)
+        elif url.path == '/status':
+            self.respond(200, {'shards': self.server.executor.paths,
+                               'generation': self.server.executor.generation,
+                               'queries': self.server.queries,
+                               'cache': self.server.executor.cache.stats()
+                               if self.server.executor.cache is not None else None})
+        else:
+            self.respond(404, {'error': 'unknown endpoint {}'.format(url.path)})
+
+    def respond(self, code, body):
+
+        body = json.dumps(body)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def query(ngrams, host=HOST, port=PORT, timeout=600, where=None, field=None):
+
+    """
+
+    Client helper (e.g. for the notebook). Sends a comma separated list of ngrams (and optionally
+    a DocFilter and a field) to a running server and returns the same {ngram: {date: count}}
+    structure as search, with datetime keys.
+
+    """
+
+    if isinstance(ngrams, unicode):
+        ngrams = ngrams.encode('utf-8')
+
+    params = {'ngrams': ngrams}
+    if where is not None:
+        params.update(where.toParams())
+    if field is not None:
+        params['field'] = field
+
+    url = 'http://{}:{}/search?{}'.format(host, port, urllib.urlencode(params))
+    response = json.load(urllib2.urlopen(url, timeout=timeout))
+
+    ngram_count = dict()
+    for ngram, dates in response.iteritems():
+        ngram_count[ngram] = defaultdict(int)
+        for date, count in dates.iteritems():
+            ngram_count[ngram][datetime.strptime(date, DATE_FORMAT)] = count
+
+    return ngram_count
+
+
+def rank(query, k=20, host=HOST, port=PORT, timeout=600, where=None):
+
+    """ Client helper: the k best matching transcripts of a free text query (see ShardExecutor.rank) """
+
+    if isinstance(query, unicode):
+        query = query.encode('utf-8')
+
+    params = {'q': query, 'k': k}
+    if where is not None:
+        params.update(where.toParams())
+
+    url = 'http://{}:{}/rank?{}'.format(host, port, urllib.urlencode(params))
+    results = json.load(urllib2.urlopen(url, timeout=timeout))
+    for result in results:
+        result['date'] = datetime.strptime(result['date'], DATE_FORMAT)
+    return results
+
+
+def advancedQuery(text, host=HOST, port=PORT, timeout=600, where=None, field=None, explain=False):
+
+    """
+
+    Client helper: counts of a query in the query language of query_plan.py, with datetime keys like
+    query. With explain=True returns (counts, plan text).
+
+    """
+
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+
+    params = {'q': text, 'explain': int(explain)}
+    if where is not None:
+        params.update(where.toParams())
+    if field is not None:
+        params['field'] = field
+
+    url = 'http://{}:{}/query?{}'.format(host, port, urllib.urlencode(params))
+    response = json.load(urllib2.urlopen(url, timeout=timeout))
+
+    ngram_count = dict()
+    for ngram, dates in response['counts'].iteritems():
+        ngram_count[ngram] = defaultdict(int)
+        for date, count in dates.iteritems():
+            ngram_count[ngram][datetime.strptime(date, DATE_FORMAT)] = count
+
+    return (ngram_count, response['explain']) if explain else ngram_count
+
+
+def snippets(ngram, offset=0, limit=20, width=10, host=HOST, port=PORT, timeout=600, where=None, field=None):
+
+    """ Client helper: a page of keyword in context snippets of the hits of an ngram (see ShardExecutor.snippets) """
+
+    if isinstance(ngram, unicode):
+        ngram = ngram.encode('utf-8')
+
+    params = {'ngram': ngram, 'offset': offset, 'limit': limit, 'width': width}
+    if where is not None:
+        params.update(where.toParams())
+    if field is not None:
+        params['field'] = field
+
+    url = 'http://{}:{}/snippets?{}'.format(host, port, urllib.urlencode(params))
+    page = json.load(urllib2.urlopen(url, timeout=timeout))
+    for snippet in page['snippets']:
+        snippet['date'] = datetime.strptime(snippet['date'], DATE_FORMAT)
+    return page
+
+
+def serve(folder='index', host=HOST, port=PORT, workers=None):
+    # Query results are also kept on disk, so a restarted server starts with a warm cache
+    server = SearchServer(folder, host, port, workers=workers, cache_folder=os.path.join(folder, 'cache'))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    serve()
@@ -0,0 +1,86 @@
+import os
+import sys
+
+from analysis import TOKEN_PATTERN
+from build_index import parseTranscript
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'preprocessing'))
+from transcript_store import TranscriptStore
+
+
+STORE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'transcripts')
+
+
+def kwic(text, offset, length, width=10):
+
+    """
+
+    Keyword in context: (left, hit, right) text of a paragraph, hit being the tokens [offset, offset +
+    length) and left / right up to width tokens on either side. The paragraph is tokenized like it was
+    at index time, but only up to the end of the snippet. left + hit + right is a piece of the paragraph.
+
+    """
+
+    spans = []
+    for match in TOKEN_PATTERN.finditer(text):
+        spans.append(match.span())
+        if len(spans) == offset + length + width:
+            break
+
+    if offset + length > len(spans):
+        raise ValueError('Position {} is not in the paragraph'.format(offset))
+
+    first = spans[offset][0]
+    last = spans[offset + length - 1][1]
+    return text[spans[max(0, offset - width)][0]:first], text[first:last], text[last:spans[-1][1]]
+
+
+class SnippetReader(object):
+
+    """
+
+    Builds the snippets of hits (doc id, position): the ParagraphMap tells which paragraph holds the
+    position, and only that paragraph is read from the TranscriptStore (which decompresses its chunk,
+    keeping the last one, so hits ordered by date mostly stay in the same chunk). Documents indexed
+    before the map existed get their paragraph starts from the whole transcript, once. Documents whose
+    transcript is not in the store (no key, or added by updateIndex before the store was rewritten)
+    get snippets without text, marked as missing.
+
+    """
+
+    def __init__(self, docs, paragraphs, store=None):
+        self.docs = docs
+        self.paragraphs = paragraphs
+        self._store = store
+
+    @property
+    def store(self):
+        if not isinstance(self._store, TranscriptStore):
+            self._store = TranscriptStore(self._store or STORE_FOLDER)
+        return self._store
+
+    def snippet(self, doc, pos, length, width=10):
+
+        """
+
+        Dict with the doc id, key, company, ticker, date, field, paragraph, position, the left / hit / right
+        text and missing (True if the transcript is not in the store, the paragraph and text are then None)
+
+        """
+
+        key = self.docs.keys[doc]
+        snippet = {'id': doc, 'key': key, 'company': self.docs.companies[doc], 'ticker': self.docs.tickers[doc],
+                   'date': self.docs.date(doc), 'field': self.docs.field(doc, pos), 'paragraph': None,
+                   'position': int(pos), 'left': None, 'hit': None, 'right': None, 'missing': True}
+        if key is None or key not in self.store:
+            return snippet
+
+        located = self.paragraphs.locate(doc, pos)
+        if located is None:
+            self.paragraphs.set(doc, parseTranscript(self.store[key], doc)[2])
+            located = self.paragraphs.locate(doc, pos)
+
+        paragraph, offset = located
+        left, hit, right = kwic(self.store.paragraph(key, paragraph), offset, length, width)
+        snippet.update(paragraph=paragraph, left=left, hit=hit, right=right, missing=False)
+        return snippet
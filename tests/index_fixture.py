@@ -0,0 +1,53 @@
+import os
+import sys
+import random
+import pandas as pd
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'preprocessing'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'search'))
+from transcript_store import Transcript
+from build_index import buildIndex
+
+
+WORDS = ['profit', 'margin', 'loss', 'cut', 'cloud', 'demand', 'supply', 'chain', 'guidance', 'raised',
+         'revenue', 'growth']
+TICKERS = ['NASDAQ:AAPL', 'NASDAQ:MSFT', 'NYSE:IBM', 'NYSE:XOM', 'NYSE:BRK-B']
+
+
+def fixtureParagraph(rng, words=WORDS):
+    return ' '.join(rng.choice(words) for _ in xrange(rng.randint(3, 25))).capitalize() + '.'
+
+
+def fixtureTranscripts(n=150, seed=11):
+
+    """
+
+    {key: Transcript} of n random calls over a few words, with 1 to 3 paragraphs of prepared remarks
+    and of Q&A each. Every 10th call has the text of the call before it (so the same BM25 scores),
+    and every 13th has no returns.
+
+    """
+
+    rng = random.Random(seed)
+    transcripts = OrderedDict()
+    for key in xrange(1, n + 1):
+        if key % 10 == 0:
+            prepared, QandA = transcripts[key - 1].prepared, transcripts[key - 1].QandA
+        else:
+            prepared = pd.Series([fixtureParagraph(rng) for _ in xrange(rng.randint(1, 3))])
+            QandA = pd.Series([fixtureParagraph(rng) for _ in xrange(rng.randint(1, 3))])
+        returns = [None] * 4 if key % 13 == 0 else [rng.gauss(0, 0.05) for _ in xrange(4)]
+        ticker = rng.choice(TICKERS)
+        transcripts[key] = Transcript('Company {} ({})'.format(key, ticker), ticker,
+                                      datetime(2011, 1, 3) + timedelta(days=rng.randint(0, 4 * 365)),
+                                      *(returns + [prepared, QandA]))
+    return transcripts
+
+
+def buildFixtureIndex(folder, transcripts, batch_size=50):
+
+    """ Builds the index of transcripts in folder, one binary shard per batch_size transcripts """
+
+    return buildIndex(transcripts, folder, workers=2, batch_size=batch_size, shard_size=1)
@@ -0,0 +1,110 @@
+import os
+import sys
+import csv
+import shutil
+import random
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+from datetime import datetime
+from StringIO import StringIO
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'preprocessing'))
+from transcript_store import Transcript
+from price_store import PriceStore, FixtureProvider
+from abnormal_returns import get_tbill_historical, calculate_abnormal_returns, event_table, price_panel, \
+    batch_abnormal_returns, write_abnormal_returns, next_returns_file
+
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data')
+FIXTURES = os.path.join(DATA, 'fixtures', 'prices')
+TBILL = os.path.join(DATA, 'tbill', 'historical_tbill.csv')
+
+
+def fixture_events(n=80):
+
+    """
+
+    {key: Transcript} of n calls on the symbols of the price fixtures (all of their windows have prices,
+    IBM is listed until June 2013), plus calls with an unknown symbol, a lower case ticker and bad dates
+
+    """
+
+    rng = random.Random(3)
+    days = pd.bdate_range('2012-11-01', '2013-07-31')
+    events = []
+    for _ in xrange(n - 6):
+        ticker = rng.choice(['NASDAQ:AAPL', 'NASDAQ:MSFT', 'NYSE:IBM'])
+        last = '2013-03-01' if ticker == 'NYSE:IBM' else None
+        day = rng.choice(days[days <= last] if last else days)
+        events.append((ticker, day + pd.Timedelta(hours=rng.choice([8, 17]))))
+    events += [('NYSE:NOPE', pd.Timestamp('2013-02-14 11:00')), ('NASDAQ:aapl', pd.Timestamp('2013-02-14 11:00')),
+               ('NASDAQ:AAPL', pd.Timestamp('2000-05-01 11:00')), ('NASDAQ:AAPL', pd.Timestamp('2031-05-01 11:00')),
+               ('NASDAQ:MSFT', pd.Timestamp('2013-12-20 11:00')), ('NASDAQ:AAPL', pd.Timestamp('2013-01-02 09:00'))]
+
+    return {key: Transcript('Company {}'.format(key), ticker, date, None, None, None, None, None, None)
+            for key, (ticker, date) in enumerate(events, 1)}
+
+
+def read_rows(text):
+    return pd.read_csv(StringIO(text), names=['key', 'name', 'ticker', 'date', 'error_code', 'return_3days',
+                                              'return_30days', 'return_60days', 'return_90days'], skiprows=1)
+
+
+class AbnormalReturnsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.store = PriceStore(os.path.join(self.folder, 'prices'), FixtureProvider(FIXTURES))
+        self.tbill = get_tbill_historical(TBILL)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_batch_matches_per_transcript(self):
+
+        transcripts = fixture_events()
+
+        old = StringIO()
+        calculate_abnormal_returns(transcripts, csv.writer(old), tbill=lambda: self.tbill, store=self.store)
+
+        events = event_table(transcripts)
+        prices = price_panel([ticker.split(':')[-1] for ticker in events.ticker] + ['^GSPC'], self.store)
+        new = StringIO()
+        write_abnormal_returns(batch_abnormal_returns(events, prices, self.tbill, today=datetime.today()),
+                               csv.writer(new))
+
+        old, new = read_rows(old.getvalue()), read_rows(new.getvalue())
+        self.assertEqual(len(new), 80)
+        self.assertEqual(list(old.key), list(new.key))
+        self.assertEqual(list(old.error_code.fillna('')), list(new.error_code.fillna('')))
+        self.assertEqual(sorted(new.error_code.dropna()), ['BETA_ERROR', 'DATE_ERROR', 'DATE_ERROR', 'TICKER_ERROR'])
+
+        for column in ['return_3days', 'return_30days', 'return_60days', 'return_90days']:
+            self.assertTrue(np.array_equal(old[column].isnull(), new[column].isnull()), column)
+            self.assertTrue(np.allclose(old[column].dropna(), new[column].dropna(), rtol=0, atol=1e-12), column)
+
+    def test_missing_market(self):
+
+        events = event_table(fixture_events())
+        prices = price_panel(['AAPL', 'MSFT', 'IBM'], self.store)
+        with self.assertRaisesRegexp(ValueError, r'\^GSPC'):
+            batch_abnormal_returns(events, prices, self.tbill)
+
+        prices['^GSPC'] = np.nan
+        with self.assertRaisesRegexp(ValueError, r'\^GSPC'):
+            batch_abnormal_returns(events, prices, self.tbill)
+
+    def test_next_returns_file(self):
+
+        folder = os.path.join(self.folder, 'abnormal_returns')
+        os.makedirs(folder)
+        self.assertEqual(os.path.basename(next_returns_file(folder)), 'abnormal_returns.csv')
+        for name in ['abnormal_returns.csv', 'abnormal_returns2.csv', 'abnormal_returns10.csv', 'notes.txt']:
+            open(os.path.join(folder, name), 'wb').close()
+        self.assertEqual(os.path.basename(next_returns_file(folder)), 'abnormal_returns11.csv')
+
+
+if __name__ == '__main__':
+    unittest.main()
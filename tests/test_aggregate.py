@@ -0,0 +1,111 @@
+import os
+import sys
+import random
+import unittest
+import numpy as np
+import pandas as pd
+from datetime import datetime
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'search'))
+from doc_table import DocTable
+from aggregate import Aggregator, TIERS
+
+
+RETURNS = [-0.5, -0.10000001, -0.1, -0.05, 0.0, 0.09999999, 0.1, 0.10000001, 0.7, None]
+SECTORS = {'AAPL': 'Technology', 'MSFT': 'Technology', 'XOM': 'Energy'}
+
+
+def docTable(n=60, seed=6):
+
+    """ DocTable of n calls, with the returns of RETURNS (the tier boundaries) in turn """
+
+    rng = random.Random(seed)
+    docs = DocTable()
+    for id in xrange(n):
+        ticker = rng.choice(['NASDAQ:AAPL', 'NASDAQ:MSFT', 'NYSE:XOM', 'NYSE:IBM'])
+        # Calls from January to June 2013, none of them in March
+        date = datetime(2013, rng.choice([1, 2, 4, 5, 6]), rng.randint(1, 28), 17)
+        docs.add(id + 1, 'Company {}'.format(id), ticker, date, [('return_3days', RETURNS[id % len(RETURNS)])],
+                 tokens=rng.randint(100, 1000))
+    return docs
+
+
+class AggregatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.docs = docTable()
+        self.deleted = frozenset([3, 17, 40])
+        self.aggregator = Aggregator(self.docs, self.deleted, SECTORS)
+
+    def test_tier_boundaries(self):
+
+        labels, codes = self.aggregator.dimension('tier')
+        self.assertEqual(list(labels), TIERS)
+        expected = ['Low', 'Low', 'Mid', 'Mid', 'Mid', 'Mid', 'High', 'High', 'High', None]
+        self.assertEqual([TIERS[code] if code >= 0 else None for code in codes[:len(RETURNS)]], expected)
+
+        # Another threshold and horizon, and a horizon without any return
+        _, codes = self.aggregator.dimension('tier', threshold=0.5)
+        self.assertEqual(list(codes[:len(RETURNS)]), [1, 1, 1, 1, 1, 1, 1, 1, 2, -1])
+        _, codes = self.aggregator.dimension('tier', horizon='return_30days')
+        self.assertTrue((codes == -1).all())
+
+    def test_dimensions(self):
+
+        labels, codes = self.aggregator.dimension('month')
+        self.assertEqual([str(label) for label in labels], ['2013-01', '2013-02', '2013-03', '2013-04', '2013-05',
+                                                            '2013-06'])
+        self.assertEqual([str(labels[code]) for code in codes],
+                         [self.docs.date(id).strftime('%Y-%m') for id in xrange(len(self.docs))])
+
+        labels, codes = self.aggregator.dimension('week')
+        for id, code in enumerate(codes):
+            self.assertIn(pd.Timestamp(self.docs.date(id).date()), pd.Interval(labels[code].start_time,
+                                                                              labels[code].end_time, closed='both'))
+
+        labels, codes = self.aggregator.dimension('ticker')
+        self.assertEqual(list(labels), ['AAPL', 'IBM', 'MSFT', 'XOM'])
+        self.assertEqual([labels[code] for code in codes], [self.docs.symbol(id) for id in xrange(len(self.docs))])
+
+        labels, codes = self.aggregator.dimension('sector')
+        self.assertEqual(list(labels), ['Energy', 'Technology', 'Unknown'])
+        self.assertEqual([labels[code] for code in codes],
+                         [SECTORS.get(self.docs.symbol(id), 'Unknown') for id in xrange(len(self.docs))])
+
+        self.assertRaises(ValueError, self.aggregator.dimension, 'company')
+
+    def test_aggregate_against_pandas(self):
+
+        rng = random.Random(7)
+        counts = {'profit': {id: rng.randint(0, 4) for id in rng.sample(xrange(len(self.docs)), 40)},
+                  'loss': {}}
+
+        frame = pd.DataFrame({'month': [self.docs.date(id).strftime('%Y-%m') for id in xrange(len(self.docs))],
+                              'sector': [SECTORS.get(self.docs.symbol(id), 'Unknown') for id in xrange(len(self.docs))],
+                              'tier': [None if r is None else 'Low' if r < -0.1 else 'Mid' if r < 0.1 else 'High'
+                                       for r in (RETURNS[id % len(RETURNS)] for id in xrange(len(self.docs)))],
+                              'tokens': self.docs.tokens,
+                              'profit': [counts['profit'].get(id, 0) for id in xrange(len(self.docs))]})
+        frame = frame.drop(list(self.deleted))
+
+        for by in ['sector', 'tier', ['sector', 'tier']]:
+            result = self.aggregator.aggregate(counts, by, normalize='tokens')
+            groups = frame.dropna(subset=['tier']) if 'tier' in by else frame
+            expected = groups.groupby(by).profit.sum() / groups.groupby(by).tokens.sum()
+            found = result.profit.dropna()
+            found.index = [tuple(label) if isinstance(label, tuple) else label for label in found.index]
+            self.assertEqual(sorted(found.index), sorted(expected.index))
+            for label, value in expected.iteritems():
+                self.assertAlmostEqual(found[label], value)
+            self.assertTrue((result.loss.fillna(0) == 0).all())
+
+        # Documents with a mention per month, over the documents of the month (March has none)
+        result = self.aggregator.aggregate(counts, 'month', normalize='docs', measure='docs')
+        mentions = frame.groupby('month').profit.apply(lambda counts: (counts > 0).mean())
+        self.assertTrue(np.isnan(result.profit.iloc[2]))
+        self.assertEqual([str(label) for label in result.profit.dropna().index], list(mentions.index))
+        self.assertTrue(np.allclose(result.profit.dropna().values, mentions.values))
+
+
+if __name__ == '__main__':
+    unittest.main()
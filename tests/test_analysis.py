@@ -0,0 +1,68 @@
+import os
+import sys
+import random
+import shutil
+import tempfile
+import unittest
+from nltk.stem import PorterStemmer
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'search'))
+from analysis import StemCache
+
+
+class StemCacheTest(unittest.TestCase):
+
+    def test_lru_eviction(self):
+
+        cache = StemCache(maxsize=3)
+        for token in ['margins', 'profits', 'cuts']:
+            cache.stem(token)
+        cache.stem('margins')
+        cache.stem('growing')
+        # "profits" was the least recently used
+        self.assertEqual(list(cache._cache), ['cuts', 'margins', 'growing'])
+        self.assertEqual((cache.hits, cache.misses), (1, 4))
+
+    def test_against_reference(self):
+
+        rng = random.Random(5)
+        stemmer = PorterStemmer()
+        tokens = ['margins', 'profits', 'cuts', 'growing', 'raised', 'guidance', 'revenues', 'supplies', 'chains']
+
+        for maxsize in [1, 2, 5, 20]:
+            cache = StemCache(maxsize=maxsize)
+            recent = []
+            hits = 0
+            for _ in xrange(300):
+                token = rng.choice(tokens)
+                self.assertEqual(cache.stem(token), stemmer.stem(token))
+                if token in recent:
+                    hits += 1
+                    recent.remove(token)
+                elif len(recent) == maxsize:
+                    recent.pop(0)
+                recent.append(token)
+
+                self.assertEqual(list(cache._cache), recent)
+                self.assertEqual(len(cache), min(maxsize, len(set(recent))))
+            self.assertEqual((cache.hits, cache.misses), (hits, 300 - hits))
+
+    def test_save_load(self):
+
+        folder = tempfile.mkdtemp()
+        try:
+            path = os.path.join(folder, 'stems.p')
+            cache = StemCache(maxsize=10)
+            for token in ['margins', 'profits', 'cuts', 'growing']:
+                cache.stem(token)
+            cache.save(path)
+
+            self.assertEqual(dict(StemCache(path=path)._cache), dict(cache._cache))
+            self.assertEqual(len(StemCache(maxsize=2, path=path)), 2)
+            self.assertEqual(StemCache(path=path).stem('profits'), 'profit')
+        finally:
+            shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    unittest.main()
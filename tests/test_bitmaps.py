@@ -0,0 +1,119 @@
+import os
+import sys
+import mmap
+import random
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'search'))
+from index_fixture import fixtureTranscripts, buildFixtureIndex
+from bitmaps import DocBitmap, ARRAY_MAX, isBitmap
+from index_format import Shard, findShards, BITMAP_MIN_DF
+from search import ngramMatches
+from analysis import defaultAnalyzer
+
+
+def randomIds(rng):
+
+    """ Sorted doc ids over a few containers: empty, sparse (arrays) and dense (bitmaps) ones """
+
+    ids = set()
+    for key in rng.sample(xrange(6), rng.randint(0, 4)):
+        n = rng.choice([1, 100, ARRAY_MAX, ARRAY_MAX + 1, 20000, 65536])
+        ids.update((key << 16) + low for low in rng.sample(xrange(65536), n))
+    return sorted(ids)
+
+
+class DocBitmapTest(unittest.TestCase):
+
+    def assertBitmap(self, bitmap, ids):
+        self.assertEqual(bitmap.toArray().tolist(), sorted(ids))
+        self.assertEqual(len(bitmap), len(ids))
+        self.assertEqual(bool(bitmap), bool(ids))
+        # Every container is in its smallest form
+        for values, count in zip(bitmap.containers, bitmap.counts):
+            self.assertEqual(isBitmap(values), count > ARRAY_MAX)
+
+    def test_operations(self):
+
+        rng = random.Random(1)
+        for _ in xrange(30):
+            a, b = randomIds(rng), randomIds(rng)
+            x, y = DocBitmap.fromArray(a), DocBitmap.fromArray(b)
+            self.assertBitmap(x, a)
+            self.assertBitmap(x & y, set(a) & set(b))
+            self.assertBitmap(x | y, set(a) | set(b))
+            self.assertBitmap(x - y, set(a) - set(b))
+            self.assertBitmap(y - x, set(b) - set(a))
+
+            for doc in rng.sample(a, min(len(a), 20)) + [rng.randint(0, 6 << 16) for _ in xrange(20)]:
+                self.assertEqual(doc in x, doc in set(a))
+
+    def test_round_trip(self):
+
+        rng = random.Random(2)
+        for _ in xrange(20):
+            ids = randomIds(rng)
+            data = 'header' + DocBitmap.fromArray(ids).serialize()
+            self.assertBitmap(DocBitmap.deserialize(data, len('header')), ids)
+
+    def test_outlives_buffer(self):
+
+        ids = randomIds(random.Random(3)) + [7 << 16]
+        with tempfile.TemporaryFile() as f:
+            f.write(DocBitmap.fromArray(ids).serialize())
+            f.flush()
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            bitmap = DocBitmap.deserialize(buf)
+            buf.close()
+
+        self.assertBitmap(bitmap, ids)
+        self.assertBitmap(bitmap & DocBitmap.fromArray(ids), ids)
+
+
+class ShardBitmapTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+
+        # One shard, in which the common words have stored bitmaps and "headwinds" (in a few calls) does not
+        transcripts = fixtureTranscripts(BITMAP_MIN_DF + 200)
+        for key in xrange(5001, 5004):
+            transcripts[key] = transcripts[key - 5000]._replace(
+                prepared=pd.Series(['Headwinds hurt the profit margin, but profit margin growth recovered.']))
+
+        cls.folder = tempfile.mkdtemp()
+        buildFixtureIndex(cls.folder, transcripts, batch_size=2000)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.folder)
+
+    def test_phrase_decodes_postings_once(self):
+
+        shard = Shard(findShards(self.folder)[0])
+        decoded = []
+        decode = shard._decode
+        shard._decode = lambda offset: decoded.append(offset) or decode(offset)
+
+        words = defaultAnalyzer().terms(u'headwinds hurt the profit margin')
+        self.assertLess(shard.docFreq(words[0]), BITMAP_MIN_DF)
+        self.assertGreaterEqual(shard.docFreq(words[-1]), BITMAP_MIN_DF)
+
+        found = dict(ngramMatches(words, shard))
+        self.assertEqual(len(found), 3)
+        self.assertEqual(sorted(set(decoded)), sorted(decoded))
+        self.assertEqual(len(decoded), len(set(words)))
+
+        # Bitmaps read from the shard are still valid once it is closed
+        bitmap = shard.bitmap(words[-1])
+        docs = np.frombuffer(shard.postings(words[-1]).docs, dtype=np.uint32).tolist()
+        shard.close()
+        self.assertEqual(bitmap.toArray().tolist(), docs)
+
+
+if __name__ == '__main__':
+    unittest.main()
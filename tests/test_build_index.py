@@ -0,0 +1,104 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import pandas as pd
+from collections import OrderedDict
+from datetime import datetime
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'search'))
+from index_fixture import fixtureTranscripts, buildFixtureIndex
+from doc_table import DOCS_FILE, PARAGRAPHS_FILE, openDocTable
+from index_format import MANIFEST_FILE, findShards, openIndex
+from transcript_store import Transcript
+from build_index import parseTranscript
+from analysis import PARAGRAPH_GAP
+from search import ShardExecutor
+
+
+def transcript(prepared, qanda):
+    return Transcript('Company (NYSE:HM)', 'NYSE:HM', datetime(2013, 5, 1), None, None, None, None,
+                      pd.Series(prepared), pd.Series(qanda))
+
+
+class BuildIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_tables_saved_with_manifest(self):
+
+        buildFixtureIndex(self.folder, fixtureTranscripts(40, 1))
+
+        # Rebuild with more calls, noting what appears in the folder and when
+        renamed = []
+        rename = os.rename
+
+        def record(src, dst):
+            if os.path.dirname(os.path.abspath(dst)) == os.path.abspath(self.folder):
+                renamed.append((os.path.basename(dst), len(openDocTable(self.folder))))
+            rename(src, dst)
+
+        os.rename = record
+        try:
+            shards = buildFixtureIndex(self.folder, fixtureTranscripts(120, 2), batch_size=30)
+        finally:
+            os.rename = rename
+
+        names = [name for name, _ in renamed]
+        self.assertEqual(names, [os.path.basename(path) for path in shards] +
+                         [DOCS_FILE, PARAGRAPHS_FILE, MANIFEST_FILE])
+        # The old doc table stays until every new shard is in place
+        self.assertEqual([size for name, size in renamed if name.startswith('index')], [40] * len(shards))
+        self.assertFalse([name for name in os.listdir(self.folder) if name.startswith('runs')])
+
+        docs = openDocTable(self.folder)
+        self.assertEqual(len(docs), 120)
+        self.assertEqual(sorted(findShards(self.folder)), sorted(shards))
+        for path in shards:
+            shard = openIndex(path)
+            self.assertTrue(shard.docFreq('profit'))
+            shard.close()
+
+
+class ParseTranscriptTest(unittest.TestCase):
+
+    # "cloud demand" and "profit margin" only span a paragraph break, then the prepared remarks / Q&A break
+    CALLS = [transcript(['Revenue grew on cloud', 'demand stayed strong and profit'], ['margin questions']),
+             transcript(['Cloud demand lifted the profit margin.'], ['No questions.'])]
+
+    def test_positions(self):
+
+        parsed, qanda, paragraphs = parseTranscript(self.CALLS[0], 7)
+        self.assertEqual(paragraphs, [0, 4 + PARAGRAPH_GAP, 9 + 2 * PARAGRAPH_GAP])
+        self.assertEqual(qanda, paragraphs[2])
+        self.assertEqual(parsed['cloud'], [7, ['3']])
+        self.assertEqual(parsed['demand'], [7, [str(paragraphs[1])]])
+        self.assertEqual(parsed['margin'], [7, [str(qanda)]])
+
+    def test_phrases_stay_in_paragraphs(self):
+
+        folder = tempfile.mkdtemp()
+        try:
+            buildFixtureIndex(folder, OrderedDict(enumerate(self.CALLS, 1)))
+            executor = ShardExecutor(folder, workers=1, cache_size=0)
+            try:
+                hits = lambda counts: {doc: count for doc, count in counts.iteritems() if count}
+                for field in [None, 'prepared', 'qanda']:
+                    counts = executor.search('cloud demand, profit margin, demand stayed', by='doc', field=field)
+                    self.assertEqual(hits(counts['cloud demand']), {1: 1} if field != 'qanda' else {})
+                    self.assertEqual(hits(counts['profit margin']), {1: 1} if field != 'qanda' else {})
+                    self.assertEqual(hits(counts['demand stayed']), {0: 1} if field != 'qanda' else {})
+                self.assertEqual(hits(executor.query('cloud NEAR/1 demand', by='doc')['cloud NEAR/1 demand']), {1: 1})
+            finally:
+                executor.close()
+        finally:
+            shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+from datetime import datetime
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'preprocessing'))
+from price_store import PriceStore, FixtureProvider
+from abnormal_returns import get_tbill_historical, event_table, price_panel
+from event_study import EventStudy, Window, horizon, drift, estimation
+from test_abnormal_returns import fixture_events, FIXTURES, TBILL
+
+
+WINDOWS = [horizon(1), horizon(3), horizon(60), horizon(200), drift(10), Window('after', 2, 5)]
+ESTIMATIONS = [estimation(30), estimation(60)]
+
+
+def naive_study(events, prices, tbill, windows, estimations, today, min_observations=10):
+
+    """ {(key, column): value} of the event study, one event and one window at a time straight from the panel """
+
+    market = prices['^GSPC'].dropna()
+    days = market.index
+    rate = tbill.rate.reindex(days, method='pad').fillna(0.) / 252
+    results = dict()
+
+    for _, event in events.iterrows():
+
+        date = pd.Timestamp(event.date)
+        symbol = event.ticker.split(':')[-1]
+        if date >= today or date < datetime(2001, 7, 31):
+            results[event.key, 'error_code'] = 'DATE_ERROR'
+            continue
+        if event.ticker != event.ticker.upper():
+            results[event.key, 'error_code'] = 'TICKER_ERROR'
+            continue
+        if symbol not in prices.columns:
+            results[event.key, 'error_code'] = 'BETA_ERROR'
+            continue
+
+        stock = prices[symbol].reindex(days)
+        day = days.searchsorted(date.normalize())
+
+        betas = dict()
+        for window in estimations:
+            start, end = day + window.start, day + window.end
+            beta = np.nan
+            if 0 <= start < end < len(days):
+                returns = pd.DataFrame({'stock': stock.pct_change(), 'market': market.pct_change()})
+                returns = returns.iloc[start + 1:end + 1].dropna()
+                if len(returns) >= min_observations:
+                    beta = np.cov(returns.stock, returns.market)[0, 1] / returns.market.var()
+            betas[window.name] = results[event.key, window.name] = beta
+
+        error = any(np.isnan(beta) for beta in betas.itervalues())
+        results[event.key, 'error_code'] = 'BETA_ERROR' if error else None
+
+        for window in windows:
+            start, end = day + window.start, day + window.end
+            for beta in estimations:
+                column = '{}_{}'.format(window.name, beta.name) if len(estimations) > 1 else window.name
+                value = np.nan
+                if not error and 0 <= start < end < len(days):
+                    risk_free = rate.iloc[start + 1:end + 1].sum()
+                    market_return = market.iloc[end] / market.iloc[start] - 1
+                    value = stock.iloc[end] / stock.iloc[start] - 1 - \
+                        (risk_free + betas[beta.name] * (market_return - risk_free))
+                results[event.key, column] = value
+
+    return results
+
+
+class EventStudyTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+
+        cls.folder = tempfile.mkdtemp()
+        store = PriceStore(os.path.join(cls.folder, 'prices'), FixtureProvider(FIXTURES))
+        cls.events = event_table(fixture_events())
+        cls.prices = price_panel([ticker.split(':')[-1] for ticker in cls.events.ticker] + ['^GSPC'], store)
+        cls.tbill = get_tbill_historical(TBILL)
+        cls.study = EventStudy(cls.prices, cls.tbill)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.folder)
+
+    def assertStudy(self, windows, estimations):
+
+        today = pd.Timestamp(datetime.today())
+        table = self.study.run(self.events, windows, estimations, today=today)
+        expected = naive_study(self.events, self.prices, self.tbill, windows, estimations, today)
+
+        self.assertEqual(list(table.key), list(self.events.key))
+        columns = [column for column in table.columns if column not in ('key', 'name', 'ticker', 'date')]
+        self.assertEqual(sorted(set(column for _, column in expected)), sorted(columns))
+
+        for _, row in table.iterrows():
+            self.assertEqual(row.error_code, expected[row.key, 'error_code'], row.key)
+            for column in columns:
+                if column == 'error_code' or (row.key, column) not in expected:
+                    continue
+                value = expected[row.key, column]
+                if np.isnan(value):
+                    self.assertTrue(np.isnan(row[column]), (row.key, column))
+                else:
+                    self.assertAlmostEqual(row[column], value, places=10, msg=(row.key, column))
+        return table
+
+    def test_windows(self):
+
+        # The 60 day estimation window reaches before the first price of the early calls
+        table = self.assertStudy(WINDOWS, ESTIMATIONS)
+        self.assertGreater(table.error_code.eq('BETA_ERROR').sum(), 1)
+
+        # The long horizon runs out of prices for the late calls, the short ones do not
+        valid = table.error_code.isnull()
+        self.assertTrue(table[valid]['return_3days_beta_30days'].notnull().all())
+        self.assertTrue(table[valid]['return_200days_beta_30days'].isnull().any())
+        self.assertTrue(table[valid]['return_200days_beta_30days'].notnull().any())
+
+    def test_one_estimation(self):
+
+        table = self.assertStudy([horizon(3), drift(5)], [estimation(30)])
+        self.assertEqual(sorted(table.error_code.dropna()), ['BETA_ERROR', 'DATE_ERROR', 'DATE_ERROR', 'TICKER_ERROR'])
+        self.assertEqual(list(table.columns), ['key', 'name', 'ticker', 'date', 'error_code', 'beta_30days',
+                                               'return_3days', 'drift_5days'])
+
+    def test_windows_outside_history(self):
+
+        # Estimation windows that start before the first price make every event a BETA_ERROR
+        table = self.study.run(self.events, [horizon(3)], [estimation(5000)])
+        self.assertTrue(table.error_code.notnull().all())
+        self.assertTrue(table.return_3days.isnull().all())
+
+    def test_missing_market(self):
+        with self.assertRaisesRegexp(ValueError, r'\^GSPC'):
+            EventStudy(self.prices.drop('^GSPC', axis=1), self.tbill)
+
+
+if __name__ == '__main__':
+    unittest.main()
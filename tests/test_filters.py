@@ -0,0 +1,126 @@
+import os
+import sys
+import random
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+from datetime import datetime
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'search'))
+from index_fixture import TICKERS, fixtureTranscripts, buildFixtureIndex
+from doc_table import RETURNS, openDocTable
+from index_format import findShards, openIndex
+from filters import DocFilter
+
+
+def randomFilter(rng):
+
+    symbols = [ticker.split(':')[-1] for ticker in TICKERS]
+    start = datetime(2011, 1, 1) + pd.Timedelta(days=rng.randint(0, 4 * 365))
+    returns = dict()
+    for column in rng.sample(RETURNS, rng.choice([0, 0, 1, 2])):
+        returns[column] = rng.choice([(None, 0.0), (-0.05, None), (-0.05, 0.05), (0.0, 0.0)])
+
+    return DocFilter(tickers=rng.choice([None, rng.sample(TICKERS + symbols + ['NYSE:NOPE'], rng.randint(1, 3))]),
+                     exchanges=rng.choice([None, ['NYSE'], ['NASDAQ', 'LSE']]),
+                     start=rng.choice([None, start, start.strftime('%Y-%m-%d')]),
+                     end=rng.choice([None, start + pd.Timedelta(days=rng.randint(0, 500))]),
+                     returns=returns)
+
+
+class DocFilterTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+
+        # Calls in date order, so the shards cover consecutive date ranges
+        transcripts = fixtureTranscripts(200)
+        transcripts = OrderedDict(sorted(transcripts.items(), key=lambda item: item[1].date))
+        cls.folder = tempfile.mkdtemp()
+        buildFixtureIndex(cls.folder, transcripts, batch_size=40)
+        cls.docs = openDocTable(cls.folder)
+        cls.shards = [openIndex(path) for path in findShards(cls.folder)]
+
+        cls.frame = pd.DataFrame({'ticker': [transcript.ticker for transcript in transcripts.itervalues()],
+                                  'date': [transcript.date for transcript in transcripts.itervalues()]})
+        for column in RETURNS:
+            cls.frame[column] = [getattr(transcript, column) for transcript in transcripts.itervalues()]
+        cls.frame[RETURNS] = cls.frame[RETURNS].astype(np.float64)
+
+    @classmethod
+    def tearDownClass(cls):
+        for shard in cls.shards:
+            shard.close()
+        shutil.rmtree(cls.folder)
+
+    def expected(self, where):
+
+        """ The ids that pass, with a pandas filter over the transcripts """
+
+        frame = self.frame
+        keep = pd.Series(True, index=frame.index)
+        if where.tickers is not None:
+            symbols = set(ticker.split(':')[-1] for ticker in where.tickers)
+            keep &= frame.ticker.str.split(':').str[-1].isin(symbols)
+        if where.exchanges is not None:
+            keep &= frame.ticker.str.split(':').str[0].isin(where.exchanges)
+        if where.start is not None:
+            keep &= frame.date >= datetime.fromordinal(where.start)
+        if where.end is not None:
+            keep &= frame.date < datetime.fromordinal(where.end + 1)
+        for column, (low, high) in where.returns.iteritems():
+            keep &= frame[column].notnull()
+            if low is not None:
+                keep &= frame[column] >= low
+            if high is not None:
+                keep &= frame[column] <= high
+        return list(frame.index[keep])
+
+    def test_mask(self):
+
+        rng = random.Random(9)
+        for _ in xrange(200):
+            where = randomFilter(rng)
+            self.assertEqual(list(np.flatnonzero(where.mask(self.docs))), self.expected(where), where)
+            self.assertEqual(where.bitmap(self.docs).toArray().tolist(), self.expected(where), where)
+
+            # The query string parameters describe the same filter
+            params = dict((name, [value]) for name, value in where.toParams().iteritems())
+            again = DocFilter.fromParams(params)
+            if where.empty():
+                self.assertIsNone(again)
+            else:
+                self.assertEqual(list(np.flatnonzero(again.mask(self.docs))), self.expected(where))
+
+    def test_skip_shard(self):
+
+        rng = random.Random(10)
+        skipped = 0
+        for _ in xrange(200):
+            where = randomFilter(rng)
+            passing = set(self.expected(where))
+            for shard in self.shards:
+                skip = where.skipShard(shard, self.docs)
+                self.assertEqual(skip, not passing & shard.ids, where)
+                skipped += skip
+
+        self.assertTrue(skipped)
+
+        # A date range outside of the shard is enough, its ids are not looked at
+        shard = self.shards[0]
+        first, last = shard.dates
+        where = DocFilter(start=datetime.fromordinal(last + 1))
+        shard.docIds = None
+        try:
+            self.assertTrue(where.skipShard(shard, self.docs))
+        finally:
+            del shard.docIds
+        self.assertFalse(DocFilter(start=datetime.fromordinal(first), end=datetime.fromordinal(first))
+                         .skipShard(shard, self.docs))
+
+
+if __name__ == '__main__':
+    unittest.main()
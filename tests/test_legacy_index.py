@@ -0,0 +1,79 @@
+import os
+import sys
+import glob
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'search'))
+from doc_table import DocTable, DOCS_FILE, openDocTable
+from build_index import readIndexFromFile
+from index_format import convertIndex
+from search import ShardExecutor
+
+
+# A shard of the first version of the index: IBM-2013-3-7 is not in the doc table
+SHARD = '''profit||AAPL-2013-1-5:0,7;IBM-2013-3-7:2;MSFT-2013-2-6:4
+cut||AAPL-2013-1-5:1;IBM-2013-3-7:3,9
+loss||MSFT-2013-2-6:5
+'''
+
+
+class LegacyIndexTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.folder = tempfile.mkdtemp()
+        docs = DocTable()
+        docs.add(1, 'Apple', 'NASDAQ:AAPL', datetime(2013, 1, 5), tokens=10)
+        docs.add(2, 'Microsoft', 'NASDAQ:MSFT', datetime(2013, 2, 6), tokens=12)
+        docs.save(os.path.join(self.folder, DOCS_FILE))
+
+        self.path = os.path.join(self.folder, 'index.txt')
+        with open(self.path, 'wb') as f:
+            f.write(SHARD)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_needs_doc_table(self):
+        self.assertRaises(ValueError, readIndexFromFile, self.path)
+        self.assertRaises(ValueError, convertIndex, self.path)
+
+    def test_unknown_ids_are_not_added_by_readers(self):
+
+        docs = openDocTable(self.folder)
+        self.assertRaises(ValueError, readIndexFromFile, self.path, docs)
+        self.assertEqual(len(docs), 2)
+
+        executor = ShardExecutor(self.folder, workers=2)
+        try:
+            self.assertRaises(ValueError, executor.search, 'profit cut', by='doc')
+        finally:
+            executor.close()
+
+    def test_converted(self):
+
+        # The upgrade path of python index_format.py
+        docs = openDocTable(self.folder)
+        for path in glob.glob(os.path.join(self.folder, 'index*.txt')):
+            convertIndex(path, docs=docs)
+        docs.save(os.path.join(self.folder, DOCS_FILE))
+
+        docs = openDocTable(self.folder)
+        self.assertEqual(len(docs), 3)
+        ibm = docs.idFor('IBM-2013-3-7', add=False)
+
+        executor = ShardExecutor(self.folder, workers=2)
+        try:
+            counts = executor.search('profit cut, profit', by='doc')
+            self.assertEqual(dict(counts['profit cut']), {0: 1, ibm: 1})
+            self.assertEqual(sorted(counts['profit']), [0, 1, ibm])
+            self.assertEqual(sorted(call['id'] for call in executor.rank('profit cut', k=5)), [0, 1, ibm])
+        finally:
+            executor.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import pandas as pd
+from datetime import datetime
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'preprocessing'))
+from transcript_store import Transcript, TranscriptStore, write_store, RETURNS
+from map_returns_to_transcript import map_store
+
+
+CALLS = [('Apple Inc. (NASDAQ:AAPL)', 'NASDAQ:AAPL', datetime(2013, 1, 23, 17)),
+         ('Microsoft Corporation (NASDAQ:MSFT)', 'NASDAQ:MSFT', datetime(2013, 1, 24, 17)),
+         ('Exxon Mobil Corporation (NYSE:XOM)', 'NYSE:XOM', datetime(2013, 4, 25, 11))]
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class MapReturnsTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.folder = tempfile.mkdtemp()
+        self.store = os.path.join(self.folder, 'transcripts')
+        self.returns = os.path.join(self.folder, 'abnormal_returns')
+        os.makedirs(self.returns)
+
+        # A store converted from the pickle: metadata.csv is the only table
+        write_store({key: Transcript(company, ticker, date, None, None, None, None,
+                                     pd.Series(['{} prepared remarks'.format(company)]),
+                                     pd.Series(['A question', 'An answer']))
+                     for key, (company, ticker, date) in enumerate(CALLS, 1)}, self.store)
+
+        # Returns of the first and the last call, the second one failed
+        rows = [[1, CALLS[0][0], CALLS[0][1], CALLS[0][2], None, 0.01, 0.02, 0.03, 0.04],
+                [2, CALLS[1][0], CALLS[1][1], CALLS[1][2], 3, None, None, None, None],
+                [3, CALLS[2][0], CALLS[2][1], CALLS[2][2], None, -0.01, -0.02, -0.03, -0.04]]
+        pd.DataFrame(rows, columns=['key', 'name', 'ticker', 'date', 'error_code'] + RETURNS).to_csv(
+            os.path.join(self.returns, 'abnormal_returns.csv'), index=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_second_run_leaves_store_unchanged(self):
+
+        map_store(self.store, self.returns)
+        mapped = read(os.path.join(self.store, 'metadata.csv'))
+
+        store = TranscriptStore(self.store)
+        self.assertEqual(sorted(store.keys()), [1, 3])
+        self.assertEqual(store[3].return_90days, -0.04)
+        self.assertEqual(list(store[3].prepared), ['Exxon Mobil Corporation (NYSE:XOM) prepared remarks'])
+        self.assertEqual(len(TranscriptStore(self.store, 'parsed.csv')), 3)
+
+        map_store(self.store, self.returns)
+        self.assertEqual(read(os.path.join(self.store, 'metadata.csv')), mapped)
+        self.assertEqual(len(TranscriptStore(self.store, 'parsed.csv')), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,179 @@
+import os
+import sys
+import gzip
+import random
+import shutil
+import tempfile
+import unittest
+import pandas as pd
+from bs4 import BeautifulSoup
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'preprocessing'))
+from parse_data import html_to_text, split_transcripts, clean_file, clean_data
+from transcript_store import Transcript
+
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'fixtures')
+
+
+def soup_text(line):
+    return BeautifulSoup(line).get_text()
+
+
+def soup_split_transcripts(df):
+
+    """ The transcripts of split_transcripts as the BeautifulSoup implementation parsed them, one at a time """
+
+    end_of_transcripts = df[df.text == 'END OF TRANSCRIPT'].index
+
+    transcripts = {}
+    last_end = -1
+    n_transcript = 1
+
+    for end in end_of_transcripts:
+
+        transcript = df[(last_end + 1):end].reset_index(drop=True)
+        last_end = end
+
+        if len(transcript) <= 4:
+            continue
+
+        company = soup_text(transcript.iloc[0].values[0])
+        if len(company) < 1 or company[-1] != ')':
+            continue
+
+        open_paren = company.rfind('(')
+        close_paren = company.find(')', open_paren)
+        ticker = company[open_paren + 1:close_paren]
+
+        try:
+            date = pd.to_datetime(soup_text(transcript.iloc[2].values[0]))
+        except ValueError:
+            continue
+
+        try:
+            begin_q_and_a = transcript[transcript.text.str.contains('id=question-answer-session')].index[0]
+        except IndexError:
+            continue
+
+        transcripts[n_transcript] = Transcript(company=company,
+                                               ticker=ticker,
+                                               date=date,
+                                               return_3days=None,
+                                               return_30days=None,
+                                               return_60days=None,
+                                               return_90days=None,
+                                               prepared=transcript[3:begin_q_and_a].text.map(soup_text),
+                                               QandA=transcript[begin_q_and_a:].text.map(soup_text))
+        n_transcript += 1
+
+    return transcripts
+
+
+def baseline_clean(data):
+
+    """ The cleaned lines of one raw file as clean_data wrote them when it read whole files """
+
+    out = []
+    for i, line in enumerate(data.split('\r\n')):
+        if i == 0:
+            continue
+        line = line.replace('"', '')
+        if len(line) > 18 or line == 'END OF TRANSCRIPT':
+            out.append('"{}"\n'.format(line))
+    return ''.join(out)
+
+
+def random_raw(rng):
+
+    """ A raw file: a header, then lines of any length with quotes and commas, ends of transcripts and blank lines """
+
+    lines = ['text']
+    for _ in xrange(rng.randint(0, 60)):
+        lines.append(rng.choice(['END OF TRANSCRIPT', '', '"', '<p>Short</p>',
+                                 ''.join(rng.choice('ab ",<>\r') for _ in xrange(rng.randint(0, 40)))]))
+    return '\r\n'.join(lines) + rng.choice(['', '\r\n'])
+
+
+class CleanDataTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write_raw(self, path, data):
+        with gzip.open(path, 'wb') as f:
+            f.write(data)
+
+    def test_clean_file(self):
+
+        rng = random.Random(7)
+        raw = os.path.join(self.folder, 'raw.gz')
+        part = os.path.join(self.folder, 'part.csv')
+
+        for data in ['', 'text', 'text\r\n', 'text\r\nEND OF TRANSCRIPT'] + [random_raw(rng) for _ in xrange(100)]:
+            self.write_raw(raw, data)
+            # Blocks that split lines and line breaks anywhere
+            for block_size in [1, 2, 3, 17, 1 << 20]:
+                self.assertEqual(clean_file((raw, part, block_size)), (part, os.path.getsize(raw), len(data)))
+                with open(part, 'rb') as f:
+                    self.assertEqual(f.read(), baseline_clean(data), (data, block_size))
+
+    def test_clean_data(self):
+
+        rng = random.Random(8)
+        raw_folder = os.path.join(self.folder, 'raw_data')
+        os.makedirs(raw_folder)
+        for i in xrange(5):
+            self.write_raw(os.path.join(raw_folder, 'raw{}.csv.gz'.format(i)), random_raw(rng))
+
+        clean_data(self.folder, 'raw_data', workers=2, block_size=5)
+
+        expected = 'text\n'
+        for name in os.listdir(raw_folder):
+            with gzip.open(os.path.join(raw_folder, name), 'rb') as f:
+                expected += baseline_clean(f.read())
+        with open(os.path.join(self.folder, 'clean_data.csv'), 'rb') as f:
+            self.assertEqual(f.read(), expected)
+        self.assertEqual(sorted(os.listdir(self.folder)), ['clean_data.csv', 'raw_data'])
+
+
+class ParseDataTest(unittest.TestCase):
+
+    def setUp(self):
+        self.df = pd.read_csv(os.path.join(FIXTURES, 'clean_data.csv'))
+
+    def test_html_to_text(self):
+
+        text = self.df.text
+        self.assertEqual(list(html_to_text(text)), list(text.map(soup_text)))
+
+        # Lines made of random pieces of the fixture, tags and entities
+        rng = random.Random(11)
+        pieces = ['<p>', '</p>', '<b>', '</strong>', '<br/>', '&amp;', '&lt;', '&#65;', '&nbsp;', '&foo;', '<', '>',
+                  '  ', 'R&D', '<!-- x -->', '<span class=a>', '\xc3\xa9'] + \
+            [word for line in text for word in line.split()[:3]]
+        lines = pd.Series([''.join(rng.choice(pieces) + rng.choice(['', ' ']) for _ in xrange(rng.randint(1, 12)))
+                           for _ in xrange(2000)])
+        self.assertEqual(list(html_to_text(lines)), list(lines.map(soup_text)))
+
+    def test_split_transcripts(self):
+
+        expected = soup_split_transcripts(self.df)
+        found = split_transcripts(FIXTURES, 'clean_data.csv', workers=2, chunk_size=2)
+
+        self.assertEqual(sorted(found), sorted(expected))
+        self.assertEqual([expected[key].ticker for key in sorted(expected)],
+                         ['NASDAQ:AAPL', 'NYSE:XOM', 'LSE:EQP', 'NYSE:MTC', 'NASDAQ:GOOG'])
+        for key in expected:
+            for column in ['company', 'ticker', 'date', 'return_3days']:
+                self.assertEqual(getattr(found[key], column), getattr(expected[key], column))
+            for column in ['prepared', 'QandA']:
+                self.assertEqual(list(getattr(found[key], column)), list(getattr(expected[key], column)))
+                self.assertEqual(list(getattr(found[key], column).index), list(getattr(expected[key], column).index))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+import os
+import sys
+import gzip
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'preprocessing'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'search'))
+from transcript_store import TranscriptStore
+from price_store import PriceStore, FixtureProvider
+from pipeline import Pipeline, load_json
+from doc_table import openDocTable
+
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data')
+FIXTURES = os.path.join(DATA, 'fixtures', 'prices')
+TBILL = os.path.join(DATA, 'tbill', 'historical_tbill.csv')
+
+# (company, date) of the calls in every raw file; there are prices for AAPL and MSFT (see data/fixtures/prices)
+CALLS = {'a': [('Apple Inc. (NASDAQ:AAPL)', datetime(2013, 1, 23)), ('Microsoft Corporation (NASDAQ:MSFT)',
+                                                                     datetime(2013, 1, 24))],
+         'b': [('Apple Inc. (NASDAQ:AAPL)', datetime(2013, 4, 23)), ('Exxon Mobil Corporation (NYSE:XOM)',
+                                                                     datetime(2013, 4, 25))],
+         'c': [('Microsoft Corporation (NASDAQ:MSFT)', datetime(2013, 4, 18))]}
+
+
+def raw_lines(company, date):
+    return ['<p><strong>{}</strong></p>'.format(company),
+            '<p>Earnings Conference Call Transcript</p>',
+            '<p>{:%B %d, %Y} 5:00 PM ET</p>'.format(date),
+            '<p>Revenue for the quarter of {} grew, and so did the profit margin.</p>'.format(company),
+            '<p>We expect supply chain costs to decline in the coming quarter.</p>',
+            '<p id="question-answer-session"><strong>Question-and-Answer Session</strong></p>',
+            '<p>Can you talk about the guidance for {:%Y}, please?</p>'.format(date),
+            '<p>We do not give guidance beyond the next quarter, sorry.</p>',
+            'END OF TRANSCRIPT']
+
+
+def write_raw(folder, name, calls=None):
+
+    """ A raw data file in the format of the scraper (a header, then lines separated by CRLF), or a broken one """
+
+    with gzip.open(os.path.join(folder, '{}.csv.gz'.format(name)), 'wb') as f:
+        if calls is None:
+            f.write('text\r\n' + '<p>a line' * 1000)
+            f.close()
+            with open(f.name, 'r+b') as broken:
+                broken.truncate(40)
+            return
+        f.write('\r\n'.join(['text'] + [line for company, date in calls for line in raw_lines(company, date)]))
+
+
+class PipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.raw = os.path.join(self.folder, 'raw_data')
+        self.transcripts = os.path.join(self.folder, 'transcripts')
+        self.index = os.path.join(self.folder, 'index')
+        os.makedirs(self.raw)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def pipeline(self):
+        return Pipeline(os.path.join(self.folder, 'pipeline'), self.raw, workers=1,
+                        store=PriceStore(os.path.join(self.folder, 'prices'), FixtureProvider(FIXTURES)),
+                        transcripts=self.transcripts, index=self.index, tbill_file=TBILL)
+
+    def mtimes(self, stage):
+        folder = os.path.join(self.folder, 'pipeline', stage)
+        return {name: os.path.getmtime(os.path.join(folder, name)) for name in os.listdir(folder)}
+
+    def test_resume_and_rebuild_changed(self):
+
+        # Interrupted by a broken raw file: the partition before it is kept
+        write_raw(self.raw, 'a', CALLS['a'])
+        write_raw(self.raw, 'b')
+        self.assertRaises(IOError, self.pipeline().run)
+        self.assertEqual(list(load_json(os.path.join(self.folder, 'pipeline', 'state', 'clean.json'))['outputs']),
+                         ['a.csv.gz'])
+
+        # Only the file that failed is cleaned when the run is started again
+        cleaned = self.mtimes('clean')
+        write_raw(self.raw, 'b', CALLS['b'])
+        self.pipeline().run()
+        self.assertEqual(self.mtimes('clean')['a.csv'], cleaned['a.csv'])
+
+        store = TranscriptStore(self.transcripts)
+        self.assertEqual(sorted(store.metadata.ticker), ['NASDAQ:AAPL', 'NASDAQ:AAPL', 'NASDAQ:MSFT'])
+        self.assertFalse(store.metadata.return_3days.isnull().any())
+        self.assertEqual(len(openDocTable(self.index)), 3)
+
+        # A new raw file, and a run that stops after the parse stage: the store still opens, with the returns
+        # of the transcripts that were mapped before, pointing at the paragraphs of the rewritten store
+        cleaned, parsed = self.mtimes('clean'), self.mtimes('parse')
+        write_raw(self.raw, 'c', CALLS['c'])
+        self.pipeline().run(['clean', 'parse'])
+
+        self.assertEqual(self.mtimes('clean')['b.csv'], cleaned['b.csv'])
+        self.assertEqual(self.mtimes('parse')['a.p'], parsed['a.p'])
+
+        interrupted = TranscriptStore(self.transcripts)
+        self.assertEqual(sorted(interrupted.metadata.key), sorted(store.metadata.key))
+        self.assertEqual(list(interrupted.metadata.sort_index().return_30days),
+                         list(store.metadata.sort_index().return_30days))
+        for key in store.keys():
+            self.assertEqual(list(interrupted[key].QandA), list(store[key].QandA))
+
+        self.pipeline().run()
+        store = TranscriptStore(self.transcripts)
+        self.assertEqual(sorted(store.metadata.ticker), ['NASDAQ:AAPL', 'NASDAQ:AAPL', 'NASDAQ:MSFT', 'NASDAQ:MSFT'])
+        self.assertEqual(len(openDocTable(self.index)), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
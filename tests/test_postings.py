@@ -0,0 +1,72 @@
+import os
+import sys
+import random
+import unittest
+from array import array
+from bisect import bisect_left
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'search'))
+from postings import gallop, intersect, phraseMatches, fromLists
+
+
+def randomSorted(rng, n, high):
+    return array('I', sorted(rng.sample(xrange(high), min(n, high))))
+
+
+class PostingsTest(unittest.TestCase):
+
+    def test_gallop(self):
+
+        rng = random.Random(1)
+        for _ in xrange(200):
+            values = randomSorted(rng, rng.randint(0, 300), 1000)
+            for _ in xrange(20):
+                target = rng.randint(-5, 1005)
+                lo = rng.randint(0, len(values))
+                self.assertEqual(gallop(values, target, lo), max(lo, bisect_left(values, target)))
+
+    def test_intersect(self):
+
+        rng = random.Random(2)
+        self.assertEqual(intersect([]), [])
+        for _ in xrange(300):
+            lists = [randomSorted(rng, rng.choice([0, 1, 5, 50, 400]), rng.choice([50, 1000]))
+                     for _ in xrange(rng.randint(1, 4))]
+            common = set(lists[0]).intersection(*lists[1:])
+
+            matches = intersect(lists)
+            self.assertEqual([doc for doc, _ in matches], sorted(common))
+            for doc, indices in matches:
+                self.assertEqual([values[j] for values, j in zip(lists, indices)], [doc] * len(lists))
+
+    def test_phrase_matches(self):
+
+        self.assertEqual(phraseMatches([(0, [2, 10]), (1, [3]), (2, [4, 8, 12, 29]), (3, [5])]), [2])
+
+        rng = random.Random(3)
+        for _ in xrange(500):
+            # Words of a phrase, some of them repeated, over a short document so that matches are common
+            length = rng.randint(1, 4)
+            words = [rng.randint(0, 2) for _ in xrange(length)]
+            size = rng.choice([5, 20, 60])
+            text = [rng.randint(0, 2) for _ in xrange(size)]
+            positions = dict((word, array('I', [pos for pos, other in enumerate(text) if other == word]))
+                             for word in words)
+            if not all(positions.values()):
+                continue
+
+            expected = [start for start in xrange(size - length + 1) if text[start:start + length] == words]
+            locs = [(offset, positions[word]) for offset, word in enumerate(words)]
+            rng.shuffle(locs)
+            self.assertEqual(phraseMatches(locs), expected)
+
+    def test_from_lists(self):
+
+        postings = fromLists([(7, ['3', '1']), (2, [5]), (7, [1, 9])])
+        self.assertEqual(list(postings.docs), [2, 7])
+        self.assertEqual(list(postings.freqs), [1, 3])
+        self.assertEqual([list(postings.positions(i)) for i in xrange(len(postings))], [[5], [1, 3, 9]])
+
+
+if __name__ == '__main__':
+    unittest.main()
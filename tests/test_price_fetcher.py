@@ -0,0 +1,140 @@
+import os
+import sys
+import json
+import shutil
+import socket
+import calendar
+import tempfile
+import threading
+import unittest
+import urlparse
+import numpy as np
+from datetime import datetime
+from collections import defaultdict
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from pandas_datareader._utils import RemoteDataError
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'preprocessing'))
+from price_store import PriceStore, PriceHistory, FixtureProvider, YahooProvider
+from price_fetcher import PriceFetcher, TransientError, prefetch
+
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'fixtures', 'prices')
+
+
+class StubYahooServer(ThreadingMixIn, HTTPServer):
+
+    """
+
+    Serves the price fixtures like the Yahoo! history page (GET /quote/<symbol>/history?period1=&period2=),
+    answering the first requests of a symbol with the statuses in failures (e.g. 429, 503)
+
+    """
+
+    daemon_threads = True
+
+    def __init__(self, failures=None):
+        self.fixtures = FixtureProvider(FIXTURES)
+        self.failures = defaultdict(list, failures or {})
+        self.requests = defaultdict(int)
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubYahooHandler)
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def url(self):
+        return 'http://{}:{}/quote/{{}}/history'.format(*self.server_address)
+
+
+class StubYahooHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+
+        url = urlparse.urlparse(self.path)
+        params = urlparse.parse_qs(url.query)
+        symbol = urlparse.unquote(url.path.split('/')[2])
+        self.server.requests[symbol] += 1
+
+        if self.server.failures[symbol]:
+            self.respond(self.server.failures[symbol].pop(0), 'try again')
+            return
+
+        # Yahoo! shifts the periods by four hours
+        start, end = [datetime.fromtimestamp(int(params[name][0]) - 14400).date() for name in ['period1', 'period2']]
+        try:
+            prices = self.server.fixtures(symbol, start, end)
+        except RemoteDataError:
+            self.respond(404, 'not found')
+            return
+
+        rows = [{'date': calendar.timegm(date.timetuple()) + 14 * 3600, 'open': price, 'high': price, 'low': price,
+                 'close': price, 'volume': 1000, 'adjclose': price} for date, price in prices.iteritems()]
+        store = {'HistoricalPriceStore': {'prices': rows, 'eventsData': []}}
+        page = 'root.App.main = {};\n}}(this));'.format(json.dumps({'context': {'dispatcher': {'stores': store}}}))
+        self.respond(200, page)
+
+    def respond(self, code, body):
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class YahooProviderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.server = StubYahooServer({'AAPL': [429, 503], 'MSFT': [503] * 10})
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.folder)
+
+    def test_errors(self):
+
+        provider = YahooProvider(self.server.url)
+        self.assertRaises(TransientError, provider, 'AAPL', datetime(2013, 1, 1), datetime(2013, 3, 1))
+        self.assertRaises(TransientError, provider, 'AAPL', datetime(2013, 1, 1), datetime(2013, 3, 1))
+        self.assertRaises(RemoteDataError, provider, 'NOPE', datetime(2013, 1, 1), datetime(2013, 3, 1))
+
+        prices = provider('AAPL', datetime(2013, 1, 1), datetime(2013, 3, 1))
+        expected = FixtureProvider(FIXTURES)('AAPL', '2013-01-01', '2013-03-01')
+        self.assertTrue(np.allclose(prices.values, expected.values))
+        self.assertTrue(np.array_equal(prices.index.values, expected.index.values))
+
+        # Nothing listens on the port anymore
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        provider = YahooProvider('http://127.0.0.1:{}/quote/{{}}/history'.format(port))
+        self.assertRaises(TransientError, provider, 'AAPL', datetime(2013, 1, 1), datetime(2013, 3, 1))
+
+    def test_prefetch_retries(self):
+
+        fetcher = PriceFetcher(YahooProvider(self.server.url), workers=4, rate=100, retries=3, backoff=0.01)
+        store = PriceStore(self.folder, fetcher)
+        prefetch(store, ['AAPL', 'MSFT', 'NOPE', 'IBM'])
+
+        # Rate limited twice, then fetched
+        self.assertEqual(self.server.requests['AAPL'], 3)
+        self.assertEqual(len(store.prices('AAPL', datetime(2013, 1, 1), datetime(2013, 3, 1))),
+                         len(FixtureProvider(FIXTURES)('AAPL', '2013-01-01', '2013-03-01')))
+
+        # Failed every retry: nothing is cached, so the next run asks again
+        self.assertEqual(self.server.requests['MSFT'], 4)
+        self.assertFalse(os.path.exists(store.path('MSFT')))
+
+        self.assertTrue(PriceHistory.load(store.path('NOPE')).missing)
+        self.assertFalse(PriceHistory.load(store.path('IBM')).missing)
+        self.assertEqual(fetcher.failures, 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
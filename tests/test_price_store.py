@@ -0,0 +1,113 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+from datetime import datetime
+from pandas_datareader._utils import RemoteDataError
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'preprocessing'))
+from price_store import PriceStore, PriceHistory, FixtureProvider, to_day
+from price_fetcher import TransientError
+
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'fixtures', 'prices')
+
+
+class FailingProvider(object):
+
+    """ Serves the fixtures, but raises error for every call after the first ok calls """
+
+    def __init__(self, error, ok=0):
+        self.fixtures = FixtureProvider(FIXTURES)
+        self.error = error
+        self.ok = ok
+        self.calls = 0
+
+    def __call__(self, symbol, start, end, session=None):
+        self.calls += 1
+        if self.calls > self.ok:
+            raise self.error
+        return self.fixtures(symbol, start, end)
+
+
+class PriceStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_windows_are_served_from_the_store(self):
+
+        store = PriceStore(self.folder, FixtureProvider(FIXTURES))
+        expected = FixtureProvider(FIXTURES)('AAPL', '2013-03-01', '2013-04-30')
+
+        prices = store.prices('AAPL', datetime(2013, 3, 1), datetime(2013, 4, 30))
+        self.assertTrue(np.array_equal(prices.values, expected.values))
+        self.assertTrue(np.array_equal(prices.index.values, expected.index.values))
+
+        store.prices('AAPL', datetime(2012, 10, 1), datetime(2013, 12, 31))
+        self.assertEqual(store.fetches, 1)
+
+        # After a restart the prices come from the file
+        store = PriceStore(self.folder, FailingProvider(TransientError('offline')))
+        self.assertEqual(len(store.prices('AAPL', datetime(2013, 3, 1), datetime(2013, 4, 30))), len(expected))
+        self.assertEqual(store.fetches, 0)
+
+    def test_unknown_symbol_is_missing(self):
+
+        store = PriceStore(self.folder, FixtureProvider(FIXTURES))
+        self.assertRaises(RemoteDataError, store.prices, 'NOPE', datetime(2013, 3, 1), datetime(2013, 4, 30))
+        self.assertTrue(PriceHistory.load(store.path('NOPE')).missing)
+
+        store = PriceStore(self.folder, FixtureProvider(FIXTURES))
+        self.assertRaises(RemoteDataError, store.prices, 'NOPE', datetime(2013, 5, 1), datetime(2013, 5, 30))
+        self.assertEqual(store.fetches, 0)
+
+    def test_failed_gap_is_not_marked_missing(self):
+
+        # A history fetched up to the end of June 2013, extended later while the provider has no data
+        history = PriceHistory()
+        history.update(FixtureProvider(FIXTURES)('MSFT', '2001-01-01', '2013-06-30'),
+                       to_day('2001-01-01'), to_day('2013-06-30'))
+        history.save(os.path.join(self.folder, 'MSFT.npz'))
+
+        provider = FailingProvider(RemoteDataError('No data fetched for symbol MSFT'))
+        store = PriceStore(self.folder, provider)
+        prices = store.prices('MSFT', datetime(2013, 6, 1), datetime(2013, 8, 30))
+        self.assertEqual(prices.index[-1], pd.Timestamp('2013-06-28'))
+
+        saved = PriceHistory.load(store.path('MSFT'))
+        self.assertFalse(saved.missing)
+        self.assertEqual(saved.last, to_day('2013-06-30'))
+
+        # The gap is asked for again, and filled once the provider answers
+        store = PriceStore(self.folder, FixtureProvider(FIXTURES))
+        prices = store.prices('MSFT', datetime(2013, 6, 1), datetime(2013, 8, 30))
+        self.assertEqual(store.fetches, 1)
+        self.assertEqual(prices.index[-1], pd.Timestamp('2013-08-30'))
+
+    def test_transient_errors_are_not_saved(self):
+
+        store = PriceStore(self.folder, FailingProvider(TransientError('HTTP 503 for IBM')))
+        self.assertRaises(TransientError, store.prices, 'IBM', datetime(2013, 3, 1), datetime(2013, 4, 30))
+        self.assertFalse(os.path.exists(store.path('IBM')))
+
+        store = PriceStore(self.folder, FixtureProvider(FIXTURES))
+        self.assertEqual(len(store.prices('IBM', datetime(2013, 3, 1), datetime(2013, 4, 30))),
+                         len(FixtureProvider(FIXTURES)('IBM', '2013-03-01', '2013-04-30')))
+
+    def test_no_prices_in_window(self):
+
+        # IBM has prices, just not after June 2013
+        store = PriceStore(self.folder, FixtureProvider(FIXTURES))
+        self.assertEqual(len(store.prices('IBM', datetime(2013, 8, 1), datetime(2013, 8, 30))), 0)
+        self.assertFalse(store.history('IBM').missing)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'search'))
+from index_fixture import fixtureTranscripts, buildFixtureIndex
+from query_cache import QueryCache
+from index_format import indexGeneration, indexStamp
+from doc_table import DocTable
+from filters import DocFilter, FILTER_CACHE_SIZE, filterCache
+from search import ShardExecutor
+
+
+class QueryCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def files(self):
+        return sorted(name for name in os.listdir(self.folder) if name.endswith('.p'))
+
+    def test_files_removed_by_another_process(self):
+
+        cache = QueryCache(2, self.folder)
+        cache.validate(1, 'build-a')
+        cache.put(('profit',), {'2013-01-01': 1})
+        cache.put(('margin',), {'2013-01-01': 2})
+        for name in self.files():
+            os.remove(os.path.join(self.folder, name))
+
+        # A restarted cache reads the names, then the files disappear
+        cache = QueryCache(2, self.folder)
+        cache.validate(1, 'build-a')
+        cache.put(('loss',), {'2013-01-01': 3})
+        cache.put(('cut',), {'2013-01-01': 4})
+        os.remove(os.path.join(self.folder, cache._name(('loss',))))
+        self.assertIsNone(cache.get(('profit',)))
+        self.assertIsNone(QueryCache(2, self.folder).get(('loss',)))
+
+        cache.put(('cloud',), {'2013-01-01': 5})
+        cache.validate(2, 'build-b')
+        self.assertEqual(self.files(), [])
+
+    def test_files_belong_to_a_build(self):
+
+        cache = QueryCache(8, self.folder)
+        cache.validate(1, 'build-a')
+        cache.put(('profit',), {'2013-01-01': 1})
+
+        # Restarted on the same build: warm
+        cache = QueryCache(8, self.folder)
+        cache.validate(1, 'build-a')
+        self.assertEqual(cache.get(('profit',)), {'2013-01-01': 1})
+
+        # Restarted on a rebuild whose generation started over: cold
+        cache = QueryCache(8, self.folder)
+        cache.validate(1, 'build-b')
+        self.assertIsNone(cache.get(('profit',)))
+        self.assertEqual(self.files(), [])
+
+    def test_rebuilt_index(self):
+
+        index = os.path.join(self.folder, 'index')
+        cache_folder = os.path.join(self.folder, 'cache')
+
+        def build(seed):
+            if os.path.isdir(index):
+                shutil.rmtree(index)
+            os.makedirs(index)
+            buildFixtureIndex(index, fixtureTranscripts(40, seed))
+            executor = ShardExecutor(index, workers=1, cache_folder=cache_folder)
+            counts = executor.search('profit margin', by='doc')
+            executor.close()
+            return counts
+
+        first = build(1)
+        generation, stamp = indexGeneration(index), indexStamp(index)
+        second = build(2)
+        self.assertEqual(indexGeneration(index), generation)
+        self.assertNotEqual(indexStamp(index), stamp)
+
+        executor = ShardExecutor(index, workers=1, cache_size=0)
+        self.assertEqual(second, executor.search('profit margin', by='doc'))
+        self.assertNotEqual(first, second)
+        executor.close()
+
+
+class FilterCacheTest(unittest.TestCase):
+
+    def test_bounded(self):
+
+        docs = DocTable()
+        for id in xrange(100):
+            docs.add(id, 'Company {}'.format(id), 'NYSE:C{}'.format(id), datetime(2013, 1, 1 + id % 28))
+
+        first = DocFilter(tickers=['C0'])
+        for id in xrange(3 * FILTER_CACHE_SIZE):
+            where = DocFilter(tickers=['C{}'.format(id % 100)], start=datetime(2013, 1, 1 + id // 100))
+            self.assertEqual(list(where.mask(docs).nonzero()[0]),
+                             [doc for doc in xrange(100) if doc == id % 100 and 1 + doc % 28 >= 1 + id // 100])
+            where.bitmap(docs)
+            first.mask(docs)
+            self.assertLessEqual(len(filterCache(docs)), FILTER_CACHE_SIZE)
+
+        # The filter used all along is still cached
+        self.assertIn(('mask', first.key()), filterCache(docs))
+
+
+if __name__ == '__main__':
+    unittest.main()
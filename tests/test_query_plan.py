@@ -0,0 +1,204 @@
+import os
+import sys
+import random
+import shutil
+import tempfile
+import unittest
+import pandas as pd
+from datetime import datetime
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'search'))
+from index_fixture import WORDS, fixtureTranscripts, buildFixtureIndex
+from transcript_store import Transcript
+from build_index import parseTranscript
+from doc_table import openDocTable
+from index_format import findShards, openIndex
+from search import mergeCounts
+from query_plan import QueryPlan, Phrase, And, Or, Not, Near
+
+
+def naiveMatches(node, positions):
+
+    """ Matches (start, end) of a plan node in a document, straight from {term: set of positions} """
+
+    if isinstance(node, Phrase):
+        return set((start, start + len(node.terms) - 1) for start in positions.get(node.terms[0], ())
+                   if all(start + i in positions.get(term, ()) for i, term in enumerate(node.terms)))
+
+    found = [naiveMatches(child, positions) for child in node.children]
+    if isinstance(node, And):
+        return set.union(*found) if all(found) else set()
+    if isinstance(node, Or):
+        return set.union(*found)
+    if isinstance(node, Not):
+        return found[0] if not found[1] else set()
+    if isinstance(node, Near):
+        return set((min(a[0], b[0]), max(a[1], b[1])) for a in found[0] for b in found[1]
+                   if max(b[0] - a[1], a[0] - b[1], 0) <= node.distance)
+
+
+def randomExpression(rng, depth=3):
+
+    if depth == 0 or rng.random() < 0.3:
+        words = [rng.choice(WORDS) for _ in xrange(rng.choice([1, 1, 2]))]
+        return words[0] if len(words) == 1 else u'"{}"'.format(u' '.join(words))
+
+    left, right = randomExpression(rng, depth - 1), randomExpression(rng, depth - 1)
+    op = rng.choice(['AND', 'OR', 'NOT', 'NEAR/{}'.format(rng.randint(0, 6))])
+    return u'({} {} {})'.format(left, op, right)
+
+
+class ParserTest(unittest.TestCase):
+
+    def root(self, text):
+        plan = QueryPlan(text)
+        self.assertEqual(len(plan.expressions), 1)
+        return plan.expressions[0].root.key
+
+    def test_precedence(self):
+
+        # OR binds loosest, then AND / NOT, then NEAR
+        self.assertEqual(self.root('profit OR loss AND cut'), u'OR("profit", AND("cut", "loss"))')
+        self.assertEqual(self.root('(profit OR loss) AND cut'), u'AND("cut", OR("loss", "profit"))')
+        self.assertEqual(self.root('profit NEAR/3 loss AND cut'), u'AND("cut", NEAR/3("loss", "profit"))')
+        self.assertEqual(self.root('profit NEAR/3 loss OR cut'), u'OR("cut", NEAR/3("loss", "profit"))')
+        self.assertEqual(self.root('profit AND cut NOT loss'), u'NOT(AND("cut", "profit"), "loss")')
+        self.assertEqual(self.root('profit AND NOT loss'), self.root('profit NOT loss'))
+
+    def test_phrases(self):
+
+        # A run of bare words is one phrase, quotes make keywords words and split phrases
+        self.assertEqual(self.root('profit margin'), u'"profit margin"')
+        self.assertEqual(self.root('"profit" "margin"'), u'AND("margin", "profit")')
+        self.assertEqual(self.root('"cut AND loss"'), u'"cut and loss"')
+        self.assertEqual(self.root('Margins'), u'"margin"')
+
+    def test_filters(self):
+
+        expression = QueryPlan('field:qanda profit date:2012-01-01.. ticker:aapl exchange:nasdaq').expressions[0]
+        self.assertEqual(expression.root.key, u'"profit"')
+        self.assertEqual(expression.field, 'qanda')
+        self.assertEqual(expression.where.key(), (('AAPL',), ('NASDAQ',), datetime(2012, 1, 1).toordinal(), None, ()))
+        self.assertIsNone(QueryPlan('profit').expressions[0].where)
+
+    def test_interning(self):
+
+        plan = QueryPlan('profit margin, (profit margin) NOT loss, loss OR "profit margin"')
+        phrase = plan.expressions[0].root
+        self.assertIs(plan.expressions[1].root.children[0], phrase)
+        self.assertIn(phrase, plan.expressions[2].root.children)
+        self.assertEqual(sorted(plan.nodes), sorted([u'"profit margin"', u'"loss"', u'NOT("profit margin", "loss")',
+                                                     u'OR("loss", "profit margin")']))
+
+        # AND / OR are flattened without duplicates, and their children are unordered
+        self.assertEqual(self.root('cut AND (loss AND cut)'), u'AND("cut", "loss")')
+        self.assertEqual(self.root('(loss OR cut) OR profit'), self.root('profit OR (cut OR loss)'))
+
+    def test_malformed(self):
+
+        for text in ['NOT loss', 'profit AND', 'profit OR', '(profit', 'profit)', 'profit NEAR/2', 'NEAR/2 profit',
+                     '""', '( )', 'field:qanda', 'field:answers profit', 'date:2012-13-01 profit', 'profit AND ,']:
+            self.assertRaises(ValueError, QueryPlan, text)
+
+
+class EvaluationTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+
+        transcripts = fixtureTranscripts()
+        # Hand made calls for the NEAR distances: "margin" is 4 positions after "profit", then 3 before it
+        for key, text in [(1001, 'Profit rose and the margin fell.'), (1002, 'Margin, then profit.')]:
+            transcripts[key] = Transcript('Company {}'.format(key), 'NYSE:HM', datetime(2013, 5, 1), *([None] * 4 + [
+                pd.Series([text]), pd.Series(['No questions.'])]))
+
+        cls.folder = tempfile.mkdtemp()
+        buildFixtureIndex(cls.folder, transcripts)
+        cls.docs = openDocTable(cls.folder)
+        cls.shards = [openIndex(path) for path in findShards(cls.folder)]
+
+        # {term: set of positions} and the start of the Q&A of every document, from the parser of the index
+        cls.positions = []
+        cls.qanda = []
+        for id, transcript in enumerate(transcripts.itervalues()):
+            parsed, qanda, _ = parseTranscript(transcript, id)
+            cls.positions.append({term: set(int(pos) for pos in posting[1]) for term, posting in parsed.iteritems()})
+            cls.qanda.append(qanda)
+
+    @classmethod
+    def tearDownClass(cls):
+        for shard in cls.shards:
+            shard.close()
+        shutil.rmtree(cls.folder)
+
+    def evaluate(self, text, deleted=frozenset(), field=None):
+        plan = QueryPlan(text)
+        counts = mergeCounts([plan.evaluate(shard, self.docs, deleted, 'doc', field=field)[0]
+                              for shard in self.shards])
+        return plan, counts
+
+    def expected(self, expression, deleted=frozenset(), field=None):
+
+        # A field of the expression that differs from the one of the search matches nothing
+        if field is not None and expression.field is not None and field != expression.field:
+            return dict()
+
+        allowed = expression.where.mask(self.docs) if expression.where is not None else None
+        section = field or expression.field
+        counts = dict()
+        for doc, positions in enumerate(self.positions):
+            if doc in deleted or (allowed is not None and not allowed[doc]):
+                continue
+            matches = naiveMatches(expression.root, positions)
+            if section == 'prepared':
+                matches = [match for match in matches if match[0] < self.qanda[doc]]
+            elif section == 'qanda':
+                matches = [match for match in matches if match[0] >= self.qanda[doc]]
+            if matches:
+                counts[doc] = len(matches)
+        return counts
+
+    def assertCounts(self, text, deleted=frozenset(), field=None):
+        plan, counts = self.evaluate(text, deleted, field)
+        for expression in plan.expressions:
+            self.assertEqual(dict(counts[expression.text.encode('utf-8')]),
+                             self.expected(expression, deleted, field), expression.text)
+        return counts
+
+    def test_near_distance(self):
+
+        near = lambda text: dict(self.evaluate(text)[1][text])
+        first, second = len(self.docs) - 2, len(self.docs) - 1
+        self.assertIn(first, near('profit NEAR/4 margin'))
+        self.assertNotIn(first, near('profit NEAR/3 margin'))
+        # Either order, and a pair counts once
+        self.assertEqual(near('margin NEAR/4 profit')[first], 1)
+        self.assertEqual(near('profit NEAR/3 margin')[second], 1)
+        self.assertNotIn(second, near('profit NEAR/2 margin'))
+
+    def test_operators(self):
+
+        for text in ['profit margin', 'profit AND margin', 'profit OR margin', 'profit NOT margin',
+                     'profit NEAR/2 margin', '"supply chain" NEAR/5 (demand OR growth)', 'guidance NOT raised',
+                     'guidance NOT "cut guidance"', '(cloud OR revenue) NOT (loss AND cut)']:
+            self.assertCounts(text)
+
+        # The counts of a phrase are its occurrences
+        counts = self.assertCounts('cloud')
+        self.assertTrue(any(count > 1 for count in counts['cloud'].values()))
+
+    def test_random_expressions(self):
+
+        rng = random.Random(4)
+        deleted = frozenset(rng.sample(xrange(len(self.docs)), 20))
+        filters = ['', ' field:prepared', ' field:qanda', ' date:2012-01-01..2013-12-31', ' ticker:AAPL ticker:IBM',
+                   ' exchange:NYSE']
+
+        for _ in xrange(40):
+            expressions = [randomExpression(rng) + rng.choice(filters) for _ in xrange(rng.randint(1, 3))]
+            self.assertCounts(u', '.join(expressions), rng.choice([frozenset(), deleted]),
+                              rng.choice([None, None, 'prepared']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import os
+import sys
+import random
+import shutil
+import tempfile
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'search'))
+from index_fixture import WORDS, fixtureTranscripts, buildFixtureIndex
+from doc_table import openDocTable
+from index_format import findShards, openIndex
+from filters import DocFilter
+from ranking import collectionStats, queryWeights, topK, exhaustive, mergeTop
+
+
+class RankingTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.mkdtemp()
+        buildFixtureIndex(cls.folder, fixtureTranscripts())
+        cls.docs = openDocTable(cls.folder)
+        cls.shards = [openIndex(path) for path in findShards(cls.folder)]
+
+    @classmethod
+    def tearDownClass(cls):
+        for shard in cls.shards:
+            shard.close()
+        shutil.rmtree(cls.folder)
+
+    def rank(self, method, query, k, deleted=frozenset(), where=None):
+        n, _ = collectionStats(self.docs, deleted)
+        weights = queryWeights(query, self.shards, n)
+        return mergeTop([method(weights, shard, self.docs, k, deleted, where) for shard in self.shards], k)
+
+    def assertSameTop(self, query, k, deleted=frozenset(), where=None):
+        expected = self.rank(exhaustive, query, k, deleted, where)
+        found = self.rank(topK, query, k, deleted, where)
+        self.assertEqual([doc for _, doc in found], [doc for _, doc in expected], query)
+        for (score, _), (best, _) in zip(found, expected):
+            self.assertAlmostEqual(score, best, places=9)
+        return found
+
+    def test_ties_by_doc_id(self):
+
+        # Calls with the same text have the same score, the lower doc id comes first
+        top = self.assertSameTop('cloud', 100)
+        scores = [score for score, _ in top]
+        self.assertLess(len(set(scores)), len(scores))
+        for (score, doc), (next_score, next_doc) in zip(top, top[1:]):
+            self.assertTrue(score > next_score or doc < next_doc)
+
+    def test_random_queries(self):
+
+        rng = random.Random(2)
+        deleted = frozenset(rng.sample(xrange(len(self.docs)), 30))
+        wheres = [None, DocFilter(tickers=['AAPL', 'NYSE:IBM']), DocFilter(start='2012-01-01', end='2013-06-30'),
+                  DocFilter(returns={'return_30days': (None, 0.0)})]
+
+        for _ in xrange(60):
+            query = ' '.join(rng.choice(WORDS) for _ in xrange(rng.randint(1, 5)))
+            k = rng.choice([1, 3, 10, 50])
+            where = rng.choice(wheres)
+            top = self.assertSameTop(query, k, rng.choice([frozenset(), deleted]), where)
+
+            if where is not None:
+                mask = where.mask(self.docs)
+                self.assertTrue(all(mask[doc] for _, doc in top))
+
+        top = self.assertSameTop('profit margin guidance', 50, deleted)
+        self.assertFalse(deleted & set(doc for _, doc in top))
+
+
+if __name__ == '__main__':
+    unittest.main()
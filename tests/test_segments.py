@@ -0,0 +1,77 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from collections import OrderedDict
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'search'))
+from index_fixture import fixtureTranscripts, buildFixtureIndex
+from index_format import Manifest
+from segments import addTranscripts, compact
+from search import ShardExecutor
+
+
+class CompactTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.transcripts = fixtureTranscripts(160)
+        buildFixtureIndex(self.folder, OrderedDict(self.transcripts.items()[:40]))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def add(self, start, n=4, size=5):
+        items = self.transcripts.items()
+        return [addTranscripts(OrderedDict(items[i:i + size]), self.folder)
+                for i in xrange(start, start + n * size, size)]
+
+    def exists(self, segments):
+        return [os.path.exists(os.path.join(self.folder, segment)) for segment in segments]
+
+    def test_old_generation_still_searchable(self):
+
+        first = self.add(40)
+        executor = ShardExecutor(self.folder, workers=1, cache_size=0)
+        try:
+            # A query that started on the generation before the compaction
+            current = executor.current()
+            expected = executor._search('profit margin', current, by='doc')
+
+            self.assertEqual(compact(self.folder, fanout=4), 4)
+            segments = Manifest.load(self.folder).segments
+            self.assertFalse(set(first) & set(segments))
+            self.assertEqual(self.exists(first), [True] * 4)
+            self.assertEqual(executor._search('profit margin', current, by='doc'), expected)
+            self.assertEqual(executor.search('profit margin', by='doc'), expected)
+
+            # The next compaction (of the merged segment and four new ones) removes the segments
+            # retired by this one, and retires its own
+            second = [segments[-1]] + self.add(60)
+            self.assertEqual(compact(self.folder, fanout=4), 5)
+            self.assertEqual(self.exists(first), [False] * 4)
+            self.assertEqual(self.exists(second), [True] * 5)
+            self.assertEqual(sorted(segment for segment, _ in Manifest.load(self.folder).retired), sorted(second))
+            fresh = ShardExecutor(self.folder, workers=1, cache_size=0)
+            self.assertEqual(executor.search('profit margin', by='doc'), fresh.search('profit margin', by='doc'))
+            fresh.close()
+        finally:
+            executor.close()
+
+    def test_one_compaction_keeps_what_it_retires(self):
+
+        # Two tiers merged by the same compaction: the segments of the first one are still on disk
+        first = self.add(40, size=1)
+        self.add(44, size=25)
+        self.assertEqual(compact(self.folder, fanout=4, base=400), 8)
+        self.assertEqual(self.exists(first), [True] * 4)
+
+        manifest = Manifest.load(self.folder)
+        self.assertEqual(len(manifest.retired), 8)
+        self.assertEqual(sum(self.exists(segment for segment, _ in manifest.retired)), 8)
+        self.assertTrue(all(os.path.exists(path) for path in manifest.paths))
+
+
+if __name__ == '__main__':
+    unittest.main()
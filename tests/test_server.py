@@ -0,0 +1,148 @@
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import urllib2
+import tempfile
+import threading
+import unittest
+from datetime import datetime
+from multiprocessing import TimeoutError
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'search'))
+from doc_table import DocTable, DOCS_FILE, openDocTable
+from index_format import convertIndex
+from search import ShardExecutor
+from server import SearchServer, query
+
+
+WORDS = ['profit', 'margin', 'loss', 'cut', 'cloud', 'demand', 'supply', 'chain']
+
+
+def sleep(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+def writeIndex(folder, n=200, shards=3):
+
+    """ Random calls split over binary shards (converted from text shards) """
+
+    rng = random.Random(5)
+    docs = DocTable()
+    postings = [dict() for _ in xrange(shards)]
+    for id in xrange(n):
+        words = [rng.choice(WORDS) for _ in xrange(rng.randint(5, 40))]
+        docs.add(id, 'Company {}'.format(id), 'NYSE:C{}'.format(id), datetime(2010 + id % 5, 1 + id % 12, 1 + id % 28),
+                 tokens=len(words))
+        for pos, word in enumerate(words):
+            postings[id % shards].setdefault(word, dict()).setdefault(id, []).append(str(pos))
+    docs.save(os.path.join(folder, DOCS_FILE))
+
+    for i, shard in enumerate(postings):
+        path = os.path.join(folder, 'index{}.txt'.format(i))
+        with open(path, 'wb') as f:
+            for word in sorted(shard):
+                f.write('{}||{}\n'.format(word, ';'.join('{}:{}'.format(id, ','.join(positions))
+                                                         for id, positions in sorted(shard[word].items()))))
+        convertIndex(path, docs=openDocTable(folder))
+        os.remove(path)
+
+
+class ConcurrencyTest(unittest.TestCase):
+
+    queries = ['profit margin', 'supply chain, cloud demand', 'loss', 'margin cut, profit', 'demand']
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        writeIndex(self.folder)
+        self.expected = dict()
+        executor = ShardExecutor(self.folder, workers=2, cache_size=0)
+        for ngrams in self.queries:
+            self.expected[ngrams] = executor.search(ngrams, by='doc')
+        executor.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_threads_share_executor(self):
+
+        executor = ShardExecutor(self.folder, workers=2, cache_size=3)
+        errors = []
+
+        def run(seed):
+            rng = random.Random(seed)
+            try:
+                for _ in xrange(20):
+                    ngrams = rng.choice(self.queries)
+                    self.assertEqual(executor.search(ngrams, by='doc'), self.expected[ngrams])
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run, args=(seed,)) for seed in xrange(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        executor.close()
+
+        self.assertEqual(errors, [])
+
+    def test_timeout_fails_only_its_query(self):
+
+        executor = ShardExecutor(self.folder, workers=2)
+        results = []
+        errors = []
+
+        def wait():
+            try:
+                results.append(executor._map(sleep, [1, 1]))
+            except Exception as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=wait)
+        thread.start()
+        time.sleep(0.2)
+
+        start = time.time()
+        self.assertRaises(TimeoutError, executor._map, sleep, [0.5], timeout=0.3)
+        self.assertLess(time.time() - start, 0.8)
+        thread.join(5)
+
+        # The query that was running on the same workers is not affected
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(errors, [])
+        self.assertEqual(results, [[1, 1]])
+
+        self.assertEqual(executor.search('profit margin', by='doc'), self.expected['profit margin'])
+        executor.close()
+
+    def test_server_counts_queries(self):
+
+        server = SearchServer(self.folder, port=0, workers=2, compact_interval=0)
+        server.RequestHandlerClass.log_message = lambda *args: None
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        port = server.server_address[1]
+
+        def run():
+            for ngrams in self.queries:
+                query(ngrams, port=port)
+
+        threads = [threading.Thread(target=run) for _ in xrange(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        status = json.load(urllib2.urlopen('http://127.0.0.1:{}/status'.format(port)))
+        server.shutdown()
+        server.server_close()
+        self.assertEqual(status['queries'], 6 * len(self.queries))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+import os
+import sys
+import json
+import shutil
+import urllib
+import urllib2
+import tempfile
+import threading
+import unittest
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'search'))
+from index_fixture import fixtureTranscripts, buildFixtureIndex
+from transcript_store import TranscriptStore, write_store
+from analysis import TOKEN_PATTERN
+from snippets import kwic
+from search import ShardExecutor
+from server import SearchServer
+
+
+TEXT = u'Revenue grew, and the profit margin rose.'
+
+
+class KwicTest(unittest.TestCase):
+
+    def test_context(self):
+
+        self.assertEqual(kwic(TEXT, 5, 2, 2), (u'and the ', u'profit margin', u' rose.'))
+        self.assertEqual(kwic(TEXT, 0, 1, 3), (u'', u'Revenue', u' grew, and'))
+        self.assertEqual(kwic(TEXT, 8, 1, 5), (u'and the profit margin rose', u'.', u''))
+        self.assertEqual(kwic(TEXT, 2, 1, 0), (u'', u',', u''))
+
+        for offset in xrange(9):
+            left, hit, right = kwic(TEXT, offset, 1, 4)
+            self.assertIn(left + hit + right, TEXT)
+
+    def test_outside_paragraph(self):
+        self.assertRaises(ValueError, kwic, TEXT, 8, 2)
+        self.assertRaises(ValueError, kwic, TEXT, 20, 1)
+
+
+class SnippetsTest(unittest.TestCase):
+
+    ngram = 'profit margin'
+
+    @classmethod
+    def setUpClass(cls):
+
+        cls.folder = tempfile.mkdtemp()
+        cls.index = os.path.join(cls.folder, 'index')
+        cls.store = os.path.join(cls.folder, 'transcripts')
+        os.makedirs(cls.index)
+
+        # A call without a key, and two calls that are indexed but not in the store (yet), all with a hit
+        transcripts = fixtureTranscripts(60)
+        transcripts[None] = transcripts[3]
+        for key in (None, 5, 7):
+            transcripts[key] = transcripts[key]._replace(prepared=pd.Series(['The profit margin rose.']))
+        cls.missing = set(id for id, key in enumerate(transcripts) if key in (None, 5, 7))
+
+        buildFixtureIndex(cls.index, transcripts, batch_size=20)
+        write_store([(key, transcript) for key, transcript in transcripts.iteritems() if key not in (None, 5, 7)],
+                    cls.store)
+        cls.executor = ShardExecutor(cls.index, workers=1, store=cls.store)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.executor.close()
+        shutil.rmtree(cls.folder)
+
+    def test_pages(self):
+
+        counts = self.executor.search(self.ngram, by='doc')[self.ngram]
+        everything = self.executor.snippets(self.ngram, 0, 10000, width=3)
+        snippets = everything['snippets']
+        self.assertEqual(everything['total'], sum(counts.values()))
+        self.assertEqual(len(snippets), everything['total'])
+        self.assertEqual(snippets, sorted(snippets, key=lambda snippet: (snippet['date'], snippet['id'],
+                                                                          snippet['position'])))
+
+        pages = []
+        for offset in xrange(0, everything['total'], 7):
+            page = self.executor.snippets(self.ngram, offset, 7, width=3)
+            self.assertEqual((page['total'], page['offset']), (everything['total'], offset))
+            pages += page['snippets']
+        self.assertEqual(pages, snippets)
+        self.assertEqual(self.executor.snippets(self.ngram, everything['total'], 7)['snippets'], [])
+        self.assertEqual(list(self.executor.iterSnippets(self.ngram, page_size=5, width=3)), snippets)
+
+    def test_text_and_missing(self):
+
+        store = TranscriptStore(self.store)
+        snippets = self.executor.snippets(self.ngram, 0, 10000, width=3)['snippets']
+        self.assertEqual(set(snippet['id'] for snippet in snippets if snippet['missing']), self.missing)
+
+        for snippet in snippets:
+            if snippet['missing']:
+                self.assertEqual((snippet['paragraph'], snippet['left'], snippet['hit'], snippet['right']),
+                                 (None, None, None, None))
+                continue
+            self.assertEqual(snippet['hit'].lower(), self.ngram)
+            self.assertLessEqual(len(TOKEN_PATTERN.findall(snippet['left'])), 3)
+            self.assertLessEqual(len(TOKEN_PATTERN.findall(snippet['right'])), 3)
+            self.assertIn(snippet['left'] + snippet['hit'] + snippet['right'],
+                          store.paragraph(snippet['key'], snippet['paragraph']))
+
+        qanda = self.executor.snippets(self.ngram, 0, 10000, field='qanda')
+        self.assertTrue(qanda['snippets'])
+        self.assertEqual(set(snippet['field'] for snippet in qanda['snippets']), set(['qanda']))
+        self.assertRaises(ValueError, self.executor.snippets, 'profit, margin')
+
+    def test_server(self):
+
+        server = SearchServer(self.index, port=0, workers=1, compact_interval=0)
+        server.RequestHandlerClass.log_message = lambda *args: None
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        def get(store):
+            server.executor.store = store
+            server.executor._snippets = (None, None)
+            url = 'http://127.0.0.1:{}/snippets?{}'.format(server.server_address[1],
+                                                           urllib.urlencode({'ngram': self.ngram, 'limit': 10000}))
+            try:
+                response = urllib2.urlopen(url)
+                return response.getcode(), json.load(response)
+            except urllib2.HTTPError as e:
+                return e.code, json.load(e)
+
+        try:
+            code, page = get(self.store)
+            self.assertEqual(code, 200)
+            self.assertIn(None, [snippet['key'] for snippet in page['snippets'] if snippet['missing']])
+
+            code, error = get(os.path.join(self.folder, 'nowhere'))
+            self.assertEqual(code, 404)
+            self.assertIn('error', error)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import os
+import sys
+import gzip
+import shutil
+import tempfile
+import unittest
+import cPickle as pickle
+import pandas as pd
+from datetime import datetime
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'preprocessing'))
+from transcript_store import (Transcript, TranscriptStore, write_store, write_metadata, convert, RETURNS,
+                              text_digest, transcript_digest)
+
+
+def transcripts():
+
+    """ {key: Transcript} with unicode text, missing returns, and empty sections """
+
+    calls = dict()
+    for key in xrange(1, 8):
+        prepared = [u'Call {} paragraph {} \u2013 caf\xe9 margins'.format(key, i) for i in xrange(key % 3 + 1)]
+        qanda = [u'Question {} {}'.format(key, i) for i in xrange(key % 4)]
+        returns = [0.1 * key, None, -0.25 / key, 1e-17 * key] if key != 4 else [None] * 4
+        calls[key] = Transcript(u'Company {} \xc5B'.format(key), 'NYSE:C{}'.format(key), datetime(2013, key, 2, 8),
+                                *(returns + [pd.Series(prepared), pd.Series(qanda)]))
+    return calls
+
+
+class TranscriptStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'transcripts')
+        self.transcripts = transcripts()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def assertTranscript(self, found, expected):
+
+        self.assertEqual((found.company, found.ticker, found.date), (expected.company, expected.ticker, expected.date))
+        for column in RETURNS:
+            self.assertEqual(getattr(found, column), getattr(expected, column))
+        # Paragraphs are numbered from 3 on, like the parsed transcripts
+        self.assertEqual(list(found.prepared), list(expected.prepared))
+        self.assertEqual(list(found.QandA), list(expected.QandA))
+        self.assertEqual(list(found.prepared.index) + list(found.QandA.index),
+                         range(3, 3 + len(expected.prepared) + len(expected.QandA)))
+
+    def test_round_trip(self):
+
+        for chunk_size in [1, 3, 256]:
+            write_store(self.transcripts, self.path, chunk_size=chunk_size)
+            store = TranscriptStore(self.path)
+
+            self.assertEqual(len(store), len(self.transcripts))
+            self.assertEqual(sorted(store.keys()), sorted(self.transcripts))
+            for key, transcript in self.transcripts.iteritems():
+                self.assertIn(key, store)
+                self.assertTranscript(store[key], transcript)
+
+            streamed = list(store.iteritems())
+            self.assertEqual([key for key, _ in streamed], store.keys())
+            for key, transcript in streamed:
+                self.assertTranscript(transcript, self.transcripts[key])
+            self.assertEqual([key for key, _ in store.iteritems([6, 2])], [2, 6])
+
+            transcript = self.transcripts[5]
+            paragraphs = list(transcript.prepared) + list(transcript.QandA)
+            self.assertEqual([store.paragraph(5, i) for i in xrange(len(paragraphs))], paragraphs)
+
+    def test_metadata(self):
+
+        write_store(self.transcripts, self.path, chunk_size=2)
+        store = TranscriptStore(self.path)
+
+        headers = store.headers()
+        self.assertEqual(headers[3].company, self.transcripts[3].company)
+        self.assertIsNone(headers[3].prepared)
+        self.assertEqual(sorted(store.select(tickers=['C2', 'NYSE:C5']).key), [2, 5])
+        self.assertEqual(sorted(store.select(start='2013-03-01', end='2013-05-02').key), [3, 4])
+
+        expected = {key: transcript_digest(transcript, text_digest(transcript.prepared, transcript.QandA))
+                    for key, transcript in self.transcripts.iteritems()}
+        self.assertEqual(store.digests(), expected)
+
+        # A second table points at the same text, and is carried over when the store is written again
+        table = store.metadata.copy()
+        table['return_30days'] = 0.5
+        write_metadata(table, self.path, 'returns.csv')
+        self.assertEqual(TranscriptStore(self.path, 'returns.csv')[2].return_30days, 0.5)
+
+        del self.transcripts[1]
+        write_store(self.transcripts, self.path, chunk_size=3, keep=['returns.csv'])
+        carried = TranscriptStore(self.path, 'returns.csv')
+        self.assertEqual(sorted(carried.keys()), range(2, 8))
+        self.assertEqual(carried[7].return_30days, 0.5)
+        self.assertEqual(list(carried[7].QandA), list(self.transcripts[7].QandA))
+        self.assertFalse(os.path.exists(self.path + '.tmp') or os.path.exists(self.path + '.old'))
+
+    def test_convert(self):
+
+        path = os.path.join(self.folder, 'transcripts.p.gz')
+        with gzip.open(path, 'wb') as f:
+            pickle.dump(self.transcripts, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        convert(path, self.path)
+        store = TranscriptStore(self.path)
+        for key, transcript in self.transcripts.iteritems():
+            self.assertTranscript(store[key], transcript)
+
+
+if __name__ == '__main__':
+    unittest.main()